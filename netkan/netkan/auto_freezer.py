@@ -21,11 +21,11 @@ class AutoFreezer:
         self.nk_repo.pull_remote_primary(strategy_option='ours')
         idle_mods = self._find_idle_mods(days_limit, days_till_ignore)
         if idle_mods:
-            with self.nk_repo.change_branch(self.BRANCH_NAME):
+            with self.nk_repo.worktree_branch(self.BRANCH_NAME) as staging_repo:
                 for ident, _ in idle_mods:
-                    if self.nk_repo.nk_path(ident).exists():
+                    if staging_repo.nk_path(ident).exists():
                         logging.info('Freezing %s', ident)
-                        self._add_freezee(ident)
+                        self._add_freezee(staging_repo, ident)
                     else:
                         logging.info('Already froze %s', ident)
             self._submit_pr(self.BRANCH_NAME, days_limit, idle_mods)
@@ -72,12 +72,13 @@ class AutoFreezer:
             # No timestamp if mod isn't in the status table (very freshly merged)
             return None
 
-    def _add_freezee(self, ident: str) -> None:
-        self.nk_repo.git_repo.index.move([
-            self.nk_repo.nk_path(ident).as_posix(),
-            self.nk_repo.frozen_path(ident).as_posix()
+    @staticmethod
+    def _add_freezee(nk_repo: NetkanRepo, ident: str) -> None:
+        nk_repo.git_repo.index.move([
+            nk_repo.nk_path(ident).as_posix(),
+            nk_repo.frozen_path(ident).as_posix()
         ])
-        self.nk_repo.git_repo.index.commit(f'Freeze {ident}')
+        nk_repo.git_repo.index.commit(f'Freeze {ident}')
 
     def _mod_table(self, idle_mods: List[Tuple[str, datetime]]) -> str:
         return '\n'.join([
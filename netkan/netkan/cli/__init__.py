@@ -19,6 +19,7 @@ from .utilities import (
     mirror_purge_epochs,
     analyze_mod,
     inflate_netkan,
+    benchmark_parsing,
 )
 
 
@@ -43,3 +44,4 @@ netkan.add_command(mirrorer)
 netkan.add_command(mirror_purge_epochs)
 netkan.add_command(analyze_mod)
 netkan.add_command(inflate_netkan)
+netkan.add_command(benchmark_parsing)
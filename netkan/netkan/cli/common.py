@@ -4,6 +4,7 @@ from pathlib import Path
 from typing import Union, Callable, Any, List, Optional, Tuple, Dict
 
 import click
+from git import Repo
 
 from ..repos import NetkanRepo, CkanMetaRepo
 from ..utils import init_repo, init_ssh
@@ -31,6 +32,19 @@ _COMMON_OPTIONS = [
                  help='SSH key for accessing repositories', callback=ctx_callback),
     click.option('--deep-clone', is_flag=True, default=False, expose_value=False,
                  help='Perform a deep clone of the git repos', callback=ctx_callback),
+    click.option('--blobless-clone', is_flag=True, default=False, envvar='BLOBLESS_CLONE',
+                 expose_value=False, callback=ctx_callback,
+                 help='Clone the git repos without file contents, fetching them as needed'),
+    click.option('--sparse-checkout', is_flag=True, default=False, envvar='SPARSE_CHECKOUT',
+                 expose_value=False, callback=ctx_callback,
+                 help='Only check out the files this command uses, if it says which'),
+    click.option('--object-reader', is_flag=True, default=False, envvar='OBJECT_READER',
+                 expose_value=False, callback=ctx_callback,
+                 help='Read metadata from git objects on the primary branch, not the working tree'),
+    click.option('--snapshot-dir', envvar='SNAPSHOT_DIR', expose_value=False,
+                 callback=ctx_callback, type=click.Path(file_okay=False),
+                 help='Where to keep the repos\' index snapshots so they outlive the clones, '
+                      'defaults to each repo\'s .git'),
     click.option('--ckanmeta-remotes', envvar='CKANMETA_REMOTES', expose_value=False,
                  help='game=Path/URL/SSH to Metadata Repos, ie ksp=http://github.com',
                  multiple=True, callback=ctx_callback),
@@ -47,6 +61,24 @@ _COMMON_OPTIONS = [
                  callback=ctx_callback),
     click.option('--timeout', default=300, envvar='SQS_TIMEOUT', expose_value=False,
                  help='Reduce message visibility timeout for testing', callback=ctx_callback),
+    click.option('--batch-size', default=10, envvar='SQS_BATCH_SIZE', expose_value=False,
+                 help='Most messages to process at once', callback=ctx_callback),
+    click.option('--batch-wait', default=0, envvar='SQS_BATCH_WAIT', expose_value=False,
+                 help='Seconds to keep receiving after the first message of a batch',
+                 callback=ctx_callback),
+    click.option('--prefetch', default=0, envvar='SQS_PREFETCH', expose_value=False,
+                 help='Batches to receive in the background while processing, 0 to disable',
+                 callback=ctx_callback),
+    click.option('--push-wait', default=0, envvar='PUSH_WAIT', expose_value=False,
+                 help='Seconds the Indexer holds back commits to push them together',
+                 callback=ctx_callback),
+    click.option('--push-commits', default=50, envvar='PUSH_COMMITS', expose_value=False,
+                 help='Push sooner once the Indexer holds this many commits',
+                 callback=ctx_callback),
+    click.option('--metrics-namespace', envvar='METRICS_NAMESPACE', expose_value=False,
+                 help='CloudWatch namespace to publish service metrics under, '
+                      'unset to not publish them',
+                 callback=ctx_callback),
     click.option('--dev', is_flag=True, default=False, expose_value=False,
                  help='Disable Production Checks', callback=ctx_callback),
     click.option('--ia-access', envvar='IA_access', expose_value=False,
@@ -76,6 +108,14 @@ class Game:
         'ksp':  'GameData',
         'ksp2': 'BepInEx/plugins',
     }
+    # Sparse checkout patterns per repo for the commands that set
+    # SharedArgs.sparse_profile
+    SPARSE_PROFILES: Dict[str, Dict[str, List[str]]] = {
+        # It reads the .ckans from git's objects
+        'download-counter': {
+            'CKAN-meta': ['/download_counts.json'],
+        },
+    }
 
     def __init__(self, name: str, shared: 'SharedArgs') -> None:
         self.name = name.lower()
@@ -99,16 +139,24 @@ class Game:
     def repo_base_path(self, path: str) -> str:
         return f'{self.clone_base}/{self.name}/{path}'
 
+    def init_repo(self, remote: str, path: str) -> Repo:
+        sparse_paths = (self.SPARSE_PROFILES.get(self.shared.sparse_profile, {}).get(path)
+                        if self.shared.sparse_checkout else None)
+        return init_repo(remote, self.repo_base_path(path), self.shared.deep_clone,
+                         self.shared.blobless_clone, sparse_paths)
+
+    @property
+    def snapshot_dir(self) -> Optional[Path]:
+        return Path(self.shared.snapshot_dir) if self.shared.snapshot_dir else None
+
     @property
     def ckanmeta_repo(self) -> CkanMetaRepo:
         if getattr(self, '_ckanmeta_repo', None) is None:
             self._ckanmeta_repo = CkanMetaRepo(
-                init_repo(
-                    self.ckanmeta_remote,
-                    self.repo_base_path('CKAN-meta'),
-                    self.shared.deep_clone
-                ),
-                game_id=self.name
+                self.init_repo(self.ckanmeta_remote, 'CKAN-meta'),
+                game_id=self.name,
+                object_reader=self.shared.object_reader,
+                snapshot_dir=self.snapshot_dir
             )
         return self._ckanmeta_repo
 
@@ -122,12 +170,10 @@ class Game:
     def netkan_repo(self) -> NetkanRepo:
         if getattr(self, '_netkan_repo', None) is None:
             self._netkan_repo = NetkanRepo(
-                init_repo(
-                    self.netkan_remote,
-                    self.repo_base_path('NetKAN'),
-                    self.shared.deep_clone
-                ),
-                game_id=self.name
+                self.init_repo(self.netkan_remote, 'NetKAN'),
+                game_id=self.name,
+                object_reader=self.shared.object_reader,
+                snapshot_dir=self.snapshot_dir
             )
         return self._netkan_repo
 
@@ -180,7 +226,18 @@ class SharedArgs:
     timeout: int
     token: str
     user: str
+    _batch_size: int
+    _batch_wait: int
+    _blobless_clone: bool
     _debug: bool
+    _metrics_namespace: str
+    _object_reader: bool
+    _prefetch: int
+    _push_commits: int
+    _push_wait: int
+    _sparse_checkout: bool
+    _sparse_profile: str
+    _snapshot_dir: str
     _ssh_key: str
     _game_ids: List[str]
 
@@ -213,6 +270,95 @@ class SharedArgs:
             # Catch uncaught exceptions and log them
             sys.excepthook = catch_all
 
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size or 10
+
+    @batch_size.setter
+    def batch_size(self, value: int) -> None:
+        self._batch_size = value
+
+    @property
+    def batch_wait(self) -> int:
+        return self._batch_wait or 0
+
+    @batch_wait.setter
+    def batch_wait(self, value: int) -> None:
+        self._batch_wait = value
+
+    @property
+    def prefetch(self) -> int:
+        return self._prefetch or 0
+
+    @prefetch.setter
+    def prefetch(self, value: int) -> None:
+        self._prefetch = value
+
+    @property
+    def push_commits(self) -> int:
+        return self._push_commits or 50
+
+    @push_commits.setter
+    def push_commits(self, value: int) -> None:
+        self._push_commits = value
+
+    @property
+    def push_wait(self) -> int:
+        return self._push_wait or 0
+
+    @push_wait.setter
+    def push_wait(self, value: int) -> None:
+        self._push_wait = value
+
+    @property
+    def blobless_clone(self) -> bool:
+        return self._blobless_clone or False
+
+    @blobless_clone.setter
+    def blobless_clone(self, value: bool) -> None:
+        self._blobless_clone = value
+
+    @property
+    def sparse_checkout(self) -> bool:
+        return self._sparse_checkout or False
+
+    @sparse_checkout.setter
+    def sparse_checkout(self, value: bool) -> None:
+        self._sparse_checkout = value
+
+    @property
+    def sparse_profile(self) -> str:
+        # Set by commands, names one of Game.SPARSE_PROFILES
+        return self._sparse_profile or ''
+
+    @sparse_profile.setter
+    def sparse_profile(self, value: str) -> None:
+        self._sparse_profile = value
+
+    @property
+    def snapshot_dir(self) -> str:
+        return self._snapshot_dir or ''
+
+    @snapshot_dir.setter
+    def snapshot_dir(self, value: str) -> None:
+        self._snapshot_dir = value
+
+    @property
+    def metrics_namespace(self) -> str:
+        return self._metrics_namespace or ''
+
+    @metrics_namespace.setter
+    def metrics_namespace(self, value: str) -> None:
+        self._metrics_namespace = value
+
+    @property
+    def object_reader(self) -> bool:
+        return self._object_reader or False
+
+    @object_reader.setter
+    def object_reader(self, value: bool) -> None:
+        self._object_reader = value
+
     @property
     def ssh_key(self) -> Optional[str]:
         return self._ssh_key
@@ -1,4 +1,6 @@
+import json
 import logging
+from typing import Optional
 
 import click
 
@@ -43,30 +45,80 @@ def indexer(common: SharedArgs) -> None:
     '--min-gh', default=1500,
     help='Only schedule if our GitHub API rate limit has this many remaining',
 )
+@click.option(
+    '--parse-workers', default=1, envvar='PARSE_WORKERS',
+    help='Number of processes to parse netkans with',
+)
+@click.option(
+    '--adaptive', is_flag=True, default=False, envvar='ADAPTIVE_SCHEDULE',
+    help='Check recently released mods often and quiet ones less often',
+)
+@click.option(
+    '--max-scheduled', default=0, envvar='MAX_SCHEDULED',
+    help='With --adaptive, most mods to schedule per run, 0 for no limit',
+)
+@click.option(
+    '--send-workers', default=1, envvar='SEND_WORKERS',
+    help='Number of message batches to send to the inflation queue at once, '
+         'ignored with --interleave as that order has to be kept',
+)
+@click.option(
+    '--interleave', is_flag=True, default=False, envvar='INTERLEAVE_HOSTS',
+    help='Spread each host\'s mods evenly through the run instead of alphabetically',
+)
+@click.option(
+    '--plan', type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Write the messages a run would send to this JSON file instead of sending them',
+)
 @common_options
 @pass_state
-def scheduler(
+def scheduler(  # pylint: disable=too-many-locals
     common: SharedArgs,
     group: str,
     max_queued: int,
     min_cpu: int,
     min_io: int,
-    min_gh: int
+    min_gh: int,
+    parse_workers: int,
+    adaptive: bool,
+    max_scheduled: int,
+    send_workers: int,
+    interleave: bool,
+    plan: Optional[str],
 ) -> None:
     """
     Reads netkans from a NetKAN repo and submits them to the
     Inflator's input queue
     """
+    plans = []
     for game_id in common.game_ids:
         game = common.game(game_id)
         sched = NetkanScheduler(
             common, game.inflation_queue, common.token, game.name,
             nonhooks_group=(group in ('all', 'nonhooks')),
             webhooks_group=(group in ('all', 'webhooks')),
+            parse_workers=parse_workers,
+            adaptive=adaptive,
+            max_scheduled=max_scheduled,
+            send_workers=send_workers,
+            interleave=interleave,
+            dry_run=plan is not None,
         )
-        if sched.can_schedule(max_queued, min_cpu, min_io, min_gh, common.dev):
+        if plan is not None:
+            game_plan = sched.plan()
+            stages = game_plan['stages']
+            logging.info('Planned %s netkans for %s: %s; peak memory %s MiB',
+                         len(game_plan['netkans']), game.name,
+                         ', '.join(f"{name} {timing['seconds']}s"
+                                   for name, timing in stages.items()),
+                         max(timing['peak_rss_kb'] for timing in stages.values()) // 1024)
+            plans.append(game_plan)
+        elif sched.can_schedule(max_queued, min_cpu, min_io, min_gh, common.dev):
             sched.schedule_all_netkans()
             logging.info("NetKANs submitted to %s", game.inflation_queue)
+    if plan is not None:
+        with open(plan, 'w', encoding='UTF-8') as plan_file:
+            json.dump(plans, plan_file, indent=4)
 
 
 @click.command(short_help='The Mirrorer service')
@@ -82,7 +134,8 @@ def mirrorer(common: SharedArgs) -> None:
     Mirrorer(
         common.game('ksp').ckanmeta_repo, common.ia_access, common.ia_secret,
         common.game('ksp').ia_collection, common.token
-    ).process_queue(common.queue, common.timeout)
+    ).process_queue(common.queue, common.timeout, common.batch_size, common.batch_wait,
+                    common.metrics_namespace)
 
 
 @click.command(short_help='The SpaceDockAdder service')
@@ -1,14 +1,18 @@
 import datetime
 import json
 import logging
+import os
+import resource
+import tempfile
 import time
 import io
 
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
 
 import boto3
 import click
+from git import Repo
 from ruamel.yaml import YAML
 
 from .common import common_options, pass_state, SharedArgs
@@ -20,6 +24,8 @@ from ..auto_freezer import AutoFreezer
 from ..mirrorer import Mirrorer
 from ..mod_analyzer import ModAnalyzer
 from ..metadata import Netkan
+from ..repos import NetkanRepo
+from ..common import sqs_send_messages
 
 
 @click.command(short_help='Submit or update a PR freezing idle mods')
@@ -49,18 +55,43 @@ def auto_freezer(common: SharedArgs, days_limit: int, days_till_ignore: int) ->
 
 
 @click.command(short_help='Update download counts in a given repo')
+@click.option(
+    '--github-workers', default=1, envvar='GITHUB_WORKERS',
+    help='Number of GitHub GraphQL queries to have in flight at once',
+)
+@click.option(
+    '--min-gh', default=1500,
+    help='Stop querying GitHub with this much of the rate limit left for the inflator',
+)
+@click.option(
+    '--refresh-days', default=0, envvar='REFRESH_DAYS',
+    help='Reuse counts that haven\'t changed lately, fetching each at least this often, '
+         'so a count can be up to this many days behind; 0 (the default) fetches them all',
+)
+@click.option(
+    '--store-dir', envvar='DOWNLOAD_COUNTS_DIR', type=click.Path(file_okay=False),
+    help='Where to keep what each run learns for the next, such as GitHub query costs '
+         'and each mod\'s count history, defaults to the metadata repo\'s .git',
+)
 @common_options
 @pass_state
-def download_counter(common: SharedArgs) -> None:
+def download_counter(common: SharedArgs, github_workers: int, min_gh: int,
+                     refresh_days: int, store_dir: Optional[str]) -> None:
     """
     Count downloads for all the mods in the given repo
     and update the download_counts.json file
     """
+    common.sparse_profile = 'download-counter'
+    if common.sparse_checkout:
+        # Only the counts file is checked out
+        common.object_reader = True
     for game_id in common.game_ids:
         logging.info('Starting Download Count Calculation (%s)...', game_id)
         DownloadCounter(game_id,
                         common.game(game_id).ckanmeta_repo,
-                        common.token).update_counts()
+                        common.token, github_workers, min_gh,
+                        refresh_days,
+                        Path(store_dir) if store_dir else None).update_counts()
         logging.info('Download Counter completed! (%s)', game_id)
 
 
@@ -93,7 +124,7 @@ def inflate_netkan(common: SharedArgs, ident: str) -> None:
     nk = Netkan(game.netkan_repo.nk_path(ident), game_id=common.game_id)
     message = nk.sqs_message(game.ckanmeta_repo.highest_version(ident))
     queue = boto3.resource('sqs').get_queue_by_name(QueueName=game.inflation_queue)
-    boto3.client('sqs').send_message_batch(QueueUrl=queue.url, Entries=[message])
+    sqs_send_messages(boto3.client('sqs'), queue.url, [message])
 
 
 @click.command(short_help='Update the JSON status file on s3')
@@ -249,6 +280,71 @@ def clean_cache(days: int, cache: str) -> None:
             item.unlink()
 
 
+BENCHMARK_NETKAN = '''spec_version: v1.18
+identifier: BenchMod{index}
+$kref: '#/ckan/github/BenchAuthor/BenchMod{index}'
+$vref: '#/ckan/ksp-avc'
+license: MIT
+tags:
+  - plugin
+  - parts
+depends:
+  - name: ModuleManager
+  - name: BenchLib{index}
+recommends:
+  - name: BenchExtras
+    min_version: '1.2'
+install:
+  - find: BenchMod{index}
+    install_to: GameData
+    filter:
+      - '*.pdb'
+      - Thumbs.db
+resources:
+  homepage: https://forum.kerbalspaceprogram.com/topic/{index}-benchmod
+  bugtracker: https://github.com/BenchAuthor/BenchMod{index}/issues
+x_netkan_override:
+  - version: 1.0.{index}
+    override:
+      ksp_version_min: '1.8'
+'''
+
+
+@click.command(short_help='Compare serial and parallel netkan parsing times')
+@click.option(
+    '--count', default=3000,
+    help='Number of synthetic netkans to parse',
+)
+@click.option(
+    '--workers', default=os.cpu_count() or 1,
+    help='Number of processes for the parallel run',
+)
+def benchmark_parsing(count: int, workers: int) -> None:
+    """
+    Parse a synthetic NetKAN repo serially and with a process pool,
+    and report the wall and CPU time of each
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        nk_repo = NetkanRepo(Repo.init(tmpdir))
+        nk_repo.nk_dir.mkdir()
+        for index in range(count):
+            nk_repo.nk_path(f'BenchMod{index}').write_text(
+                BENCHMARK_NETKAN.format(index=index), encoding='UTF-8')
+        for run_workers in (1, workers):
+            NetkanRepo.parse_cache.clear()
+            before = (resource.getrusage(resource.RUSAGE_SELF),
+                      resource.getrusage(resource.RUSAGE_CHILDREN))
+            start = time.perf_counter()
+            parsed = len(list(nk_repo.netkans(workers=run_workers)))
+            wall = time.perf_counter() - start
+            after = (resource.getrusage(resource.RUSAGE_SELF),
+                     resource.getrusage(resource.RUSAGE_CHILDREN))
+            cpu = sum(a.ru_utime + a.ru_stime - (b.ru_utime + b.ru_stime)
+                      for a, b in zip(after, before))
+            click.echo(f'{run_workers} worker(s): parsed {parsed} netkans '
+                       f'in {wall:.2f}s wall, {cpu:.2f}s CPU')
+
+
 @click.command(short_help='Remove epoch strings from archive.org entries')
 @click.option(
     '--dry-run', default=False,
@@ -1,20 +1,28 @@
 
-from typing import List, Iterable, IO, TYPE_CHECKING, Union
+import logging
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Iterable, IO, Set, TYPE_CHECKING, Union
 
+import boto3
 import requests
 import github
+from botocore.exceptions import BotoCoreError, ClientError
 from git import Repo
 
 from .metadata import Netkan
 from .repos import NetkanRepo, CkanMetaRepo
 
 if TYPE_CHECKING:
+    from mypy_boto3_sqs.client import SQSClient
     from mypy_boto3_sqs.service_resource import Message
     from mypy_boto3_sqs.type_defs import (
         DeleteMessageBatchRequestEntryTypeDef,
         SendMessageBatchRequestEntryTypeDef,
     )
 else:
+    SQSClient = object
     Message = object
     DeleteMessageBatchRequestEntryTypeDef = object
     SendMessageBatchRequestEntryTypeDef = object
@@ -24,27 +32,142 @@ USER_AGENT = 'Mozilla/5.0 (compatible; Netkanbot/1.0; CKAN; +https://github.com/
 
 
 def netkans(path: str, ids: Iterable[str], game_id: str) -> Iterable[Netkan]:
-    repo = NetkanRepo(Repo(path))
-    return (Netkan(p, game_id=game_id) for p in repo.nk_paths(ids))
+    repo = NetkanRepo(Repo(path), game_id=game_id)
+    return (repo.netkan(p) for p in repo.nk_paths(ids))
+
+
+# SQS limits for one send_message_batch call
+SQS_BATCH_ENTRIES = 10
+SQS_BATCH_BYTES = 256 * 1024
+
+
+def sqs_message_size(message: SendMessageBatchRequestEntryTypeDef) -> int:
+    """Bytes a message counts for against SQS's size limit
+
+    That's the body, plus the name, type and value of each attribute.
+    """
+    size = len(message['MessageBody'].encode('UTF-8'))
+    for name, attr in message.get('MessageAttributes', {}).items():
+        size += len(name.encode('UTF-8')) + len(attr['DataType'].encode('UTF-8'))
+        binary = attr.get('BinaryValue')
+        size += (len(binary) if isinstance(binary, bytes)
+                 else len(attr.get('StringValue', '').encode('UTF-8')))
+    return size
 
 
 def sqs_batch_entries(messages: Iterable[SendMessageBatchRequestEntryTypeDef],
-                      batch_size: int = 10) -> Iterable[List[SendMessageBatchRequestEntryTypeDef]]:
+                      batch_size: int = SQS_BATCH_ENTRIES,
+                      max_bytes: int = SQS_BATCH_BYTES) -> Iterable[List[SendMessageBatchRequestEntryTypeDef]]:
+    """Pack messages into batches within SQS's entry and size limits"""
     batch: List[SendMessageBatchRequestEntryTypeDef] = []
+    batch_bytes = 0
     for msg in messages:
+        size = sqs_message_size(msg)
+        if batch and batch_bytes + size > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
         batch.append(msg)
+        batch_bytes += size
         if len(batch) == batch_size:
             yield batch
             batch = []
+            batch_bytes = 0
     if len(batch) > 0:
         yield batch
 
 
+def sqs_send_batch(client: SQSClient, queue_url: str,
+                   batch: List[SendMessageBatchRequestEntryTypeDef],
+                   retries: int = 3, backoff: float = 1.0) -> 'Counter[str]':
+    """Send one batch, retrying just the entries that failed
+
+    Entries SQS says failed through no fault of ours (throttling,
+    internal errors) are sent again after backoff seconds, doubling each
+    time. Entries it rejects as our fault won't get better, so they're
+    logged and counted as failed. Returns counts of sent, retried and
+    failed entries.
+    """
+    counts: Counter[str] = Counter()
+    entries = batch
+    for attempt in range(retries + 1):
+        response = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed = response.get('Failed', [])
+        counts['sent'] += len(entries) - len(failed)
+        retry_ids = set()
+        for failure in failed:
+            if failure.get('SenderFault'):
+                logging.error('SQS rejected message %s: %s', failure['Id'], failure.get('Message'))
+                counts['failed'] += 1
+            else:
+                retry_ids.add(failure['Id'])
+        if not retry_ids:
+            break
+        entries = [entry for entry in entries if entry['Id'] in retry_ids]
+        if attempt == retries:
+            logging.error('Giving up on %s messages to %s', len(entries), queue_url)
+            counts['failed'] += len(entries)
+            break
+        counts['retried'] += len(entries)
+        time.sleep(backoff * 2 ** attempt)
+    return counts
+
+
+def sqs_send_messages(client: SQSClient, queue_url: str,
+                      messages: Iterable[SendMessageBatchRequestEntryTypeDef],
+                      workers: int = 1) -> 'Counter[str]':
+    """Send messages in batches, returning sent, retried and failed counts
+
+    With more than one worker, up to that many batches are in flight at
+    once. Entries within a batch keep their order, but batches can reach
+    the queue in any order, so only use workers for messages whose order
+    relative to each other doesn't matter.
+    """
+    counts: Counter[str] = Counter()
+    if workers <= 1:
+        for batch in sqs_batch_entries(messages):
+            counts.update(sqs_send_batch(client, queue_url, batch))
+        return counts
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: Set[Future['Counter[str]']] = set()
+        for batch in sqs_batch_entries(messages):
+            # Don't run ahead of the senders building batches we can't send yet
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    counts.update(future.result())
+            pending.add(executor.submit(sqs_send_batch, client, queue_url, batch))
+        for future in wait(pending).done:
+            counts.update(future.result())
+    return counts
+
+
 def pull_all(repos: Iterable[Union[NetkanRepo, CkanMetaRepo]]) -> None:
     for repo in repos:
         repo.pull_remote_primary(strategy_option='theirs')
 
 
+def put_metrics(namespace: str, metrics: Dict[str, float], **dimensions: str) -> None:
+    """Publish values to CloudWatch, or nothing without a namespace
+
+    Failures are only logged, a missed data point isn't worth
+    stopping a service over.
+    """
+    if not namespace:
+        return
+    try:
+        boto3.client('cloudwatch').put_metric_data(
+            Namespace=namespace,
+            MetricData=[{
+                'MetricName': name,
+                'Dimensions': [{'Name': key, 'Value': value}
+                               for key, value in dimensions.items()],
+                'Value': value,
+            } for name, value in metrics.items()])
+    except (BotoCoreError, ClientError) as exc:
+        logging.warning('Failed to publish metrics to %s: %s', namespace, exc)
+
+
 def github_limit_remaining(token: str) -> int:
     return github.Github(token, user_agent=USER_AGENT).get_rate_limit().resources.core.remaining
 
@@ -0,0 +1,135 @@
+import os
+import re
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+
+class DownloadCacheIndex:
+
+    """
+    Finds cached downloads by their cache prefix without walking the cache
+
+    The cache is scanned once, then each lookup only stats the directories
+    we know about and rescans the ones whose mtime moved. A rescan is a
+    single scandir; files we've already seen aren't stat'd again.
+    """
+
+    PREFIX_LENGTH = 8
+    # Cached downloads are named '<prefix>-<identifier>-<version>.<extension>',
+    # anything else (hash sidecars, partial or temp files) isn't one
+    NAME_PATTERN = re.compile(r'^([0-9A-F]{8})-.+\.(zip|tar|gz)$')
+    # Where CKAN keeps downloads that are still in progress
+    SKIP_DIRS = {'downloading'}
+
+    _indexes: Dict[Path, 'DownloadCacheIndex'] = {}
+    _indexes_lock = Lock()
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.scans = 0
+        self._lock = Lock()
+        # directory -> mtime_ns when we last scanned it
+        self._dirs: Dict[Path, int] = {}
+        # directory -> path -> (size, mtime_ns)
+        self._dir_files: Dict[Path, Dict[Path, Tuple[int, int]]] = {}
+        # prefix -> paths
+        self._prefixes: Dict[str, List[Path]] = {}
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__}({self.root})>'
+
+    @classmethod
+    def for_path(cls, root: Path) -> 'DownloadCacheIndex':
+        with cls._indexes_lock:
+            index = cls._indexes.get(root)
+            if index is None:
+                index = cls(root)
+                cls._indexes[root] = index
+            return index
+
+    @classmethod
+    def prefix(cls, name: str) -> Optional[str]:
+        match = cls.NAME_PATTERN.match(name)
+        return match.group(1) if match else None
+
+    def find(self, prefix: str) -> Optional[Path]:
+        entry = self.find_entry(prefix)
+        return entry[0] if entry else None
+
+    def find_entry(self, prefix: str) -> Optional[Tuple[Path, int, int]]:
+        """Newest cached download for this prefix, as (path, size, mtime_ns)"""
+        with self._lock:
+            self._refresh()
+            found = [(path, *self._dir_files[path.parent][path])
+                     for path in self._prefixes.get(prefix, [])]
+        found.sort(key=lambda entry: entry[2], reverse=True)
+        for entry in found:
+            if entry[0].exists():
+                return entry
+        return None
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        if not self._dirs:
+            self._scan_dir(self.root)
+            return
+        for directory, mtime in list(self._dirs.items()):
+            if directory not in self._dirs:
+                continue
+            try:
+                current = directory.stat().st_mtime_ns
+            except OSError:
+                self._forget_dir(directory)
+                continue
+            if current != mtime:
+                self._scan_dir(directory)
+
+    def _scan_dir(self, directory: Path) -> None:
+        self.scans += 1
+        known = self._dir_files.get(directory, {})
+        try:
+            mtime = directory.stat().st_mtime_ns
+            entries = os.scandir(directory)
+        except OSError:
+            self._forget_dir(directory)
+            return
+        files: Dict[Path, Tuple[int, int]] = {}
+        subdirs = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.SKIP_DIRS:
+                        subdirs.append(Path(entry.path))
+                elif self.prefix(entry.name) and entry.is_file():
+                    path = Path(entry.path)
+                    if path in known:
+                        files[path] = known[path]
+                    else:
+                        stat = entry.stat()
+                        files[path] = (stat.st_size, stat.st_mtime_ns)
+        for path in known.keys() - files.keys():
+            self._drop_file(path)
+        for path in files.keys() - known.keys():
+            self._prefixes.setdefault(path.name[:self.PREFIX_LENGTH], []).append(path)
+        self._dirs[directory] = mtime
+        self._dir_files[directory] = files
+        for subdir in subdirs:
+            if subdir not in self._dirs:
+                self._scan_dir(subdir)
+
+    def _forget_dir(self, directory: Path) -> None:
+        self._dirs.pop(directory, None)
+        for path in self._dir_files.pop(directory, {}):
+            self._drop_file(path)
+
+    def _drop_file(self, path: Path) -> None:
+        prefix = path.name[:self.PREFIX_LENGTH]
+        paths = self._prefixes.get(prefix)
+        if paths and path in paths:
+            paths.remove(path)
+            if not paths:
+                del self._prefixes[prefix]
@@ -1,10 +1,15 @@
 import json
 import logging
 import re
+import sqlite3
+import zlib
+from collections import deque
+from contextlib import closing
 from pathlib import Path
 from string import Template
 import urllib.parse
-from typing import Dict, Tuple, Any, Optional, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Tuple, Any, Optional, Iterable, List, Sequence, Set
 import heapq
 from datetime import date, datetime, timezone, timedelta
 from time import sleep
@@ -12,13 +17,189 @@ from itertools import groupby, batched
 from more_itertools import ilen
 
 import requests
-from requests.exceptions import ConnectTimeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ReadTimeout
 
 from .utils import repo_file_add_or_changed, legacy_read_text
 from .repos import CkanMetaRepo
 from .metadata import Ckan
 
 
+# A (user, repo) to query and the identifier it's queried under
+GitHubRequest = Tuple[Tuple[str, str], str]
+# A count we fetched before, with when and the release it had reached
+CachedCount = Tuple[int, datetime, Optional[str]]
+
+
+def request_json(method: str, url: str, timeout: Tuple[float, float],
+                 retries: int = 2, **kwargs: Any) -> Any:
+    """Request url and parse its JSON, trying again after 1, 2, 4... seconds if it fails"""
+    for attempt in range(retries + 1):
+        try:
+            response = requests.request(method, url, timeout=timeout, **kwargs)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as exc:
+            if attempt == retries:
+                raise
+            logging.warning('Request to %s failed, retrying: %s', url, exc)
+            sleep(2 ** attempt)
+    return None
+
+
+class DownloadCountStore:
+
+    """
+    What the download counter learned on earlier runs, saved in an
+    SQLite file that has to outlive the metadata repo's clone
+
+    That's each source key's last fetched count, how much each GitHub
+    repo costs to query, and each mod's count over time. Failures are
+    logged and treated as there being nothing saved.
+    """
+
+    FILENAME = 'netkan-download-counts.sqlite'
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE IF NOT EXISTS github_costs'
+                     ' (user TEXT NOT NULL, repo TEXT NOT NULL, cost INTEGER NOT NULL,'
+                     ' PRIMARY KEY (user, repo))')
+        conn.execute('CREATE TABLE IF NOT EXISTS source_counts'
+                     ' (source TEXT NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL,'
+                     ' fetched TEXT NOT NULL, fingerprint TEXT, PRIMARY KEY (source, key))')
+        # Days are date ordinals, with a row for each day a mod's count was
+        # fetched; its count on the days in between is interpolated
+        conn.execute('CREATE TABLE IF NOT EXISTS daily_counts'
+                     ' (identifier TEXT NOT NULL, day INTEGER NOT NULL, count INTEGER NOT NULL,'
+                     ' PRIMARY KEY (identifier, day)) WITHOUT ROWID')
+        return conn
+
+    def record_day(self, day: date, counts: Dict[str, int]) -> None:
+        """Add the counts fetched on a day"""
+        try:
+            with closing(self._connect()) as conn:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO daily_counts VALUES (?, ?, ?)',
+                                     ((ident, day.toordinal(), count)
+                                      for ident, count in counts.items()))
+        except sqlite3.Error as exc:
+            logging.warning('Failed to save daily counts to %s: %s', self.path, exc)
+
+    def counts_on(self, day: date) -> Dict[str, int]:
+        """
+        Each mod's count as of a day
+
+        That's its latest fetched count, or if it's been fetched again
+        since, the share of the downloads in between that fall on or
+        before the day.
+        """
+        if not self.path.exists():
+            return {}
+        ordinal = day.toordinal()
+        try:
+            with closing(self._connect()) as conn:
+                return {ident: (count if next_day is None
+                                else count + (next_count - count) * (ordinal - prev_day)
+                                // (next_day - prev_day))
+                        for ident, prev_day, count, next_day, next_count in conn.execute(
+                            'SELECT d.identifier, d.day, d.count, n.day, n.count'
+                            ' FROM daily_counts AS d LEFT JOIN daily_counts AS n'
+                            ' ON n.identifier = d.identifier'
+                            ' AND n.day = (SELECT MIN(day) FROM daily_counts'
+                            '              WHERE identifier = d.identifier AND day > ?)'
+                            ' WHERE d.day = (SELECT MAX(day) FROM daily_counts'
+                            '                WHERE identifier = d.identifier AND day <= ?)',
+                            (ordinal, ordinal))}
+        except sqlite3.Error as exc:
+            logging.warning('Failed to load daily counts from %s: %s', self.path, exc)
+            return {}
+
+    def deltas(self, start: date, end: date) -> Dict[str, int]:
+        """How many downloads each mod got after start, up to end
+
+        Mods we have no count for as of start are left out, so new
+        mods don't crowd out the rest with their all-time counts.
+        """
+        before = self.counts_on(start)
+        return {ident: count - before[ident]
+                for ident, count in self.counts_on(end).items()
+                if ident in before}
+
+    def top(self, how_many: int, start: date, end: date) -> List[Tuple[str, int]]:
+        """The mods with the most downloads after start, up to end"""
+        deltas = self.deltas(start, end)
+        return [(ident, deltas[ident])
+                for ident in heapq.nlargest(how_many, deltas, key=deltas.__getitem__)]
+
+    def trend(self, identifier: str, start: date, end: date) -> List[Tuple[date, int]]:
+        """A mod's count as of its last fetch by start, then each one up to end"""
+        if not self.path.exists():
+            return []
+        try:
+            with closing(self._connect()) as conn:
+                return [(date.fromordinal(day), count) for day, count in conn.execute(
+                    'SELECT day, count FROM daily_counts WHERE identifier = ? AND day <= ?'
+                    ' AND day >= COALESCE((SELECT MAX(day) FROM daily_counts'
+                    '                      WHERE identifier = ? AND day <= ?), ?)'
+                    ' ORDER BY day',
+                    (identifier, end.toordinal(), identifier, start.toordinal(),
+                     start.toordinal()))]
+        except sqlite3.Error as exc:
+            logging.warning('Failed to load daily counts from %s: %s', self.path, exc)
+            return []
+
+    def counts(self, source: str) -> Dict[str, CachedCount]:
+        """The last count we fetched for each of a source's keys"""
+        if not self.path.exists():
+            return {}
+        try:
+            with closing(self._connect()) as conn:
+                return {key: (count, datetime.fromisoformat(fetched), fingerprint)
+                        for key, count, fetched, fingerprint in conn.execute(
+                            'SELECT key, count, fetched, fingerprint FROM source_counts'
+                            ' WHERE source = ?', (source,))}
+        except (sqlite3.Error, ValueError) as exc:
+            logging.warning('Failed to load %s counts from %s: %s', source, self.path, exc)
+            return {}
+
+    def save_counts(self, source: str, counts: Dict[str, Tuple[int, Optional[str]]],
+                    fetched: datetime) -> None:
+        try:
+            with closing(self._connect()) as conn:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO source_counts VALUES (?, ?, ?, ?, ?)',
+                                     ((source, key, count, fetched.isoformat(), fingerprint)
+                                      for key, (count, fingerprint) in counts.items()))
+        except sqlite3.Error as exc:
+            logging.warning('Failed to save %s counts to %s: %s', source, self.path, exc)
+
+    def github_costs(self) -> Dict[Tuple[str, str], int]:
+        """How many nodes each GitHub repo's downloads query returned last time"""
+        if not self.path.exists():
+            return {}
+        try:
+            with closing(self._connect()) as conn:
+                return {(user, repo): cost for user, repo, cost
+                        in conn.execute('SELECT user, repo, cost FROM github_costs')}
+        except sqlite3.Error as exc:
+            logging.warning('Failed to load GitHub query costs from %s: %s', self.path, exc)
+            return {}
+
+    def save_github_costs(self, costs: Dict[Tuple[str, str], int]) -> None:
+        try:
+            with closing(self._connect()) as conn:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO github_costs VALUES (?, ?, ?)',
+                                     ((user, repo, cost) for (user, repo), cost in costs.items()))
+        except sqlite3.Error as exc:
+            logging.warning('Failed to save GitHub query costs to %s: %s', self.path, exc)
+
+
 class GitHubBatchedQuery:
 
     PATH_PATTERN = re.compile(r'^/([^/]+)/([^/]+)')
@@ -26,8 +207,15 @@ class GitHubBatchedQuery:
     # The URL that handles GitHub GraphQL requests
     GITHUB_API = 'https://api.github.com/graphql'
 
-    # Get this many modules per request
-    MODULES_PER_GRAPHQL = 10
+    # We estimate a module's cost as the nodes its response had last time,
+    # and fill each request with modules up to this
+    TARGET_COST = 3000
+    # What we assume a module costs before we've seen a response for it
+    DEFAULT_COST = 300
+    # Never put more modules than this in one request
+    MAX_MODULES_PER_GRAPHQL = 50
+    # Errors that mean a request asked for too much at once
+    SPLIT_ERRORS = {'RESOURCE_LIMITS_EXCEEDED', 'TIMEOUT'}
 
     # The request we send to GitHub, with a parameter for the module specific section
     GRAPHQL_TEMPLATE = Template(legacy_read_text('netkan', 'downloads_query.graphql'))
@@ -37,21 +225,42 @@ class GitHubBatchedQuery:
     MODULE_TEMPLATE = Template(
         '${ident}: repository(owner: "${user}", name: "${repo}") { ...getDownloads }')
 
-    def __init__(self, github_token: str) -> None:
+    # A cheap query for each repo's latest release, to tell whether it's changed
+    FINGERPRINT_TEMPLATE = Template(
+        'query {\n    rateLimit { cost remaining resetAt }\n$module_queries\n}')
+    FINGERPRINT_MODULE_TEMPLATE = Template(
+        '${ident}: repository(owner: "${user}", name: "${repo}") { releases(last: 1) { nodes { id } } }')
+    FINGERPRINTS_PER_GRAPHQL = 100
+
+    # Wait this long at most for the rate limit to reset once we've used our share
+    MAX_RESET_WAIT = timedelta(minutes=10)
+
+    def __init__(self, github_token: str, workers: int = 1, min_remaining: int = 0,
+                 api_url: str = GITHUB_API,
+                 costs: Optional[Dict[Tuple[str, str], int]] = None) -> None:
         self.repos: Dict[str, Tuple[str, str]] = {}
         self.requests: Dict[Tuple[str, str], str] = {}
         self.cache: Dict[Tuple[str, str], int] = {}
+        # Estimated cost per repo, updated from each response
+        self.costs: Dict[Tuple[str, str], int] = dict(costs or {})
+        # Latest release of each repo we fetched counts for
+        self.fingerprints: Dict[Tuple[str, str], str] = {}
         self.github_token = github_token
+        self.workers = workers
+        # Leave this much of the rate limit for everything else using the token
+        self.min_remaining = min_remaining
+        self.api_url = api_url
+        self.session = requests.Session()
+        self.session.mount(api_url, HTTPAdapter(pool_maxsize=workers))
+        self.session.headers['Authorization'] = f'bearer {github_token}'
+        # The latest rateLimit GitHub sent us, with cost, remaining and resetAt
+        self.rate_limit: Optional[Dict[str, Any]] = None
         logging.info('Starting new GraphQL query')
 
     def empty(self) -> bool:
         # We might need to return values that are already cached
         return len(self.repos) == 0
 
-    def full(self) -> bool:
-        # We only need to do requests for uncached mods
-        return len(self.requests) >= self.MODULES_PER_GRAPHQL
-
     def add(self, identifier: str, user: str, repo: str) -> None:
         user_repo = (user, repo)
         self.repos[identifier] = user_repo
@@ -67,11 +276,79 @@ class GitHubBatchedQuery:
         self.requests.pop(user_repo, None)
         # Keep self.cache for shared $krefs
 
+    def skip_unchanged(self, previous: Dict[Tuple[str, str], Tuple[int, Optional[str]]]) -> None:
+        """
+        Reuse earlier counts for repos whose latest release hasn't changed
+
+        previous has the count and latest release we saw for some of the
+        repos. Each repo's latest release is fetched in cheap batches,
+        and those that still match get their earlier count instead of a
+        full query.
+        """
+        checks = [(user_repo, identifier) for user_repo, identifier in self.requests.items()
+                  if user_repo in previous]
+        batches = list(batched(checks, self.FINGERPRINTS_PER_GRAPHQL))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._fingerprint_batch, batches))
+        unchanged = sum(self._skip_matching(batch, result, previous)
+                        for batch, result in zip(batches, results))
+        logging.info('%s of %s GitHub repos checked have no new releases',
+                     unchanged, len(checks))
+
+    def _skip_matching(self, batch: Sequence[GitHubRequest], result: Optional[Dict[str, Any]],
+                       previous: Dict[Tuple[str, str], Tuple[int, Optional[str]]]) -> int:
+        data = dict(result.get('data') or {}) if result else {}
+        rate_limit = data.pop('rateLimit', None)
+        if rate_limit:
+            self._update_rate_limit(rate_limit)
+        skipped = 0
+        for user_repo, identifier in batch:
+            apidata = data.get(self.graphql_safe_identifier(identifier))
+            count, fingerprint = previous[user_repo]
+            if apidata and self.release_fingerprint(apidata) == fingerprint:
+                self.cache[user_repo] = count
+                self.requests.pop(user_repo, None)
+                skipped += 1
+        return skipped
+
+    def _fingerprint_batch(self, reqs: Sequence[GitHubRequest]) -> Optional[Dict[str, Any]]:
+        try:
+            return self.graphql_to_github(self.FINGERPRINT_TEMPLATE.safe_substitute(
+                module_queries='\n'.join(
+                    self.FINGERPRINT_MODULE_TEMPLATE.safe_substitute(
+                        ident=self.graphql_safe_identifier(identifier), user=user, repo=repo)
+                    for (user, repo), identifier in reqs)))
+        except requests.RequestException as exc:
+            logging.error('DownloadCounter GraphQL request failed', exc_info=exc)
+            return None
+
+    @staticmethod
+    def release_fingerprint(apidata: Dict[str, Any]) -> str:
+        nodes = apidata['releases']['nodes']
+        return nodes[-1]['id'] if nodes else ''
+
+    def get_batches(self) -> List[List[GitHubRequest]]:
+        """Pack the pending requests into batches of about TARGET_COST each"""
+        batches: List[List[GitHubRequest]] = []
+        batch: List[GitHubRequest] = []
+        batch_cost = 0
+        for user_repo, identifier in self.requests.items():
+            cost = self.costs.get(user_repo, self.DEFAULT_COST)
+            if batch and (batch_cost + cost > self.TARGET_COST
+                          or len(batch) >= self.MAX_MODULES_PER_GRAPHQL):
+                batches.append(batch)
+                batch = []
+                batch_cost = 0
+            batch.append((user_repo, identifier))
+            batch_cost += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
     def get_queries(self) -> Iterable[str]:
-        return map(self.get_query, batched(self.requests.items(),
-                                           self.MODULES_PER_GRAPHQL))
+        return map(self.get_query, self.get_batches())
 
-    def get_query(self, reqs: Tuple[Tuple[Tuple[str, str], str], ...]) -> str:
+    def get_query(self, reqs: Sequence[GitHubRequest]) -> str:
         return self.GRAPHQL_TEMPLATE.safe_substitute(module_queries='\n'.join(
             self.get_module_query(identifier, user, repo)
             for (user, repo), identifier in reqs))
@@ -101,31 +378,34 @@ class GitHubBatchedQuery:
         return fake_ident[1:].replace("_", "-")
 
     def get_result(self, counts: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """
+        Run the queries for every module added so far and add their counts
+
+        Up to workers queries are in flight at once. Each response says
+        what's left of our rate limit, and we stop sending once the next
+        queries would dip into the min_remaining we're leaving for the
+        inflator, unless it resets soon enough to wait for. Batches that
+        turn out to be too big are split in two and sent again.
+        """
         if counts is None:
             counts = {}
         logging.info('Running GraphQL query')
-        for full_query in list(self.get_queries()):
-            result = self.graphql_to_github(full_query)
-            if not result:
-                continue
-            if 'errors' in result:
-                logging.error('DownloadCounter errors in GraphQL query: %s',
-                              ', '.join(f'{msg} (x{ilen(grp)})'
-                                        for msg, grp
-                                        in groupby(sorted(err['message']
-                                                          for err in result['errors'])))
-                              if result['errors'] else 'Empty errors list')
-            if 'data' in result:
-                for fake_ident, apidata in result['data'].items():
-                    if apidata:
-                        real_ident = self.from_graphql_safe_identifier(fake_ident)
-                        try:
-                            count = self.sum_graphql_result(apidata)
-                            user_repo = self.repos[real_ident]
-                            # Cache results per repo, for shared $krefs
-                            self.cache[user_repo] = count
-                        except Exception:  # pylint: disable=broad-except
-                            pass
+        batches = deque(self.get_batches())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending: Set[Future[Tuple[List[GitHubRequest], Optional[Dict[str, Any]]]]] = set()
+            while batches or pending:
+                if (batches and len(pending) < self.workers
+                        and self._budget_allows(len(pending))):
+                    pending.add(executor.submit(self._run_batch, batches.popleft()))
+                elif pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # Split batches go next, in order
+                        batches.extendleft(reversed(self._add_result(*future.result())))
+                else:
+                    logging.error('GitHub rate limit down to %s, skipping %s queries',
+                                  self.rate_limit_remaining, len(batches))
+                    break
         # Retrieve everything from the cache, new and old alike
         for ident, user_repo in list(self.repos.items()):
             if user_repo in self.cache:
@@ -136,18 +416,96 @@ class GitHubBatchedQuery:
                 self.remove(ident, user_repo)
         return counts
 
+    @property
+    def rate_limit_remaining(self) -> Optional[int]:
+        return self.rate_limit['remaining'] if self.rate_limit else None
+
+    def _budget_allows(self, in_flight: int) -> bool:
+        if self.rate_limit is None:
+            return True
+        cost = max(self.rate_limit.get('cost', 1), 1)
+        if self.rate_limit['remaining'] - (in_flight + 1) * cost >= self.min_remaining:
+            return True
+        if in_flight == 0:
+            wait_for = (datetime.fromisoformat(self.rate_limit['resetAt'])
+                        - datetime.now(timezone.utc))
+            if wait_for <= self.MAX_RESET_WAIT:
+                logging.info('GitHub rate limit resets in %s, waiting', wait_for)
+                sleep(max(wait_for.total_seconds(), 0))
+                self.rate_limit = None
+                return True
+        return False
+
+    def _run_batch(self, batch: List[GitHubRequest]
+                   ) -> Tuple[List[GitHubRequest], Optional[Dict[str, Any]]]:
+        try:
+            return batch, self.graphql_to_github(self.get_query(batch))
+        except ReadTimeout:
+            return batch, {'errors': [{'type': 'TIMEOUT', 'message': 'Request timed out'}]}
+        except requests.RequestException as exc:
+            logging.error('DownloadCounter GraphQL request failed', exc_info=exc)
+            return batch, None
+
+    def _add_result(self, batch: List[GitHubRequest],
+                    result: Optional[Dict[str, Any]]) -> List[List[GitHubRequest]]:
+        """Take in a batch's response, returning it split in two if it was too big"""
+        if not result:
+            return []
+        data = dict(result.get('data') or {})
+        rate_limit = data.pop('rateLimit', None)
+        if rate_limit:
+            self._update_rate_limit(rate_limit)
+        if any(err.get('type') in self.SPLIT_ERRORS for err in result.get('errors') or []):
+            if len(batch) > 1:
+                logging.info('Splitting a GraphQL query of %s modules that was too big',
+                             len(batch))
+                half = len(batch) // 2
+                return [batch[:half], batch[half:]]
+            # Too big even by itself, so it gets a request of its own next time
+            self.costs[batch[0][0]] = self.TARGET_COST
+        if 'errors' in result:
+            logging.error('DownloadCounter errors in GraphQL query: %s',
+                          ', '.join(f'{msg} (x{ilen(grp)})'
+                                    for msg, grp
+                                    in groupby(sorted(err['message']
+                                                      for err in result['errors'])))
+                          if result['errors'] else 'Empty errors list')
+        for fake_ident, apidata in data.items():
+            if apidata:
+                real_ident = self.from_graphql_safe_identifier(fake_ident)
+                try:
+                    count = self.sum_graphql_result(apidata)
+                    user_repo = self.repos[real_ident]
+                    # Cache results per repo, for shared $krefs
+                    self.cache[user_repo] = count
+                    self.costs[user_repo] = self.count_graphql_nodes(apidata)
+                    self.fingerprints[user_repo] = self.release_fingerprint(apidata)
+                except Exception:  # pylint: disable=broad-except
+                    pass
+        return []
+
+    def _update_rate_limit(self, rate_limit: Dict[str, Any]) -> None:
+        # Responses can arrive out of order, so keep the lowest remaining
+        # for the current window, or the first of a newer one
+        if (self.rate_limit is None
+                or rate_limit['resetAt'] > self.rate_limit['resetAt']
+                or (rate_limit['resetAt'] == self.rate_limit['resetAt']
+                    and rate_limit['remaining'] < self.rate_limit['remaining'])):
+            self.rate_limit = rate_limit
+
     def graphql_to_github(self, query: str) -> Optional[Dict[str, Any]]:
         logging.info('Contacting GitHub')
         for which_attempt in range(5):
-            response = requests.post(self.GITHUB_API,
-                                     headers={'Authorization': f'bearer {self.github_token}'},
-                                     json={'query': query},
-                                     timeout=60)
+            response = self.session.post(self.api_url, json={'query': query}, timeout=60)
             retry_after = self._retry_interval(response)
             if retry_after:
                 logging.error('Download counter throttled, waiting %s to retry...',
                               retry_after)
                 sleep(retry_after.total_seconds() * (2 ** which_attempt))
+            elif response.status_code in (502, 504):
+                # GitHub gives up on queries that take too long to run
+                return {'errors': [{'type': 'TIMEOUT',
+                                    'message': f'HTTP {response.status_code}'}]}
             else:
                 return response.json()
         logging.error('Download counter query ran out of retries')
@@ -168,6 +526,15 @@ class GitHubBatchedQuery:
 
         return None
 
+    def count_graphql_nodes(self, apidata: Dict[str, Any]) -> int:
+        """Roughly how much GitHub had to fetch for this repo"""
+        total = 1 + len(apidata['releases']['nodes'])
+        if apidata.get('parent', None):
+            total += self.count_graphql_nodes(apidata['parent'])
+        for release in apidata['releases']['nodes']:
+            total += len(release['releaseAssets']['nodes'])
+        return total
+
     def sum_graphql_result(self, apidata: Dict[str, Any]) -> int:
         total = 0
         if apidata.get('parent', None):
@@ -183,6 +550,8 @@ class SpaceDockBatchedQuery:
     PATH_PATTERN = re.compile(r'^/mod/([^/]+)')
 
     SPACEDOCK_API = 'https://spacedock.info/api/download_counts'
+    # (connect, read) seconds, it's one big request
+    TIMEOUT = (10, 120)
 
     def __init__(self) -> None:
         self.ids: Dict[str, int] = {}
@@ -200,11 +569,13 @@ class SpaceDockBatchedQuery:
         }
 
     def query_to_spacedock(self, query: Dict[str, Any]) -> Dict[str, Any]:
-        return requests.post(self.SPACEDOCK_API, data=query, timeout=60).json()
+        return request_json('POST', self.SPACEDOCK_API, self.TIMEOUT, data=query)
 
     def get_result(self, counts: Optional[Dict[str, int]] = None) -> Dict[str, int]:
         if counts is None:
             counts = {}
+        if self.empty():
+            return counts
         full_query = self.get_query()
         result = self.query_to_spacedock(full_query)
         sd_counts = {
@@ -226,9 +597,13 @@ class InternetArchiveBatchedQuery:
 
     # It let me get away with 35 in testing, let's pad that
     MODULES_PER_REQUEST = 30
+    # (connect, read) seconds
+    TIMEOUT = (10, 60)
 
     def __init__(self) -> None:
         self.ids: Dict[str, str] = {}
+        # Counts per archive.org item
+        self.results: Dict[str, int] = {}
 
     def empty(self) -> bool:
         return len(self.ids) == 0
@@ -242,11 +617,12 @@ class InternetArchiveBatchedQuery:
     def get_result(self, counts: Optional[Dict[str, int]] = None) -> Dict[str, int]:
         if counts is None:
             counts = {}
-        result = requests.get(self.IARCHIVE_API + ','.join(self.ids.values()),
-                              timeout=60).json()
+        result = request_json('GET', self.IARCHIVE_API + ','.join(self.ids.values()),
+                              self.TIMEOUT)
         for ckan_ident, ia_ident in self.ids.items():
             try:
-                counts[ckan_ident] = counts.get(ckan_ident, 0) + result[ia_ident]['all_time']
+                self.results[ia_ident] = result[ia_ident]['all_time']
+                counts[ckan_ident] = counts.get(ckan_ident, 0) + self.results[ia_ident]
             except KeyError as exc:
                 logging.error('InternetArchive id not found in downloads result: %s',
                               ia_ident, exc_info=exc)
@@ -262,9 +638,12 @@ class SourceForgeQuerier:
                             '?start_date=2010-01-01&end_date=${today}'
                             '&os_by_country=false&period=monthly')
 
+    # (connect, read) seconds
+    TIMEOUT = (10, 60)
+
     @classmethod
     def get_count(cls, proj_id: str) -> int:
-        return requests.get(cls.get_query(proj_id), timeout=60).json()['total']
+        return request_json('GET', cls.get_query(proj_id), cls.TIMEOUT)['total']
 
     @classmethod
     def get_query(cls, proj_id: str) -> str:
@@ -282,20 +661,114 @@ class SourceForgeQuerier:
 
 class DownloadCounter:
 
-    def __init__(self, game_id: str, ckm_repo: CkanMetaRepo, github_token: str) -> None:
+    # Requests in flight at once to archive.org or SourceForge
+    SOURCE_WORKERS = 4
+    # Download leaderboards to log besides all-time, as (days, period)
+    LEADERBOARDS = [(1, 'today'), (7, 'this week'), (30, 'this month')]
+
+    def __init__(self, game_id: str, ckm_repo: CkanMetaRepo, github_token: str,
+                 github_workers: int = 1, min_gh: int = 0, refresh_days: int = 0,
+                 store_dir: Optional[Path] = None) -> None:
         self.game_id = game_id
         self.ckm_repo = ckm_repo
         self.counts: Dict[str, Any] = {}
         self.github_token = github_token
+        self.github_workers = github_workers
+        self.min_gh = min_gh
+        # Fetch every count at least this often, 0 to fetch them all every run
+        self.refresh_days = refresh_days
+        self.now = datetime.now(timezone.utc)
+        # Clones of the metadata repo are often thrown away after a run,
+        # so the store goes in store_dir where there is one
+        self.store = DownloadCountStore(
+            Path(store_dir, f'{game_id}-{DownloadCountStore.FILENAME}') if store_dir
+            else Path(self.ckm_repo.git_repo.git_dir, DownloadCountStore.FILENAME))
+        self.cached: Dict[str, Dict[str, CachedCount]] = {}
+        # Counts fetched this run, per source and key, with their fingerprints
+        self.fetched: Dict[str, Dict[str, Tuple[int, Optional[str]]]] = {}
+        # Mods a source should have counted this run but didn't
+        self.missed: Set[str] = set()
+        # Mods with a count reused from an earlier run
+        self.reused: Set[str] = set()
         if self.ckm_repo.git_repo.working_dir:
             self.output_file = Path(
                 self.ckm_repo.git_repo.working_dir, 'download_counts.json'
             )
 
+    def reusable(self, source: str, key: str) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        The count and fingerprint we fetched for this key on an earlier
+        run, if it isn't due a refresh
+
+        Every key is refreshed once refresh_days have passed, and each is
+        also due on its own day of that cycle, so the refreshes are
+        spread across the days rather than all landing together. A
+        reused count misses the downloads since it was fetched, so it
+        can be up to refresh_days behind.
+        """
+        if not self.refresh_days:
+            return None
+        if source not in self.cached:
+            self.cached[source] = self.store.counts(source)
+        cached = self.cached[source].get(key)
+        if cached is None:
+            return None
+        count, fetched, fingerprint = cached
+        days = (self.now.date() - fetched.date()).days
+        if days >= self.refresh_days or (
+                days > 0 and (zlib.crc32(key.encode('UTF-8')) % self.refresh_days
+                              == self.now.date().toordinal() % self.refresh_days)):
+            return None
+        return count, fingerprint
+
+    def add_count(self, identifier: str, count: int) -> None:
+        self.counts[identifier] = self.counts.get(identifier, 0) + count
+
     def get_counts(self) -> None:
-        graph_query = GitHubBatchedQuery(self.github_token)
+        """
+        Find which mods are on which source, then count each source at once
+
+        Each source is counted on its own thread, so the run takes as long
+        as the slowest rather than all of them added up. A source that
+        fails, in part or entirely, doesn't stop the others.
+        """
+        graph_query, sd_query, ia_ckans, sf_projects = self.find_sources()
+        wanted = {
+            'GitHub': set(graph_query.repos),
+            'SpaceDock': set(sd_query.ids),
+            'archive.org': set(ia_ckans),
+            'SourceForge': {ident for idents in sf_projects.values() for ident in idents},
+        }
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sources = {
+                'GitHub': executor.submit(self.count_github, graph_query),
+                'SpaceDock': executor.submit(sd_query.get_result),
+                'archive.org': executor.submit(self.count_archive_org, list(ia_ckans.values())),
+                'SourceForge': executor.submit(self.count_sourceforge, sf_projects),
+            }
+            for source, future in sources.items():
+                try:
+                    counted = future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error('Failed to get counts from %s', source, exc_info=exc)
+                    counted = {}
+                for identifier, count in counted.items():
+                    self.add_count(identifier, count)
+                self.missed.update(wanted[source].difference(counted))
+        for source, fetched in self.fetched.items():
+            self.store.save_counts(source, fetched, self.now)
+
+    def find_sources(self) -> Tuple[GitHubBatchedQuery, SpaceDockBatchedQuery,
+                                    Dict[str, Ckan], Dict[str, List[str]]]:
+        """
+        Sort the mods by where they're downloaded from, adding counts we
+        can reuse as we go
+        """
+        graph_query = GitHubBatchedQuery(self.github_token, self.github_workers, self.min_gh,
+                                         costs=self.store.github_costs())
         sd_query = SpaceDockBatchedQuery()
-        ia_query: Optional[InternetArchiveBatchedQuery] = InternetArchiveBatchedQuery()
+        ia_ckans: Dict[str, Ckan] = {}
+        sf_projects: Dict[str, List[str]] = {}
         for ckan in self.ckm_repo.all_latest_modules():  # pylint: disable=too-many-nested-blocks
             if ckan.kind == 'dlc':
                 continue
@@ -307,9 +780,6 @@ class DownloadCounter:
                         if match:
                             # Process GitHub modules together in big batches
                             graph_query.add(ckan.identifier, *match.groups())
-                            if graph_query.full():
-                                # Run the query
-                                graph_query.get_result(self.counts)
                     elif url_parse.netloc == 'spacedock.info':
                         match = SpaceDockBatchedQuery.PATH_PATTERN.match(url_parse.path)
                         if match:
@@ -319,22 +789,22 @@ class DownloadCounter:
                             logging.error('Failed to parse SD URL for %s: %s',
                                           ckan.identifier, download)
                     elif url_parse.netloc == 'archive.org':
-                        if ia_query:
-                            ia_query.add(ckan)
-                            if ia_query.full():
-                                try:
-                                    ia_query.get_result(self.counts)
-                                    ia_query = InternetArchiveBatchedQuery()
-                                except ConnectTimeout as exc:
-                                    # Cleanly turn off archive.org counting during downtime
-                                    logging.error('Failed to get counts from archive.org',
-                                                  exc_info=exc)
-                                    ia_query = None
+                        reused = self.reusable('archive.org', ckan.mirror_item())
+                        if reused:
+                            self.add_count(ckan.identifier, reused[0])
+                            self.reused.add(ckan.identifier)
+                        else:
+                            ia_ckans[ckan.identifier] = ckan
                     elif url_parse.netloc.endswith('.sourceforge.net'):
                         match = SourceForgeQuerier.PATH_PATTERN.match(url_parse.path)
                         if match:
-                            SourceForgeQuerier.get_result(ckan.identifier, match.group(1),
-                                                          self.counts)
+                            proj_id = match.group(1)
+                            reused = self.reusable('sourceforge', proj_id)
+                            if reused:
+                                self.add_count(ckan.identifier, reused[0])
+                                self.reused.add(ckan.identifier)
+                            else:
+                                sf_projects.setdefault(proj_id, []).append(ckan.identifier)
                         else:
                             logging.error('Failed to parse SF URL for %s: %s',
                                           ckan.identifier, download)
@@ -343,13 +813,77 @@ class DownloadCounter:
                     # Print file path because netkan_dl might be None
                     logging.error('DownloadCounter failed for %s',
                                   ckan.identifier, exc_info=exc)
-        if not sd_query.empty():
-            sd_query.get_result(self.counts)
-        if not graph_query.empty():
-            # Final pass doesn't overflow the bound
-            graph_query.get_result(self.counts)
-        if ia_query and not ia_query.empty():
-            ia_query.get_result(self.counts)
+        return graph_query, sd_query, ia_ckans, sf_projects
+
+    def count_github(self, graph_query: GitHubBatchedQuery) -> Dict[str, int]:
+        if graph_query.empty():
+            return {}
+        graph_query.skip_unchanged({
+            user_repo: reused for user_repo in graph_query.requests
+            if (reused := self.reusable('github', '/'.join(user_repo)))})
+        repos = dict(graph_query.repos)
+        counts = graph_query.get_result()
+        self.reused.update(ident for ident, user_repo in repos.items()
+                           if user_repo in graph_query.cache
+                           and user_repo not in graph_query.fingerprints)
+        self.store.save_github_costs(graph_query.costs)
+        self.fetched['github'] = {
+            '/'.join(user_repo): (graph_query.cache[user_repo], fingerprint)
+            for user_repo, fingerprint in graph_query.fingerprints.items()
+            if user_repo in graph_query.cache}
+        return counts
+
+    def count_archive_org(self, ckans: List[Ckan]) -> Dict[str, int]:
+        queries = []
+        for batch in batched(ckans, InternetArchiveBatchedQuery.MODULES_PER_REQUEST):
+            query = InternetArchiveBatchedQuery()
+            for ckan in batch:
+                query.add(ckan)
+            queries.append(query)
+        counts: Dict[str, int] = {}
+        fetched: Dict[str, int] = {}
+        with ThreadPoolExecutor(max_workers=self.SOURCE_WORKERS) as executor:
+            futures = [(query, executor.submit(query.get_result)) for query in queries]
+            for query, future in futures:
+                try:
+                    counts.update(future.result())
+                    fetched.update(query.results)
+                except (requests.RequestException, ValueError) as exc:
+                    logging.error('Failed to get %s counts from archive.org: %s',
+                                  len(query.ids), exc)
+        self.add_fetched('archive.org', fetched)
+        self.log_partial('archive.org', len(counts), len(ckans))
+        return counts
+
+    def count_sourceforge(self, projects: Dict[str, List[str]]) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        fetched: Dict[str, int] = {}
+        with ThreadPoolExecutor(max_workers=self.SOURCE_WORKERS) as executor:
+            futures = {proj_id: executor.submit(SourceForgeQuerier.get_count, proj_id)
+                       for proj_id in projects}
+            for proj_id, future in futures.items():
+                try:
+                    fetched[proj_id] = future.result()
+                except (requests.RequestException, ValueError, KeyError) as exc:
+                    logging.error('Failed to get count for %s from SourceForge: %s',
+                                  proj_id, exc)
+                    continue
+                for identifier in projects[proj_id]:
+                    counts[identifier] = counts.get(identifier, 0) + fetched[proj_id]
+        self.add_fetched('sourceforge', fetched)
+        self.log_partial('SourceForge', len(fetched), len(projects))
+        return counts
+
+    @staticmethod
+    def log_partial(source: str, fetched: int, wanted: int) -> None:
+        if fetched < wanted:
+            logging.error('Got %s of %s counts from %s', fetched, wanted, source)
+        else:
+            logging.info('Got all %s counts from %s', wanted, source)
+
+    def add_fetched(self, source: str, counts: Dict[str, int]) -> None:
+        self.fetched.setdefault(source, {}).update(
+            (key, (count, None)) for key, count in counts.items())
 
     def write_json(self) -> None:
         if self.output_file:
@@ -372,24 +906,57 @@ class DownloadCounter:
                          if counts[ident] > 0)
 
     def log_top(self, how_many: int) -> None:
-        if self.output_file and self.output_file.exists():
-            with open(self.output_file, encoding='UTF-8') as old_file:
-                old_counts = json.load(old_file)
-                deltas = {ident: count - old_counts[ident]
-                          for ident, count in self.counts.items()
-                          if ident in old_counts}
-                # This isn't an error, but only errors go to Discord
-                logging.error('Top %s downloads for %s all-time:\n%s\n\n'
-                              'Top %s downloads for %s today:\n%s',
-                              how_many, self.game_id,
-                              self._download_summary_table(self.counts, how_many),
-                              how_many, self.game_id,
-                              self._download_summary_table(deltas, how_many))
+        if self.output_file:
+            today = self.now.date()
+            sections = [f'Top {how_many} downloads for {self.game_id} all-time:\n'
+                        + self._download_summary_table(self.counts, how_many)]
+            for days, period in self.LEADERBOARDS:
+                deltas = self.store.deltas(today - timedelta(days=days), today)
+                if not deltas and days == 1:
+                    # No history yet, compare with the last run's counts
+                    deltas = self._json_deltas()
+                if deltas:
+                    sections.append(f'Top {how_many} downloads for {self.game_id} {period}:\n'
+                                    + self._download_summary_table(deltas, how_many))
+            # This isn't an error, but only errors go to Discord
+            logging.error('%s', '\n\n'.join(sections))
+
+    def _json_counts(self) -> Dict[str, int]:
+        if not self.output_file.exists():
+            return {}
+        with open(self.output_file, encoding='UTF-8') as old_file:
+            return json.load(old_file)
+
+    def _json_deltas(self) -> Dict[str, int]:
+        old_counts = self._json_counts()
+        return {ident: count - old_counts[ident]
+                for ident, count in self.counts.items()
+                if ident in old_counts}
+
+    def carry_forward(self) -> None:
+        """
+        Keep the last run's count for mods a source missed this time,
+        rather than dropping them or lowering their count
+        """
+        old_counts = self._json_counts()
+        carried = 0
+        for ident in self.missed:
+            if old_counts.get(ident, 0) > self.counts.get(ident, 0):
+                self.counts[ident] = old_counts[ident]
+                carried += 1
+        if carried:
+            logging.info('Carried forward the last run\'s counts for %s mods', carried)
 
     def update_counts(self) -> None:
         if self.output_file:
             self.get_counts()
             self.ckm_repo.pull_remote_primary(strategy_option='ours')
+            self.carry_forward()
+            # Reused and carried forward counts are from earlier days, putting
+            # them on today would land all of the downloads since on it
+            stale = self.reused | self.missed
+            self.store.record_day(self.now.date(), {
+                ident: count for ident, count in self.counts.items() if ident not in stale})
             self.log_top(5)
             self.write_json()
             if repo_file_add_or_changed(self.ckm_repo.git_repo, self.output_file):
@@ -1,14 +1,16 @@
 import hashlib
 import logging
-from pathlib import Path, PurePath
+import time
+from pathlib import Path, PurePath, PurePosixPath
 from collections import deque
 from datetime import datetime, timezone
-from typing import List, Optional, Dict, Any, Deque, Type, TYPE_CHECKING
+from typing import List, Optional, Dict, Any, Deque, Tuple, Type, TYPE_CHECKING
 
 from dateutil.parser import parse
 from git.objects.commit import Commit
 
 from .cli.common import Game
+from .common import put_metrics
 from .metadata import Ckan
 from .queue_handler import BaseMessageHandler, QueueHandler
 from .repos import CkanMetaRepo
@@ -123,39 +125,58 @@ class CkanMessage:
         if cache_path:
             cache_mtime = datetime.fromtimestamp(cache_path.stat().st_mtime)
             attrs['last_downloaded'] = cache_mtime.astimezone(timezone.utc)
-        if self.indexed:
+        # Primary commits only count as indexed once they're pushed,
+        # MessageHandler.push sets it for those
+        if self.indexed and self.Staged:
             attrs['last_indexed'] = datetime.now(timezone.utc)
         release_date = getattr(self.ckan, 'release_date', None)
         if release_date:
             attrs['release_date'] = release_date
         return attrs
 
+    @property
+    def status_key(self) -> Tuple[str, str]:
+        return (self.ModIdentifier, self.GameId.lower())
+
     def _process_ckan(self) -> None:
         if self.Success and self.metadata_changed():
             new_file = not self.mod_file.exists()
             self.write_metadata()
             self.commit_metadata(new_file)
-        try:
-            status = ModStatus.get(
-                self.ModIdentifier, range_key=self.GameId.lower())
-            attrs = self.status_attrs()
-            if not self.Success and getattr(status, 'last_error', None) != self.ErrorMessage:
-                logging.error('New inflation error for %s: %s',
-                              self.ModIdentifier, self.ErrorMessage)
-            elif (getattr(status, 'last_warnings', None) != self.WarningMessages and self.WarningMessages is not None):
-                logging.error('New inflation warnings for %s: %s',
-                              self.ModIdentifier, self.WarningMessages)
-            actions = [getattr(ModStatus, key).set(val)
-                       for key, val in attrs.items()]
-            status.update(actions=actions)
-        except ModStatus.DoesNotExist:
-            ModStatus(**self.status_attrs(True)).save()
+
+    def update_status(self, status: Optional[ModStatus]) -> ModStatus:
+        """Write this inflation to the mod's status
+
+        Takes the current status (None if there isn't one yet) and
+        returns it as written.
+        """
+        if status is None:
+            status = ModStatus(**self.status_attrs(True))
+            status.save()
+            return status
+        if not self.Success and getattr(status, 'last_error', None) != self.ErrorMessage:
+            logging.error('New inflation error for %s: %s',
+                          self.ModIdentifier, self.ErrorMessage)
+        elif (getattr(status, 'last_warnings', None) != self.WarningMessages and self.WarningMessages is not None):
+            logging.error('New inflation warnings for %s: %s',
+                          self.ModIdentifier, self.WarningMessages)
+        # Only set the attributes we own, so changes made elsewhere
+        # since we read the row aren't overwritten
+        status.update(actions=[getattr(ModStatus, key).set(val)
+                               for key, val in self.status_attrs().items()])
+        return status
 
     def process_ckan(self) -> None:
         # Staged CKANs that were inflated successfully and have been changed
         if self.Staged and self.Success and self.metadata_changed():
-            with self.ckm_repo.change_branch(self.staging_branch_name):
-                self._process_ckan()
+            primary_repo = self.ckm_repo
+            with primary_repo.worktree_branch(self.staging_branch_name) as staging_repo:
+                # Paths and commits resolve against the repo we hold
+                self.ckm_repo = staging_repo
+                try:
+                    self._process_ckan()
+                finally:
+                    self.ckm_repo = primary_repo
             if self.indexed and self.github_pr:
                 self.github_pr.create_pull_request(
                     title=f'NetKAN inflated: {self.ModIdentifier}',
@@ -176,6 +197,72 @@ class CkanMessage:
         }
 
 
+class PushCoalescer:
+
+    """
+    Holds back pushes of the primary branch until enough commits have
+    built up
+
+    A push is due max_wait seconds after the first pending commit, or
+    sooner once max_commits are pending; with the default max_wait of 0
+    each batch's commits are pushed straight away. The messages behind
+    the commits are deleted once they're committed locally, so they
+    don't sit in flight holding up the rest of the queue's group, but
+    the mods' last_indexed waits for the push. Pending commits left in
+    the clone by a restart are pushed when it's next used, and if the
+    clone itself is lost, each mod's next inflation commits it again,
+    as the remote's metadata still differs.
+    """
+
+    def __init__(self, max_commits: int = 50, max_wait: float = 0,
+                 metrics_namespace: str = '', game_id: str = '') -> None:
+        self.max_commits = max_commits
+        self.max_wait = max_wait
+        self.metrics_namespace = metrics_namespace
+        self.game_id = game_id
+        self.commits = 0
+        self.first_commit: Optional[float] = None
+        self.pushes = 0
+        self.pushed_commits = 0
+
+    @property
+    def pending(self) -> bool:
+        return self.commits > 0
+
+    def add(self, commits: int) -> None:
+        if commits and self.first_commit is None:
+            self.first_commit = time.monotonic()
+        self.commits += commits
+
+    def due(self) -> bool:
+        return self.pending and (
+            self.commits >= self.max_commits
+            or time.monotonic() - (self.first_commit or 0) >= self.max_wait)
+
+    def push(self, repo: CkanMetaRepo) -> List[str]:
+        """Push the pending commits, returning the mods they changed"""
+        identifiers: List[str] = []
+        if self.pending:
+            repo.rebase_remote_primary()
+            identifiers = sorted({PurePosixPath(path).parts[0]
+                                  for path in repo.unpushed_primary_paths()})
+            repo.push_remote_primary()
+            self.pushes += 1
+            self.pushed_commits += self.commits
+            logging.info('Pushed %s commits, %s pushes so far at %.2f commits per push',
+                         self.commits, self.pushes, self.commits_per_push)
+            put_metrics(self.metrics_namespace,
+                        {'PrimaryPushes': 1, 'PushedCommits': self.commits},
+                        Service='Indexer', Game=self.game_id)
+        self.commits = 0
+        self.first_commit = None
+        return identifiers
+
+    @property
+    def commits_per_push(self) -> float:
+        return self.pushed_commits / self.pushes if self.pushes else 0
+
+
 class MessageHandler(BaseMessageHandler):
     primary: Deque[CkanMessage]
     staged: Deque[CkanMessage]
@@ -184,6 +271,23 @@ class MessageHandler(BaseMessageHandler):
         super().__init__(game)
         self.primary = deque()
         self.staged = deque()
+        self.pusher = PushCoalescer(game.shared.push_commits, game.shared.push_wait,
+                                    game.shared.metrics_namespace, game.name)
+
+    def __enter__(self) -> 'MessageHandler':
+        if not self.repo.is_primary_active():
+            self.repo.checkout_primary()
+        unpushed = self.repo.unpushed_primary_commits()
+        if unpushed:
+            # Merging the remote in would put a merge commit on top of
+            # the commits still waiting to be pushed
+            self.repo.rebase_remote_primary()
+            if not self.pusher.pending:
+                # Left over from before a restart
+                self.pusher.add(unpushed)
+        else:
+            self.repo.pull_remote_primary(strategy_option=self.STRATEGY_OPTION)
+        return self
 
     def __str__(self) -> str:
         return str(' '.join([str(x) for x in self.primary + self.staged]))
@@ -210,25 +314,50 @@ class MessageHandler(BaseMessageHandler):
         else:
             self.staged.append(ckan)
 
-    def _process_queue(self, queue: Deque[CkanMessage]) -> List[CkanMessage]:
+    @staticmethod
+    def _process_queue(queue: Deque[CkanMessage],
+                       statuses: Dict[Tuple[str, str], ModStatus]) -> List[CkanMessage]:
         processed = []
         while queue:
             ckan = queue.popleft()
             ckan.process_ckan()
             processed.append(ckan)
+            # Written straight after its commit, so a later message
+            # failing can't lose it
+            statuses[ckan.status_key] = ckan.update_status(statuses.get(ckan.status_key))
         return processed
 
-    # Currently we intermingle Staged/Primary commits
-    # separating them out will be a little more efficient
-    # with our push/pull traffic.
+    # Primary commits are pushed by the coalescer, staged ones go
+    # out with their branches as they're made.
     def process_messages(self) -> List[DeleteMessageBatchRequestEntryTypeDef]:
-        processed = self._process_queue(self.primary)
-        if any(ckan.indexed for ckan in processed):
-            self.repo.pull_remote_primary()
-            self.repo.push_remote_primary()
-        processed.extend(self._process_queue(self.staged))
+        statuses = self.load_statuses(list(self.primary + self.staged))
+        processed = self._process_queue(self.primary, statuses)
+        self.pusher.add(sum(1 for ckan in processed if ckan.indexed))
+        if self.pusher.due():
+            self.push()
+        processed.extend(self._process_queue(self.staged, statuses))
         return [c.delete_attrs for c in processed]
 
+    def flush(self, force: bool = False) -> None:
+        if self.pusher.due() or (force and self.pusher.pending):
+            with self:
+                self.push()
+
+    def push(self) -> None:
+        indexed = datetime.now(timezone.utc)
+        for identifier in self.pusher.push(self.repo):
+            ModStatus(identifier, self.game.name).update(
+                actions=[ModStatus.last_indexed.set(indexed)])
+
+    @staticmethod
+    def load_statuses(ckans: List[CkanMessage]) -> Dict[Tuple[str, str], ModStatus]:
+        # One read for the whole batch rather than a get per message,
+        # the writes stay per message to only touch our attributes
+        if not ckans:
+            return {}
+        return {(status.ModIdentifier, status.game_id): status
+                for status in ModStatus.batch_get(list({ckan.status_key for ckan in ckans}))}
+
 
 class IndexerQueueHandler(QueueHandler):
     _handler_class: Type[BaseMessageHandler] = MessageHandler
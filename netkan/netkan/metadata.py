@@ -1,16 +1,19 @@
 import json
 import re
-from functools import total_ordering
+from functools import total_ordering, lru_cache
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
 from hashlib import sha1
 import uuid
 import urllib.parse
 from string import Template
-from typing import Optional, List, Tuple, Union, Any, Dict, TYPE_CHECKING
+from typing import Optional, List, Tuple, Union, Any, Dict, Iterable, TYPE_CHECKING
 from ruamel.yaml import YAML
 import dateutil.parser
 
 from .csharp_compat import csharp_uri_tostring
+from .download_cache import DownloadCacheIndex
 
 if TYPE_CHECKING:
     from mypy_boto3_sqs.type_defs import SendMessageBatchRequestEntryTypeDef
@@ -30,9 +33,10 @@ class Netkan:
     ) -> None:
         if filename:
             self.filename = Path(filename)
-            self.contents = self.filename.read_text(encoding='UTF-8')
-        elif contents:
+        if contents:
             self.contents = contents
+        elif filename:
+            self.contents = self.filename.read_text(encoding='UTF-8')
         self.game_id = game_id
         yaml = YAML(typ='safe')
         # YAML parser doesn't allow tabs, so replace with spaces
@@ -55,6 +59,11 @@ class Netkan:
             return f'<{self.__class__.__name__}(identifier undefined)>'
 
     def __getattr__(self, name: str) -> Any:
+        # Private and dunder lookups (e.g. from pickle) aren't metadata, and
+        # would recurse before _raw is set
+        if name.startswith('_'):
+            raise AttributeError(name)
+
         # Return kref host, ie `self.on_spacedock`. Current krefs include
         # github, spacedock, curse and netkan.
         if name.startswith('on_'):
@@ -162,6 +171,9 @@ class Ckan:
 
         PATTERN = re.compile("^(?:(?P<epoch>[0-9]+):)?(?P<version>.*)$")
 
+        # (epoch, ((string piece key, number piece), ...))
+        SortKey = Tuple[int, Tuple[Tuple[Tuple[Union[int, str], ...], int], ...]]
+
         def __init__(self, version_string: str) -> None:
             self.string = version_string
             match = self.PATTERN.fullmatch(self.string)
@@ -176,142 +188,67 @@ class Ckan:
             self.bare_version = match.group('version')
             if self.bare_version is None:
                 raise ValueError
+            self.key: 'Ckan.Version.SortKey' = (self.epoch, self._pieces(self.bare_version))
+
+        # The CKAN-Core implementation walks both strings in step, comparing a string
+        # piece then a number piece until one of them differs or runs out. We split
+        # the version into those pieces once, so comparing is a plain tuple comparison.
+        # https://github.com/KSP-CKAN/CKAN/blob/master/Spec.md#version-ordering
+        @staticmethod
+        @lru_cache(maxsize=65536)
+        def _pieces(bare_version: str) -> Tuple[Tuple[Tuple[Union[int, str], ...], int], ...]:
+            runs = [(is_digit, ''.join(chars))
+                    for is_digit, chars in groupby(bare_version, key=str.isdigit)]
+            pieces = []
+            i = 0
+            while i < len(runs):
+                string = ''
+                if not runs[i][0]:
+                    string = runs[i][1]
+                    i += 1
+                number = 0
+                if i < len(runs) and runs[i][0]:
+                    number = int(runs[i][1]) if runs[i][1].isdecimal() else 0
+                    i += 1
+                pieces.append((Ckan.Version._string_key(string), number))
+            return tuple(pieces)
+
+        @staticmethod
+        def _string_key(piece: str) -> Tuple[Union[int, str], ...]:
+            # Strings compare normally, except that one starting with '.' sorts
+            # higher than one that doesn't, and a lone '.' sorts higher than
+            # a '.' with anything after it (which are all equal to each other).
+            if not piece:
+                return (0,)
+            if piece[0] != '.':
+                return (1, piece)
+            return (3,) if piece == '.' else (2,)
 
-        # @total_ordering doesn't generate this one right. Maybe it compares the strings?
         def __eq__(self, other: object) -> bool:
             if isinstance(other, self.__class__):
-                return not self > other and not other > self
+                return self.key == other.key
             return False
 
-        # The CKAN-Core implementation relies on a __cmp__-like concept. __cmp__ has been deprecated in Python3.
-        # The logic has been adjusted a bit to be run as __gt__. All the other possible relation comparisons
-        # (except __eq__) are deduced from it by @total_ordering.
+        def __hash__(self) -> int:
+            return hash(self.key)
+
         def __gt__(self, other: 'Ckan.Version') -> bool:
+            return self.key > other.key
 
-            def _string_compare(ver1: str, ver2: str) -> Tuple[int, str, str]:
-                _result: int
-                _first_remainder = ''
-                _second_remainder = ''
-
-                # Our starting assumptions are, that both versions are completely strings,
-                # with no remainder. We'll then check if they're not.
-                str1 = ver1
-                str2 = ver2
-
-                # Start by walking along our version string until we find a number,
-                # thereby finding the starting string in both cases. If we fall off
-                # the end, then our assumptions made above hold.
-                for i, piece in enumerate(ver1):
-                    if piece.isdigit():
-                        _first_remainder = ver1[i:]
-                        str1 = ver1[:i]
-                        break
-
-                for i, piece in enumerate(ver2):
-                    if piece.isdigit():
-                        _second_remainder = ver2[i:]
-                        str2 = ver2[:i]
-                        break
-
-                # Then compare the two strings, and return our comparison state.
-                # Override sorting of '.' to higher than other characters.
-                if len(str1) > 0 and len(str2) > 0:
-                    if str1[0] != '.' and str2[0] == '.':
-                        _result = -1
-                    elif str1[0] == '.' and str2[0] != '.':
-                        _result = 1
-                    elif str1[0] == '.' and str2[0] == '.':
-                        if len(str1) == 1 and len(str2) > 1:
-                            _result = 1
-                        elif len(str1) > 1 and len(str2) == 1:
-                            _result = -1
-                        else:
-                            _result = 0
-                    else:
-                        # Do an artificial __cmp__
-                        _result = (str1 > str2) - (str1 < str2)
-                else:
-                    _result = (str1 > str2) - (str1 < str2)
-
-                return _result, _first_remainder, _second_remainder
-
-            def _number_compare(ver1: str, ver2: str) -> Tuple[int, str, str]:
-                _result: int
-                _first_remainder = ''
-                _second_remainder = ''
-
-                minimum_length1 = 0
-                for i, piece in enumerate(ver1):
-                    if not piece.isdigit():
-                        _first_remainder = ver1[i:]
-                        break
-                    minimum_length1 += 1
-
-                minimum_length2 = 0
-                for i, piece in enumerate(ver2):
-                    if not piece.isdigit():
-                        _second_remainder = ver2[i:]
-                        break
-                    minimum_length2 += 1
-
-                if ver1[:minimum_length1].isnumeric():
-                    integer1 = int(ver1[:minimum_length1])
-                else:
-                    integer1 = 0
-
-                if ver2[:minimum_length2].isnumeric():
-                    integer2 = int(ver2[:minimum_length2])
-                else:
-                    integer2 = 0
-
-                _result = (integer1 > integer2) - (integer1 < integer2)
-                return _result, _first_remainder, _second_remainder
-
-            # Here begins the main comparison logic
-            if self is other:
-                return False
-
-            if other.epoch == self.epoch and other.bare_version == self.bare_version:
-                return False
-
-            # Compare epochs first
-            if self.epoch != other.epoch:
-                return self.epoch >= other.epoch
-
-            # Epochs are the same. Do the dance described in
-            # https://github.com/KSP-CKAN/CKAN/blob/master/Spec.md#version-ordering
-            first_remainder = self.bare_version
-            second_remainder = other.bare_version
-
-            # Process our strings while there are characters remaining
-            while len(first_remainder) > 0 and len(second_remainder) > 0:
-                # Start by comparing the string parts.
-                (result, first_remainder, second_remainder) = _string_compare(
-                    first_remainder, second_remainder)
-
-                if result != 0:
-                    return result > 0
-
-                # Otherwise, compare the number parts.
-                # It's okay not to check if our strings are exhausted, because
-                # if they are the exhausted parts will return zero.
-                (result, first_remainder, second_remainder) = _number_compare(
-                    first_remainder, second_remainder)
-
-                # Again, return difference if found.
-                if result != 0:
-                    return result > 0
-
-            # Oh, we've run out of one or both strings.
-            if len(first_remainder) == 0:
-                # If both remainders are empty, both versions are equal => gt is false.
-                # Else, whichever version is empty first is the smallest. (1.2 < 1.2.3)
-                return False
-            return True
+        def __lt__(self, other: 'Ckan.Version') -> bool:
+            return self.key < other.key
 
         def __str__(self) -> str:
             return self.string
 
+        @staticmethod
+        def sort(versions: Iterable['Ckan.Version'], reverse: bool = False) -> List['Ckan.Version']:
+            return sorted(versions, key=attrgetter('key'), reverse=reverse)
+
+        @staticmethod
+        def max(versions: Iterable['Ckan.Version']) -> Optional['Ckan.Version']:
+            return max(versions, key=attrgetter('key'), default=None)
+
     CACHE_PATH = Path.home().joinpath('ckan_cache')
     MIME_TO_EXTENSION = {
         'application/x-gzip': 'gz',
@@ -328,9 +265,10 @@ class Ckan:
     def __init__(self, filename: Optional[Union[str, Path]] = None, contents: Optional[str] = None) -> None:
         if filename:
             self.filename = Path(filename)
-            self.contents = self.filename.read_text(encoding='UTF-8')
-        elif contents:
+        if contents:
             self.contents = contents
+        elif filename:
+            self.contents = self.filename.read_text(encoding='UTF-8')
         self._raw = json.loads(self.contents, object_hook=self._custom_parser)
 
     def __repr__(self) -> str:
@@ -350,6 +288,8 @@ class Ckan:
         return dct
 
     def __getattr__(self, name: str) -> Any:
+        if name.startswith('_'):
+            raise AttributeError(name)
         if name in self._raw:
             return self._raw[name]
         if name == 'kind':
@@ -388,10 +328,10 @@ class Ckan:
 
     @property
     def cache_find_file(self) -> Optional[Path]:
-        found = list(self.CACHE_PATH.glob(f'**/{self.cache_prefix}*.zip'))
-        if found:
-            return found[0]
-        return None
+        prefix = self.cache_prefix
+        if not prefix:
+            return None
+        return DownloadCacheIndex.for_path(self.CACHE_PATH).find(prefix)
 
     @property
     def cache_filename(self) -> Optional[str]:
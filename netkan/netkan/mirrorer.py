@@ -5,6 +5,7 @@ import urllib.parse
 import hashlib
 import logging
 import shutil
+import time
 from pathlib import Path
 from typing import Optional, List, Union, Iterable, BinaryIO, Dict, Any, TYPE_CHECKING
 import boto3
@@ -15,6 +16,7 @@ from jinja2 import Template
 from .metadata import Ckan
 from .repos import CkanMetaRepo
 from .common import deletion_msg, download_stream_to_file, USER_AGENT
+from .queue_handler import BatchStats, delete_messages, receive_batch
 from .utils import legacy_read_text
 
 if TYPE_CHECKING:
@@ -270,21 +272,22 @@ class Mirrorer:
                     if token else
                     github.Github(user_agent=USER_AGENT))
 
-    def process_queue(self, queue_name: str, timeout: int) -> None:
+    def process_queue(self, queue_name: str, timeout: int,  # pylint: disable=too-many-locals
+                      batch_size: int = 10, batch_wait: int = 0,
+                      metrics_namespace: str = '') -> None:
         queue = boto3.resource('sqs').get_queue_by_name(QueueName=queue_name)
+        stats = BatchStats(self.__class__.__name__, metrics_namespace=metrics_namespace)
         if self.ckm_repo.git_repo.working_dir:
             while True:
-                messages = queue.receive_messages(
-                    MaxNumberOfMessages=10,
-                    MessageAttributeNames=['All'],
-                    VisibilityTimeout=timeout,
-                )
+                messages = receive_batch(queue, timeout, batch_size, batch_wait)
                 if not messages:
                     continue
                 # Get up to date copy of the metadata for the files we're mirroring
                 logging.info('Updating repo')
+                start = time.monotonic()
                 self.ckm_repo.checkout_primary()
                 self.ckm_repo.pull_remote_primary(strategy_option='theirs')
+                ready = time.monotonic()
                 # Start processing the messages
                 to_delete: List[DeleteMessageBatchRequestEntryTypeDef] = []
                 for msg in messages:
@@ -306,9 +309,12 @@ class Mirrorer:
                                       msg.body, exc)
                         to_delete.append(deletion_msg(msg))
                 if to_delete:
-                    queue.delete_messages(Entries=to_delete)
+                    delete_messages(queue, to_delete)
+                done = time.monotonic()
                 # Clean up GitPython's lingering file handles between batches
                 self.ckm_repo.git_repo.close()
+                stats.record(len(messages), (ready - start) + (time.monotonic() - done),
+                             done - ready)
 
     def try_mirror(self, ckan: CkanMirror) -> bool:
         if not ckan.can_mirror:
@@ -1,24 +1,241 @@
 import logging
+import math
+import signal
+import threading
+import time
+from collections import Counter, deque
 
-from typing import Dict, List, Type, TYPE_CHECKING, Union
-from types import TracebackType
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Type, TYPE_CHECKING, Union
+from types import FrameType, TracebackType
 
 import boto3
 
 from .repos import CkanMetaRepo, NetkanRepo
+from .common import put_metrics
 from .cli.common import Game, SharedArgs
 
 if TYPE_CHECKING:
-    from mypy_boto3_sqs.service_resource import Message
+    from mypy_boto3_sqs.service_resource import Message, Queue
     from mypy_boto3_sqs.type_defs import (
         DeleteMessageBatchRequestEntryTypeDef,
     )
 else:
     Game = object
     Message = object
+    Queue = object
     DeleteMessageBatchRequestEntryTypeDef = object
 
 
+# SQS limits
+MAX_RECEIVE = 10
+MAX_WAIT_SECONDS = 20
+
+
+def receive_batch(queue: Queue, visibility_timeout: int,
+                  batch_size: int = MAX_RECEIVE, batch_wait: float = 0) -> List[Message]:
+    """Receive up to batch_size messages
+
+    Keeps receiving until we have batch_size messages or batch_wait
+    seconds have passed since the first one arrived, so the repo setup
+    and push a batch costs is shared by more messages. With the default
+    batch_wait of 0 this is a single receive, as before.
+
+    On a FIFO queue, messages from a group we're holding in flight
+    aren't handed out again until we delete them, so only other
+    groups can top up the batch.
+    """
+    messages: List[Message] = []
+    first_received: Optional[float] = None
+    while len(messages) < batch_size:
+        wait = MAX_WAIT_SECONDS
+        if first_received is not None:
+            remaining = batch_wait - (time.monotonic() - first_received)
+            if remaining <= 0:
+                break
+            wait = min(math.ceil(remaining), MAX_WAIT_SECONDS)
+        received = queue.receive_messages(
+            MaxNumberOfMessages=min(batch_size - len(messages), MAX_RECEIVE),
+            MessageAttributeNames=['All'],
+            VisibilityTimeout=visibility_timeout,
+            WaitTimeSeconds=wait,
+        )
+        if received:
+            messages.extend(received)
+            if first_received is None:
+                first_received = time.monotonic()
+        if first_received is None or batch_wait <= 0:
+            # Nothing yet, let the caller poll again, or we're not accumulating
+            break
+    return messages
+
+
+def delete_messages(queue: Queue, entries: List[DeleteMessageBatchRequestEntryTypeDef]) -> None:
+    for start in range(0, len(entries), MAX_RECEIVE):
+        queue.delete_messages(Entries=entries[start:start + MAX_RECEIVE])
+
+
+def change_visibility(queue: Queue, messages: List[Message], timeout: int) -> None:
+    client = queue.meta.client
+    for start in range(0, len(messages), MAX_RECEIVE):
+        client.change_message_visibility_batch(
+            QueueUrl=queue.url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': msg.receipt_handle,
+                      'VisibilityTimeout': timeout}
+                     for i, msg in enumerate(messages[start:start + MAX_RECEIVE])])
+
+
+class MessagePrefetcher:
+
+    """
+    Receives the next batches on a background thread while the current
+    one is being processed
+
+    Up to max_buffered batches are held; while they wait their
+    visibility timeout is extended so they don't go back on the queue,
+    and on exit any left over are released for the next consumer.
+    The thread gets its own queue object (and so boto3 session) from
+    connect, as boto3 resources can't be shared between threads.
+    """
+
+    def __init__(self, connect: Callable[[], Queue], visibility_timeout: int,
+                 batch_size: int = MAX_RECEIVE, batch_wait: float = 0,
+                 max_buffered: int = 1) -> None:
+        self.connect = connect
+        self.visibility_timeout = visibility_timeout
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_buffered = max_buffered
+        # (received or last extended, messages)
+        self._buffer: Deque[Tuple[float, List[Message]]] = deque()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+
+    def __enter__(self) -> 'MessagePrefetcher':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type: Type[BaseException],
+                 exc_value: BaseException, traceback: TracebackType) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join()
+
+    def get(self, timeout: Optional[float] = None) -> List[Message]:
+        """Next buffered batch, or an empty list if none arrives within timeout"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._buffer or not self._thread.is_alive(), timeout)
+            if not self._buffer:
+                if not self._thread.is_alive():
+                    raise RuntimeError('Prefetch thread has stopped')
+                return []
+            _, messages = self._buffer.popleft()
+            self._cond.notify_all()
+        return messages
+
+    def _run(self) -> None:
+        queue = self.connect()
+        try:
+            while not self._stop.is_set():
+                with self._cond:
+                    # Wake up well within the visibility timeout to extend it
+                    self._cond.wait_for(
+                        lambda: len(self._buffer) < self.max_buffered or self._stop.is_set(),
+                        self.visibility_timeout / 3)
+                    full = len(self._buffer) >= self.max_buffered
+                if self._stop.is_set():
+                    break
+                # Buffered batches age while we receive more, not just while full
+                self._extend_visibility(queue)
+                if full:
+                    continue
+                messages = receive_batch(queue, self.visibility_timeout,
+                                         self.batch_size, self.batch_wait)
+                if messages:
+                    with self._cond:
+                        self._buffer.append((time.monotonic(), messages))
+                        self._cond.notify_all()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.error('Prefetching messages failed: %s', exc, exc_info=exc)
+        finally:
+            with self._cond:
+                left_over = [msg for _, batch in self._buffer for msg in batch]
+                self._buffer.clear()
+                self._cond.notify_all()
+            if left_over:
+                change_visibility(queue, left_over, 0)
+
+    def _extend_visibility(self, queue: Queue) -> None:
+        now = time.monotonic()
+        stale: List[Message] = []
+        with self._cond:
+            for i, (received, messages) in enumerate(self._buffer):
+                if now - received > self.visibility_timeout / 2:
+                    self._buffer[i] = (now, messages)
+                    stale.extend(messages)
+        if stale:
+            change_visibility(queue, stale, self.visibility_timeout)
+
+
+class BatchStats:
+
+    """
+    Sizes of the batches a queue consumer processes and the repo setup/teardown
+    time each one costs, logged every log_every batches
+
+    With a metrics namespace, the totals since the last log are also
+    published to CloudWatch, for each service.
+    """
+
+    def __init__(self, name: str, log_every: int = 50, metrics_namespace: str = '') -> None:
+        self.name = name
+        self.log_every = log_every
+        self.metrics_namespace = metrics_namespace
+        self.sizes: Counter[int] = Counter()
+        self.messages = 0
+        self.overhead = 0.0
+        self.processing = 0.0
+        self.unpublished: Counter[str] = Counter()
+
+    @property
+    def batches(self) -> int:
+        return sum(self.sizes.values())
+
+    def record(self, size: int, overhead: float, processing: float) -> None:
+        self.sizes[size] += 1
+        self.messages += size
+        self.overhead += overhead
+        self.processing += processing
+        self.unpublished.update({'Batches': 1, 'Messages': size,
+                                 'OverheadSeconds': overhead,
+                                 'ProcessingSeconds': processing})
+        if self.batches % self.log_every == 0:
+            self.log()
+            self.publish()
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'mean_batch_size': self.messages / self.batches if self.batches else 0,
+            'overhead_per_message': self.overhead / self.messages if self.messages else 0,
+            'processing_per_message': self.processing / self.messages if self.messages else 0,
+        }
+
+    def log(self) -> None:
+        summary = self.summary()
+        logging.info('%s batch stats: %s batches, %s messages, mean size %.2f, '
+                     'overhead %.2fs/message, processing %.2fs/message, sizes %s',
+                     self.name, summary['batches'], summary['messages'],
+                     summary['mean_batch_size'], summary['overhead_per_message'],
+                     summary['processing_per_message'], dict(sorted(self.sizes.items())))
+
+    def publish(self) -> None:
+        put_metrics(self.metrics_namespace, dict(self.unpublished), Service=self.name)
+        self.unpublished.clear()
+
+
 class BaseMessageHandler:
     STRATEGY_OPTION = 'ours'
     game: Game
@@ -49,6 +266,12 @@ class BaseMessageHandler:
     def process_messages(self) -> List[DeleteMessageBatchRequestEntryTypeDef]:
         raise NotImplementedError
 
+    def flush(self, force: bool = False) -> None:  # pylint: disable=unused-argument
+        """Finish any work held back by earlier batches that's now due
+
+        Called between batches, and with force set on shutdown.
+        """
+
 
 class QueueHandler:
     common: SharedArgs
@@ -57,6 +280,9 @@ class QueueHandler:
 
     def __init__(self, common: SharedArgs) -> None:
         self.common = common
+        self.stats = BatchStats(self.__class__.__name__,
+                                metrics_namespace=common.metrics_namespace)
+        self._stopping = False
 
     @property
     def game_handlers(self) -> Dict[str, BaseMessageHandler]:
@@ -77,26 +303,59 @@ class QueueHandler:
     def run(self) -> None:
         sqs = boto3.resource('sqs')
         queue = sqs.get_queue_by_name(QueueName=self.common.queue)
-        while True:
-            messages = queue.receive_messages(
-                MaxNumberOfMessages=10,
-                MessageAttributeNames=['All'],
-                VisibilityTimeout=self.common.timeout
-            )
-            if not messages:
+        # Stop between batches on SIGTERM so held back work is flushed before we go
+        signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            if self.common.prefetch:
+                with MessagePrefetcher(self.connect, self.common.timeout,
+                                       self.common.batch_size, self.common.batch_wait,
+                                       self.common.prefetch) as prefetcher:
+                    while not self._stopping:
+                        self.process_batch(queue, prefetcher.get(MAX_WAIT_SECONDS))
+            else:
+                while not self._stopping:
+                    self.process_batch(queue, receive_batch(
+                        queue, self.common.timeout, self.common.batch_size,
+                        self.common.batch_wait))
+        finally:
+            self.flush(force=True)
+
+    def _terminate(self, signum: int, frame: Optional[FrameType]) -> None:  # pylint: disable=unused-argument
+        # Raising from here could interrupt a git command and leave its
+        # locks behind for the flush, so let the batch in hand finish
+        logging.info('Received signal %s, stopping after this batch', signum)
+        self._stopping = True
+
+    def connect(self) -> Queue:
+        return boto3.session.Session().resource('sqs').get_queue_by_name(
+            QueueName=self.common.queue)
+
+    def flush(self, force: bool = False) -> None:
+        for _, handler in self.game_handlers.items():
+            handler.flush(force)
+
+    def process_batch(self, queue: Queue, messages: List[Message]) -> None:
+        if not messages:
+            self.flush()
+            return
+        for message in messages:
+            game_id = message.message_attributes.get(  # type: ignore[union-attr,call-overload]
+                'GameId', {}).get('StringValue', None)
+            if game_id is None:
+                logging.error('GameId missing from MessageAttributes')
                 continue
-            for message in messages:
-                game_id = message.message_attributes.get(  # type: ignore[union-attr,call-overload]
-                    'GameId', {}).get('StringValue', None)
-                if game_id is None:
-                    logging.error('GameId missing from MessageAttributes')
-                    continue
-                self.append_message(game_id, message)
-
-            for _, handler in self.game_handlers.items():
-                with handler:
-                    processed = handler.process_messages()
-                    if processed:
-                        queue.delete_messages(
-                            Entries=processed
-                        )
+            self.append_message(game_id, message)
+
+        overhead = 0.0
+        processing = 0.0
+        for _, handler in self.game_handlers.items():
+            start = time.monotonic()
+            with handler:
+                ready = time.monotonic()
+                processed = handler.process_messages()
+                if processed:
+                    delete_messages(queue, processed)
+                done = time.monotonic()
+            overhead += (ready - start) + (time.monotonic() - done)
+            processing += done - ready
+        self.stats.record(len(messages), overhead, processing)
@@ -1,32 +1,130 @@
-from contextlib import contextmanager
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from functools import partial
+from itertools import batched, chain
+import json
+import logging
+import math
+from pathlib import Path, PurePosixPath
 import re
-from typing import Iterable, List, Optional, Generator, Union
+import sqlite3
+from threading import Lock
+from typing import Any, Iterable, List, Optional, Generator, Union, Dict, Set, Tuple, TypeVar
 
 from git import Repo, GitCommandError
 from git.objects.commit import Commit
+from git.objects.tree import Tree
 from git.refs import Head
+from git.util import hex_to_bin
 from .metadata import Netkan, Ckan
+from .utils import ParseCache, FileStamp, file_stamp
 
 
-class XkanRepo:
+XkanRepoT = TypeVar('XkanRepoT', bound='XkanRepo')
+
+
+class RepoSnapshot:
+
+    """
+    Derived state of a repo, saved in an SQLite file along with the
+    commit it describes
+
+    Each named snapshot is a set of JSON rows. On a cold start the
+    indexes load them and only apply the changes since that commit,
+    rather than reading every file again. Failures are logged and
+    treated as there being no snapshot.
+    """
+
+    FILENAME = 'netkan-snapshot.sqlite'
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, sha TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshot_rows (name TEXT NOT NULL, data TEXT NOT NULL)')
+        return conn
+
+    def load(self, name: str) -> Optional[Tuple[str, List[List[Any]]]]:
+        """The sha and rows of a snapshot, if there is one"""
+        if not self.path.exists():
+            return None
+        try:
+            with closing(self._connect()) as conn:
+                found = conn.execute('SELECT sha FROM snapshots WHERE name = ?', (name,)).fetchone()
+                if found is None:
+                    return None
+                return found[0], [json.loads(data) for data, in conn.execute(
+                    'SELECT data FROM snapshot_rows WHERE name = ?', (name,))]
+        except (sqlite3.Error, ValueError) as exc:
+            logging.warning('Failed to load %s snapshot from %s: %s', name, self.path, exc)
+            return None
+
+    def save(self, name: str, sha: str, rows: Iterable[List[Any]]) -> None:
+        try:
+            with closing(self._connect()) as conn:
+                # One transaction, so the rows and sha change together
+                with conn:
+                    conn.execute('DELETE FROM snapshot_rows WHERE name = ?', (name,))
+                    conn.executemany('INSERT INTO snapshot_rows VALUES (?, ?)',
+                                     ((name, json.dumps(row)) for row in rows))
+                    conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?)', (name, sha))
+        except sqlite3.Error as exc:
+            logging.warning('Failed to save %s snapshot to %s: %s', name, self.path, exc)
+
+
+class XkanRepo:  # pylint: disable=too-many-public-methods
 
     """
     Concantenates all common repo operations in one place
     """
     _primary_branch: str
-
-    def __init__(self, git_repo: Repo, game_id: Optional[str] = None) -> None:
+    _tree_blobs: Dict[str, str]
+    _tree_blobs_sha: Optional[str]
+    # One staging worktree per repo, so only one branch can use it at a time
+    _worktree_locks: Dict[Path, Lock] = {}
+    _worktree_locks_lock = Lock()
+
+    def __init__(self, git_repo: Repo, game_id: Optional[str] = None,
+                 object_reader: bool = False, snapshot_dir: Optional[Path] = None) -> None:
         self.git_repo = git_repo
         self.game_id = game_id
+        # Read metadata from the primary branch's git objects rather than the working tree
+        self.object_reader = object_reader
+        # Where snapshots outlive the clone, otherwise they go under .git
+        self.snapshot_dir = snapshot_dir
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__}({self.git_repo.__repr__()})>'
 
+    @property
+    def snapshot(self) -> RepoSnapshot:
+        if self.snapshot_dir:
+            return RepoSnapshot(Path(self.snapshot_dir,
+                                     f'{self.game_id}-{RepoSnapshot.FILENAME}'))
+        return RepoSnapshot(Path(self.git_repo.git_dir, RepoSnapshot.FILENAME))
+
+    def save_snapshot(self) -> None:
+        """Save derived state for the next process to start from"""
+
     def commit(self, files: List[Union[str, Path]], commit_message: str) -> Commit:
-        index = self.git_repo.index
-        index.add([x.as_posix() if isinstance(x, Path) else x for x in files])
-        return index.commit(commit_message)
+        """Commit these files to the current branch
+
+        GitPython's index.add and index.commit load, stat and rewrite
+        every entry and rebuild every tree in Python, so the cost grows
+        with the repo. Instead git update-index stages just these paths
+        (removing any that were deleted) and git write-tree only rebuilds
+        the trees containing them, reusing the index's cached trees for
+        the rest. The commit object is then made the same way
+        index.commit makes it.
+        """
+        git = self.git_repo.git
+        git.update_index('--add', '--remove', '--',
+                         *[x.as_posix() if isinstance(x, Path) else x for x in files])
+        tree = Tree(self.git_repo, hex_to_bin(git.write_tree()), path='')
+        return Commit.create_from_tree(self.git_repo, tree, commit_message, head=True)
 
     @property
     def active_branch(self) -> str:
@@ -75,6 +173,23 @@ class XkanRepo:
         self.git_repo.remotes.origin.pull(
             self.primary_branch, strategy_option=strategy_option)
 
+    def rebase_remote_primary(self) -> None:
+        # Replays our unpushed commits on top of the remote's instead of
+        # merging, keeping ours on conflicts ('theirs' is the side being
+        # replayed in a rebase)
+        self.git_repo.remotes.origin.pull(
+            self.primary_branch, rebase=True, strategy_option='theirs')
+
+    def unpushed_primary_commits(self) -> int:
+        try:
+            return sum(1 for _ in self.git_repo.iter_commits(
+                f'origin/{self.primary_branch}..{self.primary_branch}'))
+        except GitCommandError:
+            return 0
+
+    def unpushed_primary_paths(self) -> List[str]:
+        return self.changed_paths(f'origin/{self.primary_branch}', self.primary_branch) or []
+
     def push_remote_branch(self, branch_name: str) -> None:
         self.git_repo.remotes.origin.push(branch_name)
 
@@ -84,6 +199,78 @@ class XkanRepo:
     def close_repo(self) -> None:
         self.git_repo.close()
 
+    def head_sha(self) -> Optional[str]:
+        try:
+            return self.git_repo.head.commit.hexsha
+        except ValueError:
+            # No commits yet
+            return None
+
+    def read_sha(self) -> Optional[str]:
+        """The commit metadata is read from
+
+        HEAD normally, or the tip of the primary branch in object reader
+        mode, so that checking out other branches doesn't change what
+        we read.
+        """
+        if not self.object_reader:
+            return self.head_sha()
+        try:
+            return getattr(self.git_repo.heads, self.primary_branch).commit.hexsha
+        except (AttributeError, ValueError):
+            return None
+
+    def tree_blobs(self) -> Dict[str, str]:
+        """All the files at read_sha(), mapped to their blob shas
+
+        Listed with a single git ls-tree, and only again when the
+        commit changes.
+        """
+        sha = self.read_sha()
+        if getattr(self, '_tree_blobs', None) is None or sha != self._tree_blobs_sha:
+            blobs = {}
+            if sha:
+                for line in self.git_repo.git.ls_tree('-r', '-z', '--full-tree', sha).split('\0'):
+                    if line:
+                        meta, path = line.split('\t', 1)
+                        _, obj_type, blob_sha = meta.split(' ')
+                        if obj_type == 'blob':
+                            blobs[path] = blob_sha
+            self._tree_blobs = blobs
+            self._tree_blobs_sha = sha
+        return self._tree_blobs
+
+    def blob_sha(self, path: Path) -> Optional[str]:
+        if not self.git_repo.working_dir:
+            return None
+        try:
+            relative = path.relative_to(self.git_repo.working_dir).as_posix()
+        except ValueError:
+            return None
+        return self.tree_blobs().get(relative)
+
+    def read_blob(self, blob_sha: str) -> str:
+        # GitPython streams these through one long-lived `git cat-file --batch`
+        _, _, _, data = self.git_repo.git.get_object_data(blob_sha)
+        return data.decode('UTF-8')
+
+    def changed_paths(self, old_sha: str, new_sha: str) -> Optional[List[str]]:
+        """Paths that differ between two commits, relative to the repo root
+
+        Returns None if git can't tell us, for example because the older
+        commit is no longer in the repo. A shallow clone fetches the older
+        commit first if it's missing, as snapshots can come from other clones.
+        """
+        try:
+            if (Path(self.git_repo.git_dir, 'shallow').exists()
+                    and not self.git_repo.git.cat_file('-t', old_sha, with_exceptions=False)):
+                self.git_repo.git.fetch('--depth=1', 'origin', old_sha)
+            return [path for path in self.git_repo.git.diff(
+                        '--name-only', '--no-renames', '-z', old_sha, new_sha).split('\0')
+                    if path]
+        except GitCommandError:
+            return None
+
     @contextmanager
     def change_branch(self, branch_name: str) -> Generator[None, None, None]:
         """Change branch and return on exit of context
@@ -136,6 +323,75 @@ class XkanRepo:
             ).raise_if_error()
             self.checkout_branch(active_branch)
 
+    @property
+    def worktree_path(self) -> Path:
+        working_dir = Path(str(self.git_repo.working_dir))
+        return working_dir.with_name(f'{working_dir.name}-staging')
+
+    def _worktree(self: XkanRepoT) -> XkanRepoT:
+        path = self.worktree_path
+        if not path.exists():
+            # Drop the registration of any worktree that was deleted under us
+            self.git_repo.git.worktree('prune')
+            self.git_repo.git.worktree('add', '--detach', path.as_posix())
+        return self.__class__(Repo(path), game_id=self.game_id)
+
+    @contextmanager
+    def worktree_branch(self: XkanRepoT, branch_name: str) -> Generator[XkanRepoT, None, None]:
+        """Check out a branch in the staging worktree
+
+        Does what change_branch does, but in a second working tree next
+        to this one, which is kept and reused for later branches. The
+        main checkout stays on its branch throughout, so the working tree
+        isn't rewritten twice per staged commit and primary branch work
+        isn't interrupted. Yields a repo for the worktree; paths and
+        commits need to go through that.
+
+        with ckm.worktree_branch('test') as staging:
+            staging.commit([staging.mod_path('Mod') / 'Mod-1.0.ckan'], 'commit in branch test')
+        """
+        with self._worktree_locks_lock:
+            lock = self._worktree_locks.setdefault(self.worktree_path, Lock())
+        with lock:
+            worktree = self._worktree()
+            git = worktree.git_repo.git
+            try:
+                self.git_repo.remotes.origin.fetch(branch_name)
+                if branch_name not in self.git_repo.heads:
+                    self.git_repo.create_head(
+                        branch_name, getattr(self.git_repo.remotes.origin.refs, branch_name))
+            except (GitCommandError, AttributeError):
+                # Branch doesn't exist on remote, start it from where we are
+                if branch_name not in self.git_repo.heads:
+                    self.git_repo.create_head(branch_name)
+            # Throw away anything left behind by an earlier failure
+            git.clean('-fd')
+            git.checkout('--force', branch_name)
+            try:
+                yield worktree
+            finally:
+                try:
+                    worktree.git_repo.remotes.origin.pull(
+                        branch_name, strategy_option='ours'
+                    )
+                except GitCommandError:
+                    pass
+                worktree.git_repo.remotes.origin.push(
+                    f'{branch_name}:{branch_name}'
+                ).raise_if_error()
+                # Let go of the branch so it can be checked out elsewhere
+                git.checkout('--detach')
+                worktree.close_repo()
+
+
+NetkanCacheKey = Tuple[Union[Tuple[str, str], FileStamp], Optional[str]]
+
+
+def _parse_netkans(game_id: Optional[str],
+                   files: Iterable[Tuple[Path, Optional[str]]]) -> List[Netkan]:
+    # Runs in worker processes, so needs to be importable at module level
+    return [Netkan(path, contents=contents, game_id=game_id) for path, contents in files]
+
 
 class NetkanRepo(XkanRepo):
 
@@ -147,6 +403,12 @@ class NetkanRepo(XkanRepo):
     UNFROZEN_SUFFIX = 'netkan'
     FROZEN_SUFFIX = 'frozen'
     NETKAN_GLOB = f'**/*.{UNFROZEN_SUFFIX}'
+    # Shared by all instances, entries are keyed by path and blob sha or
+    # path, mtime and size, plus game
+    parse_cache: ParseCache[NetkanCacheKey, Netkan] = ParseCache()
+    _kref_index: Dict[Tuple[str, str], Set[str]]
+    _kref_index_sha: Optional[str]
+    _identifier_krefs: Dict[str, Tuple[str, str]]
 
     @property
     def nk_dir(self) -> Path:
@@ -160,20 +422,161 @@ class NetkanRepo(XkanRepo):
         return self.nk_dir.joinpath(f'{identifier}.{self.FROZEN_SUFFIX}')
 
     def all_nk_paths(self) -> Iterable[Path]:
+        if self.object_reader and self.git_repo.working_dir:
+            return sorted((Path(self.git_repo.working_dir, path)
+                           for path in self.tree_blobs()
+                           if path.startswith(f'{self.NETKAN_DIR}/')
+                           and path.endswith(f'.{self.UNFROZEN_SUFFIX}')),
+                          key=self._nk_sort)
         return sorted(self.nk_dir.glob(self.NETKAN_GLOB),
                       key=self._nk_sort)
 
     def nk_paths(self, identifiers: Iterable[str]) -> Iterable[Path]:
         return (self.nk_path(identifier) for identifier in identifiers)
 
-    def netkans(self) -> Iterable[Netkan]:
-        return (Netkan(f, game_id=self.game_id) for f in self.all_nk_paths())
+    def _netkan_source(self, path: Path) -> Tuple[NetkanCacheKey, Optional[str]]:
+        blob_sha = self.blob_sha(path) if self.object_reader else None
+        if blob_sha:
+            return ((str(path), blob_sha), self.game_id), blob_sha
+        return (file_stamp(path), self.game_id), None
+
+    def netkan(self, path: Path) -> Netkan:
+        key, blob_sha = self._netkan_source(path)
+        return self.parse_cache.get(
+            key, lambda: Netkan(path, contents=self.read_blob(blob_sha) if blob_sha else None,
+                                game_id=self.game_id))
+
+    def netkans(self, workers: int = 1) -> Iterable[Netkan]:
+        """All the netkans in the repo, sorted by identifier
+
+        With more than one worker, files that aren't in the parse cache
+        are parsed in chunks across a pool of processes, and the result
+        is a list rather than a lazy generator.
+        """
+        if workers <= 1:
+            return (self.netkan(f) for f in self.all_nk_paths())
+        sources = [(path, *self._netkan_source(path)) for path in self.all_nk_paths()]
+        netkans = [self.parse_cache.lookup(key) for _, key, _ in sources]
+        todo = [i for i, netkan in enumerate(netkans) if netkan is None]
+        if todo:
+            files = [(path, self.read_blob(blob_sha) if blob_sha else None)
+                     for path, _, blob_sha in (sources[i] for i in todo)]
+            # A few chunks per worker keeps them busy without much IPC overhead
+            chunk_size = math.ceil(len(files) / (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = executor.map(partial(_parse_netkans, self.game_id),
+                                      batched(files, chunk_size))
+                for i, netkan in zip(todo, chain.from_iterable(parsed)):
+                    self.parse_cache.put(sources[i][1], netkan)
+                    netkans[i] = netkan
+        return [netkan for netkan in netkans if netkan is not None]
+
+    @property
+    def kref_index(self) -> Dict[Tuple[str, str], Set[str]]:
+        """Identifiers of the netkans using each (kref_src, kref_id)
+
+        Built from every netkan the first time it's needed. When read_sha()
+        moves (e.g. after a pull) only the changed netkans are re-read.
+        The snapshot is saved whenever the index changes.
+        """
+        sha = self.read_sha()
+        if getattr(self, '_kref_index', None) is None:
+            self._kref_index = {}
+            self._identifier_krefs = {}
+            loaded = self.snapshot.load('kref_index')
+            if loaded:
+                self._kref_index_sha = loaded[0]
+                self._index_krefs_from(loaded[1])
+            else:
+                self._index_krefs(self.all_nk_paths())
+                self._kref_index_sha = sha
+                self.save_snapshot()
+        if sha != self._kref_index_sha:
+            changed = (self.changed_paths(self._kref_index_sha, sha)
+                       if self._kref_index_sha and sha else None)
+            if changed is None:
+                self._kref_index.clear()
+                self._identifier_krefs.clear()
+                self._index_krefs(self.all_nk_paths())
+            else:
+                self._index_krefs(
+                    Path(self.git_repo.working_dir or '.', path) for path in changed
+                    if path.startswith(f'{self.NETKAN_DIR}/')
+                    and path.endswith(f'.{self.UNFROZEN_SUFFIX}'))
+            self._kref_index_sha = sha
+            self.save_snapshot()
+        return self._kref_index
+
+    def _index_krefs_from(self, rows: Iterable[List[Any]]) -> None:
+        for identifier, kref_src, kref_id in rows:
+            kref = (kref_src, kref_id)
+            self._identifier_krefs[identifier] = kref
+            self._kref_index.setdefault(kref, set()).add(identifier)
+
+    def save_snapshot(self) -> None:
+        if getattr(self, '_kref_index', None) is not None and self._kref_index_sha:
+            self.snapshot.save('kref_index', self._kref_index_sha,
+                               ([identifier, *kref]
+                                for identifier, kref in self._identifier_krefs.items()))
+
+    def _index_krefs(self, paths: Iterable[Path]) -> None:
+        for path in paths:
+            identifier = path.stem
+            old_kref = self._identifier_krefs.pop(identifier, None)
+            if old_kref:
+                self._kref_index[old_kref].discard(identifier)
+                if not self._kref_index[old_kref]:
+                    del self._kref_index[old_kref]
+            exists = self.blob_sha(path) if self.object_reader else path.exists()
+            if exists:
+                netkan = self.netkan(path)
+                if netkan.kref_src and netkan.kref_id:
+                    kref = (netkan.kref_src, netkan.kref_id)
+                    self._identifier_krefs[identifier] = kref
+                    self._kref_index.setdefault(kref, set()).add(identifier)
+
+    def kref_netkans(self, kref_src: str, kref_id: str) -> List[Netkan]:
+        """The netkans whose $kref is #/ckan/<kref_src>/<kref_id>"""
+        return [self.netkan(self.nk_path(identifier))
+                for identifier in sorted(self.kref_index.get((kref_src, kref_id), ()),
+                                         key=str.casefold)]
 
     @staticmethod
     def _nk_sort(path: Path) -> str:
         return path.stem.casefold()
 
 
+class ModVersions:
+
+    """
+    The .ckan files of one mod and the highest stable and
+    prerelease versions among them
+    """
+
+    def __init__(self, files: List[Tuple[Path, Ckan.Version, bool]]) -> None:
+        self.files = files
+        self._highest = {
+            prerelease: max(((path, version)
+                             for path, version, is_prerelease in files
+                             if is_prerelease == prerelease),
+                            default=None,
+                            key=lambda f: f[1].key)
+            for prerelease in (False, True)
+        }
+
+    @classmethod
+    def from_ckans(cls, ckans: Iterable[Ckan]) -> 'ModVersions':
+        return cls([(ck.filename, ck.version, ck.is_prerelease) for ck in ckans])
+
+    def highest_path(self, prerelease: bool) -> Optional[Path]:
+        highest = self._highest[prerelease]
+        return highest[0] if highest else None
+
+    def highest_version(self, prerelease: bool) -> Optional[Ckan.Version]:
+        highest = self._highest[prerelease]
+        return highest[1] if highest else None
+
+
 class CkanMetaRepo(XkanRepo):
 
     """
@@ -182,13 +585,37 @@ class CkanMetaRepo(XkanRepo):
 
     CKANMETA_GLOB = '**/*.ckan'
     IDENTIFIER_PATTERN = re.compile('^[A-Za-z0-9][A-Za-z0-9-]+$')
+    # Shared by all instances, entries are keyed by path and blob sha or path, mtime and size
+    parse_cache: ParseCache[Union[Tuple[str, str], FileStamp], Ckan] = ParseCache()
+    _version_index: Dict[str, ModVersions]
+    _version_index_sha: Optional[str]
+    # Whether the index has changed since it was loaded or saved
+    _version_index_unsaved: bool
+    _mod_blobs: Dict[str, Dict[str, str]]
+    _mod_blobs_of: Dict[str, str]
 
     @property
     def ckm_dir(self) -> Path:
         return (Path(self.git_repo.working_dir)
                 if self.git_repo.working_dir else Path('.'))
 
+    def mod_blobs(self) -> Dict[str, Dict[str, str]]:
+        """The .ckan files at read_sha(), as {identifier: {path: blob sha}}"""
+        blobs = self.tree_blobs()
+        if getattr(self, '_mod_blobs_of', None) is not blobs:
+            mods: Dict[str, Dict[str, str]] = {}
+            for path, blob_sha in blobs.items():
+                if '/' in path and path.endswith('.ckan'):
+                    mods.setdefault(path.split('/', 1)[0], {})[path] = blob_sha
+            self._mod_blobs = mods
+            self._mod_blobs_of = blobs
+        return self._mod_blobs
+
     def identifiers(self) -> Iterable[str]:
+        if self.object_reader:
+            return (identifier for identifier, paths in self.mod_blobs().items()
+                    if self.IDENTIFIER_PATTERN.fullmatch(identifier)
+                    and any(path.count('/') == 1 for path in paths))
         return (path.stem for path in self.ckm_dir.iterdir()
                 if path.is_dir()
                 and self.IDENTIFIER_PATTERN.fullmatch(path.stem)
@@ -203,19 +630,86 @@ class CkanMetaRepo(XkanRepo):
     def mod_path(self, identifier: str) -> Path:
         return self.ckm_dir.joinpath(identifier)
 
+    def ckan(self, path: Path) -> Ckan:
+        blob_sha = self.blob_sha(path) if self.object_reader else None
+        if blob_sha:
+            return self.parse_cache.get(
+                (str(path), blob_sha), lambda: Ckan(path, contents=self.read_blob(blob_sha)))
+        return self.parse_cache.get(file_stamp(path), lambda: Ckan(path))
+
     def ckans(self, identifier: str) -> Iterable[Ckan]:
-        return (Ckan(f) for f in self.mod_path(identifier).glob(self.CKANMETA_GLOB))
+        if self.object_reader:
+            return (self.ckan(self.ckm_dir.joinpath(path))
+                    for path in self.mod_blobs().get(identifier, {}))
+        return (self.ckan(f) for f in self.mod_path(identifier).glob(self.CKANMETA_GLOB))
+
+    @property
+    def version_index(self) -> Dict[str, ModVersions]:
+        """Versions of the mods we've looked up, kept in step with HEAD
+
+        Mods are scanned the first time they're asked for. When read_sha() moves
+        (pull, commit, checkout), only the mods with changed files are
+        dropped and rescanned on their next lookup, everything else
+        is answered from memory. A new process starts from the last
+        saved snapshot, if any.
+        """
+        head = self.read_sha()
+        if getattr(self, '_version_index', None) is None:
+            self._version_index = {}
+            self._version_index_sha = head
+            self._version_index_unsaved = False
+            loaded = self.snapshot.load('version_index')
+            if loaded:
+                self._version_index_sha = loaded[0]
+                self._version_index_from(loaded[1])
+        if head != self._version_index_sha:
+            changed = (self.changed_paths(self._version_index_sha, head)
+                       if self._version_index_sha and head else None)
+            if changed is None:
+                self._version_index.clear()
+            else:
+                for identifier in {PurePosixPath(path).parts[0] for path in changed}:
+                    self._version_index.pop(identifier, None)
+            self._version_index_unsaved = True
+        self._version_index_sha = head
+        return self._version_index
+
+    def _version_index_from(self, rows: Iterable[List[Any]]) -> None:
+        files: Dict[str, List[Tuple[Path, Ckan.Version, bool]]] = {}
+        for identifier, path, version, prerelease in rows:
+            mod_files = files.setdefault(identifier, [])
+            # Mods without any files have a single row of nulls
+            if path is not None:
+                mod_files.append((self.ckm_dir.joinpath(path), Ckan.Version(version), prerelease))
+        self._version_index.update((identifier, ModVersions(mod_files))
+                                   for identifier, mod_files in files.items())
+
+    def save_snapshot(self) -> None:
+        if (getattr(self, '_version_index', None) is not None and self._version_index_sha
+                and self._version_index_unsaved):
+            self._version_index_unsaved = False
+            self.snapshot.save('version_index', self._version_index_sha, (
+                [identifier, *row]
+                for identifier, versions in self._version_index.items()
+                for row in ([[path.relative_to(self.ckm_dir).as_posix(), version.string, prerelease]
+                             for path, version, prerelease in versions.files]
+                            or [[None, None, None]])))
+
+    def mod_versions(self, identifier: str) -> ModVersions:
+        index = self.version_index
+        versions = index.get(identifier)
+        if versions is None:
+            versions = ModVersions.from_ckans(self.ckans(identifier))
+            index[identifier] = versions
+            self._version_index_unsaved = True
+        return versions
 
     def highest_version_module(self, identifier: str, prerelease: bool) -> Optional[Ckan]:
-        return max((ck for ck in self.ckans(identifier)
-                    if ck.is_prerelease == prerelease),
-                   default=None,
-                   key=lambda ck: ck.version if ck else Ckan.Version('0'))
+        path = self.mod_versions(identifier).highest_path(prerelease)
+        return self.ckan(path) if path else None
 
     def highest_version(self, identifier: str) -> Optional[Ckan.Version]:
-        highest = self.highest_version_module(identifier, False)
-        return highest.version if highest else None
+        return self.mod_versions(identifier).highest_version(False)
 
     def highest_version_prerelease(self, identifier: str) -> Optional[Ckan.Version]:
-        highest = self.highest_version_module(identifier, True)
-        return highest.version if highest else None
+        return self.mod_versions(identifier).highest_version(True)
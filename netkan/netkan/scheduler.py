@@ -1,13 +1,18 @@
 import datetime
 import logging
-from typing import List, Dict, Any, TYPE_CHECKING
+import resource
+import time
+from collections import Counter
+from typing import Iterable, List, Dict, Any, Optional, Tuple, TYPE_CHECKING
 
 import boto3
 import requests
+from botocore.config import Config
 
 from .repos import NetkanRepo, CkanMetaRepo
 from .metadata import Netkan
-from .common import sqs_batch_entries, github_limit_remaining
+from .status import ModStatus
+from .common import sqs_message_size, sqs_send_messages, github_limit_remaining
 from .cli.common import SharedArgs
 
 if TYPE_CHECKING:
@@ -18,20 +23,151 @@ else:
     SendMessageBatchRequestEntryTypeDef = object
 
 
+class AdaptiveSchedule:
+
+    """
+    Picks the mods due an inflation this run, checking each one at an
+    interval set by how recently it last changed
+
+    A mod's last change is the later of its release date and when we
+    last indexed it. Recently changed mods are checked every run, quiet
+    ones less often, mods whose last inflation failed no more than every
+    FAILING_HOURS, and quiet mods on rate limited hosts less often again.
+    Mods we've never inflated are always due. If more are due than
+    max_scheduled, the most overdue go first and the rest wait for the
+    next run.
+    """
+
+    # (most days since the last change, hours between checks, reason)
+    TIERS: List[Tuple[Optional[int], int, str]] = [
+        (7, 0, 'active'),
+        (30, 2, 'recent'),
+        (180, 6, 'quiet'),
+        (None, 24, 'dormant'),
+    ]
+    FAILING_HOURS = 6
+    # Quiet mods on these hosts cost API calls we're rate limited on
+    HOST_FACTORS = {'github': 2, 'gitlab': 2}
+
+    def __init__(self, max_scheduled: int = 0,
+                 now: Optional[datetime.datetime] = None) -> None:
+        self.max_scheduled = max_scheduled
+        self.now = now or datetime.datetime.now(datetime.timezone.utc)
+        self.report: Counter[str] = Counter()
+
+    def interval(self, netkan: Netkan, status: ModStatus) -> Tuple[datetime.timedelta, str]:
+        changes = [dttm for dttm in (getattr(status, 'release_date', None),
+                                     getattr(status, 'last_indexed', None))
+                   if dttm]
+        days = (self.now - max(changes)).days if changes else None
+        hours, reason = self.TIERS[-1][1:]
+        for max_days, tier_hours, tier_reason in self.TIERS:
+            if max_days is not None and days is not None and days <= max_days:
+                hours, reason = tier_hours, tier_reason
+                break
+        if hours:
+            hours *= self.HOST_FACTORS.get(netkan.kref_src or '', 1)
+        if getattr(status, 'success', True) is False:
+            hours = max(hours, self.FAILING_HOURS)
+            reason = 'failing'
+        return datetime.timedelta(hours=hours), reason
+
+    def plan(self, netkans: Iterable[Netkan],
+             statuses: Dict[str, ModStatus]) -> List[Netkan]:
+        """The netkans to schedule this run, recording why in report"""
+        due: List[Tuple[float, str, Netkan]] = []
+        for netkan in netkans:
+            status = statuses.get(netkan.identifier)
+            last_inflated = getattr(status, 'last_inflated', None) if status else None
+            if status is None or last_inflated is None:
+                due.append((float('inf'), 'new', netkan))
+                continue
+            interval, reason = self.interval(netkan, status)
+            elapsed = self.now - last_inflated
+            if elapsed >= interval:
+                overdue = (elapsed / interval) if interval else float('inf')
+                due.append((overdue, reason, netkan))
+            else:
+                self.report['not due'] += 1
+        if self.max_scheduled and len(due) > self.max_scheduled:
+            due.sort(key=lambda entry: entry[0], reverse=True)
+            self.report['over budget'] += len(due) - self.max_scheduled
+            due = due[:self.max_scheduled]
+        self.report.update(reason for _, reason, _ in due)
+        return [netkan for _, _, netkan in due]
+
+
+class HostInterleave:
+
+    """
+    Orders netkans so each host's mods are spread evenly through the run
+
+    In alphabetical order the inflator hits whichever host owns a run of
+    names in bursts. Instead hosts take turns, weighted by how many mods
+    each has (a smooth weighted round robin), so every host sees a steady
+    rate. GitHub mods beyond what the API budget covers trail the rest of
+    the run, giving the rate limit time to reset.
+    """
+
+    # Roughly how many API calls the inflator makes for a GitHub mod
+    GITHUB_CALLS_PER_MOD = 3
+
+    def __init__(self, github_budget: Optional[int] = None) -> None:
+        self.github_budget = github_budget
+
+    def github_covered(self, count: int) -> int:
+        """How many GitHub mods the budget covers"""
+        if self.github_budget is None:
+            return count
+        return min(count, max(self.github_budget, 0) // self.GITHUB_CALLS_PER_MOD)
+
+    def order(self, netkans: Iterable[Netkan]) -> List[Netkan]:
+        hosts: Dict[str, List[Netkan]] = {}
+        for netkan in netkans:
+            hosts.setdefault(netkan.kref_src or '', []).append(netkan)
+        trailing: List[Netkan] = []
+        if 'github' in hosts:
+            covered = self.github_covered(len(hosts['github']))
+            hosts['github'], trailing = hosts['github'][:covered], hosts['github'][covered:]
+        weights = {host: len(mods) for host, mods in hosts.items() if mods}
+        total = sum(weights.values())
+        current = dict.fromkeys(weights, 0)
+        remaining = {host: iter(mods) for host, mods in hosts.items()}
+        ordered: List[Netkan] = []
+        # Over total turns each host comes up exactly as many times as it has mods
+        for _ in range(total):
+            for host, weight in weights.items():
+                current[host] += weight
+            host = max(current, key=lambda h: current[h])
+            current[host] -= total
+            ordered.append(next(remaining[host]))
+        return ordered + trailing
+
+
 class NetkanScheduler:
 
     def __init__(self, common: SharedArgs, queue: str, github_token: str, game_id: str,
-                 nonhooks_group: bool = False, webhooks_group: bool = False) -> None:
+                 nonhooks_group: bool = False, webhooks_group: bool = False,
+                 parse_workers: int = 1, adaptive: bool = False,
+                 max_scheduled: int = 0, send_workers: int = 1,
+                 interleave: bool = False, dry_run: bool = False) -> None:
         self.common = common
         self.game_id = game_id
         self.nonhooks_group = nonhooks_group
         self.webhooks_group = webhooks_group
         self.github_token = github_token
+        self.parse_workers = parse_workers
+        self.adaptive = adaptive
+        self.max_scheduled = max_scheduled
+        self.send_workers = send_workers
+        self.interleave = interleave
 
         # FUTURE: This isn't super neat, do something better.
         self.queue_url = 'test_url'
-        if queue != 'TestyMcTestFace':
-            self.client = boto3.client('sqs')
+        if queue != 'TestyMcTestFace' and not dry_run:
+            # Enough pooled connections for every sender to have one
+            self.client = boto3.client(
+                'sqs', config=Config(max_pool_connections=max(10, send_workers)))
             sqs = boto3.resource('sqs')
             self.queue = sqs.get_queue_by_name(QueueName=queue)
             self.queue_url = self.queue.url
@@ -53,13 +189,93 @@ class NetkanScheduler:
     def _in_group(self, netkan: Netkan) -> bool:
         return self.webhooks_group if netkan.hook_only() else self.nonhooks_group
 
+    def statuses(self, identifiers: List[str]) -> Dict[str, ModStatus]:
+        game_id = self.game_id.lower()
+        return {status.ModIdentifier: status
+                for status in ModStatus.batch_get([(ident, game_id) for ident in identifiers])}
+
+    def group_netkans(self) -> Iterable[Netkan]:
+        return (nk for nk in self.nk_repo.netkans(workers=self.parse_workers)
+                if self._in_group(nk))
+
+    def scheduled_netkans(self) -> Iterable[Netkan]:
+        return self.select_netkans(self.group_netkans())
+
+    def select_netkans(self, netkans: Iterable[Netkan]) -> Iterable[Netkan]:
+        if self.adaptive:
+            netkans = list(netkans)
+            schedule = AdaptiveSchedule(self.max_scheduled)
+            netkans = schedule.plan(netkans, self.statuses([nk.identifier for nk in netkans]))
+            logging.info('Scheduling %s mods for %s: %s', len(netkans), self.game_id,
+                         ', '.join(f'{count} {reason}'
+                                   for reason, count in schedule.report.most_common()))
+        if self.interleave:
+            netkans = HostInterleave(
+                None if self.common.dev else github_limit_remaining(self.github_token)
+            ).order(netkans)
+        return netkans
+
     def schedule_all_netkans(self) -> None:
         repo = self.ckm_repo
         messages = (nk.sqs_message(repo.highest_version(nk.identifier),
                                    repo.highest_version_prerelease(nk.identifier))
-                    for nk in self.nk_repo.netkans() if self._in_group(nk))
-        for batch in sqs_batch_entries(messages):
-            self.client.send_message_batch(**self.sqs_batch_attrs(batch))
+                    for nk in self.scheduled_netkans())
+        start = time.monotonic()
+        # The inflators take messages in the order they reach the queue, so
+        # an interleaved run has to be sent in order, one batch at a time.
+        # Otherwise each mod is scheduled once per run and the order
+        # batches arrive in doesn't matter.
+        counts = sqs_send_messages(self.client, self.queue_url, messages,
+                                   workers=1 if self.interleave else self.send_workers)
+        logging.info('Sent %s messages to %s in %.1fs (%s retried, %s failed)',
+                     counts['sent'], self.queue_url, time.monotonic() - start,
+                     counts['retried'], counts['failed'])
+        # Every mod's versions have been read, the next run can start from here
+        repo.save_snapshot()
+
+    def plan(self) -> Dict[str, Any]:
+        """
+        Build the messages a run would send without sending them
+
+        Returns what each would carry for each netkan, and how long each
+        stage took along with the process's peak memory after it.
+        """
+        stages: Dict[str, Dict[str, float]] = {}
+        start = time.perf_counter()
+
+        def stage(name: str) -> None:
+            nonlocal start
+            now = time.perf_counter()
+            stages[name] = {
+                'seconds': round(now - start, 3),
+                # Kilobytes on Linux
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+            start = now
+
+        netkans = list(self.group_netkans())
+        stage('parse')
+        netkans = list(self.select_netkans(netkans))
+        stage('select')
+        repo = self.ckm_repo
+        versions = [(nk, repo.highest_version(nk.identifier),
+                     repo.highest_version_prerelease(nk.identifier))
+                    for nk in netkans]
+        stage('versions')
+        planned: List[Dict[str, Any]] = [{
+            'identifier': nk.identifier,
+            'group': 'webhooks' if nk.hook_only() else 'nonhooks',
+            'high_version': str(high_ver) if high_ver else None,
+            'high_version_prerelease': str(high_ver_pre) if high_ver_pre else None,
+            'message_size': sqs_message_size(nk.sqs_message(high_ver, high_ver_pre)),
+        } for nk, high_ver, high_ver_pre in versions]
+        stage('messages')
+        return {
+            'game_id': self.game_id,
+            'netkans': planned,
+            'message_bytes': sum(entry['message_size'] for entry in planned),
+            'stages': stages,
+        }
 
     @staticmethod
     def cpu_credits(cloudwatch: CloudWatchClient, instance_id: str,
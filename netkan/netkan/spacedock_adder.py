@@ -69,15 +69,16 @@ class SpaceDockAdder:
 
         # Create and checkout branch
         branch_name = f"add/{netkan[0].get('identifier')}"
-        with self.nk_repo.change_branch(branch_name):
+        with self.nk_repo.worktree_branch(branch_name) as staging_repo:
             # Create file
-            netkan_path.write_text(self.yaml_dump(netkan))
+            staged_path = staging_repo.nk_path(ident)
+            staged_path.write_text(self.yaml_dump(netkan))
 
             # Add netkan to branch
-            self.nk_repo.git_repo.index.add([netkan_path.as_posix()])
+            staging_repo.git_repo.index.add([staged_path.as_posix()])
 
             # Commit
-            self.nk_repo.git_repo.index.commit(
+            staging_repo.git_repo.index.commit(
                 self.COMMIT_TEMPLATE.safe_substitute(
                     defaultdict(lambda: '', self.info)),
                 author=git.Actor(self.info.get('username'), self.info.get('email')))
@@ -1,21 +1,40 @@
 import logging
 import subprocess
+from collections import OrderedDict
+from collections.abc import Hashable
 from pathlib import Path
-from typing import Union
+from threading import Lock
+from typing import Any, Union, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
 from importlib.resources import files
 
 from git import Repo
 
 
-def init_repo(metadata: str, path: str, deep_clone: bool) -> Repo:
+def init_repo(metadata: str, path: str, deep_clone: bool,
+              blobless: bool = False, sparse_paths: Optional[List[str]] = None) -> Repo:
+    """Clone a repo, or open it if we already have
+
+    blobless makes a partial clone that fetches file contents as they're
+    checked out or read rather than up front. sparse_paths limits the
+    checkout to these gitignore style patterns, for commands that only
+    touch part of the repo.
+    """
     clone_path = Path(path)
     if not clone_path.exists():
         logging.info('Cloning %s', metadata)
-        repo = (Repo.clone_from(metadata, clone_path)
-                if deep_clone else
-                Repo.clone_from(metadata, clone_path, depth=1))
+        options: Dict[str, Any] = {}
+        if not deep_clone:
+            options['depth'] = 1
+        if blobless:
+            options['filter'] = 'blob:none'
+        if sparse_paths:
+            options['no_checkout'] = True
+        repo = Repo.clone_from(metadata, clone_path, **options)
     else:
         repo = Repo(clone_path)
+    if sparse_paths:
+        repo.git.sparse_checkout('set', '--no-cone', *sparse_paths)
+        repo.git.checkout(repo.active_branch.name)
     return repo
 
 
@@ -48,3 +67,68 @@ def repo_file_add_or_changed(repo: Repo, filename: Union[str, Path]) -> bool:
 
 def legacy_read_text(pkg: str, resource: str) -> str:
     return files(pkg).joinpath(resource).read_text()
+
+
+# Path, mtime_ns and size
+FileStamp = Tuple[str, int, int]
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class ParseCache(Generic[K, V]):
+
+    """
+    Bounded LRU cache of parsed metadata objects
+
+    Keys should change whenever the underlying file does, e.g. via
+    file_stamp or a git blob sha, so stale entries simply age out.
+    """
+
+    def __init__(self, maxsize: int = 20000) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[K, V]' = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f'<{self.__class__.__name__}({len(self)}/{self.maxsize}, '
+                f'hits={self.hits}, misses={self.misses})>')
+
+    def get(self, key: K, parse: Callable[[], V]) -> V:
+        val = self.lookup(key)
+        if val is None:
+            # Parse outside the lock, worst case two threads parse the same file
+            val = parse()
+            self.put(key, val)
+        return val
+
+    def lookup(self, key: K) -> Optional[V]:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: K, val: V) -> None:
+        with self._lock:
+            self._entries[key] = val
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def file_stamp(path: Path) -> FileStamp:
+    stat = path.stat()
+    return (str(path), stat.st_mtime_ns, stat.st_size)
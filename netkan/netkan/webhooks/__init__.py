@@ -39,6 +39,7 @@ def create_app() -> NetkanWebhooks:
         ckanmeta_remotes=os.environ.get('CKANMETA_REMOTES', ''),
         inf_queue_names=os.environ.get('INFLATION_SQS_QUEUES', ''),
         add_queue_name=os.environ.get('ADD_SQS_QUEUE', ''),
-        mir_queue_name=os.environ.get('MIRROR_SQS_QUEUE', '')
+        mir_queue_name=os.environ.get('MIRROR_SQS_QUEUE', ''),
+        snapshot_dir=os.environ.get('SNAPSHOT_DIR', '')
     )
     return NetkanWebhooks()
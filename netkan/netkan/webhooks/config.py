@@ -25,7 +25,8 @@ class WebhooksConfig:
     # its properties, and that requires a temporary 'empty' state.
     def setup(self, ssh_key: str, secret: str,
               netkan_remotes: str, ckanmeta_remotes: str,
-              inf_queue_names: str, add_queue_name: str, mir_queue_name: str) -> None:
+              inf_queue_names: str, add_queue_name: str, mir_queue_name: str,
+              snapshot_dir: str = '') -> None:
 
         self.secret = secret
         self.common = SharedArgs()
@@ -34,6 +35,7 @@ class WebhooksConfig:
         self.common.netkan_remotes = tuple(netkan_remotes.split(' '))
         self.common.inflation_queues = tuple(inf_queue_names.split(' '))
         self.common.deep_clone = False
+        self.common.snapshot_dir = snapshot_dir
         self._add_queue_name = add_queue_name
         self._mir_queue_name = mir_queue_name
 
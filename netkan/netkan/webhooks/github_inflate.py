@@ -3,7 +3,7 @@ from pathlib import Path
 from typing import List, Tuple, Iterable, Dict, Any, Set, Union
 from flask import Blueprint, current_app, request, jsonify, Response
 
-from ..common import netkans, sqs_batch_entries, pull_all
+from ..common import netkans, sqs_send_messages, pull_all
 from ..repos import NetkanRepo
 from ..status import ModStatus
 from .github_utils import signature_required
@@ -65,14 +65,13 @@ def inflate(ids: Iterable[str], game_id: str) -> None:
         # Make sure our NetKAN and CKAN-meta repos are up to date
         pull_all(game.repos)
         repo = game.ckanmeta_repo
-        messages = (nk.sqs_message(repo.highest_version(nk.identifier),
+        messages = [nk.sqs_message(repo.highest_version(nk.identifier),
                                    repo.highest_version_prerelease(nk.identifier))
-                    for nk in netkans(str(game.netkan_repo.git_repo.working_dir), ids, game_id))
-        for batch in sqs_batch_entries(messages):
-            current_config.client.send_message_batch(
-                QueueUrl=current_config.inflation_queue(game_id).url,
-                Entries=batch
-            )
+                    for nk in netkans(str(game.netkan_repo.git_repo.working_dir), ids, game_id)]
+        if messages:
+            sqs_send_messages(current_config.client,
+                              current_config.inflation_queue(game_id).url, messages)
+        repo.save_snapshot()
 
 
 def ends_with_frozen(filename: str) -> bool:
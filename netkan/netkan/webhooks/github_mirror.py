@@ -5,7 +5,7 @@ from typing import Tuple, List, Iterable, Dict, Any, Set, Union, TYPE_CHECKING
 from flask import Blueprint, current_app, request, jsonify, Response
 
 from .github_utils import signature_required
-from ..common import sqs_batch_entries
+from ..common import sqs_send_messages
 from .config import current_config
 
 if TYPE_CHECKING:
@@ -34,14 +34,10 @@ def mirror_hook(game_id: str) -> Tuple[Union[Response, str], int]:
     if not commits:
         current_app.logger.info('No commits received')
         return jsonify({'message': 'No commits received'}), 200
-    # Submit mirroring requests to queue in batches of <=10
-    messages = (batch_message(p, game_id) for p in paths_from_commits(commits))
-    for batch in sqs_batch_entries(messages):
-        current_app.logger.info(f'Queueing mirroring request batch: {batch}')
-        current_config.client.send_message_batch(
-            QueueUrl=current_config.mirror_queue.url,
-            Entries=batch
-        )
+    # Submit mirroring requests to queue in batches
+    messages = [batch_message(p, game_id) for p in paths_from_commits(commits)]
+    current_app.logger.info(f'Queueing mirroring requests: {messages}')
+    sqs_send_messages(current_config.client, current_config.mirror_queue.url, messages)
     return '', 204
 
 
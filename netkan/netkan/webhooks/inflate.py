@@ -1,7 +1,7 @@
 from typing import Tuple
 from flask import Blueprint, current_app, request
 
-from ..common import netkans, sqs_batch_entries, pull_all
+from ..common import netkans, sqs_send_messages, pull_all
 from .config import current_config
 
 
@@ -23,14 +23,11 @@ def inflate_hook(game_id: str) -> Tuple[str, int]:
     # Make sure our NetKAN and CKAN-meta repos are up to date
     pull_all(game.repos)
     repo = game.ckanmeta_repo
-    messages = (nk.sqs_message(repo.highest_version(nk.identifier),
+    messages = [nk.sqs_message(repo.highest_version(nk.identifier),
                                repo.highest_version_prerelease(nk.identifier))
-                for nk in netkans(str(game.netkan_repo.git_repo.working_dir), ids, game_id=game_id))
-    for batch in sqs_batch_entries(messages):
-        current_app.logger.info(
-            f'Queueing inflation request batch: {batch}')
-        current_config.client.send_message_batch(
-            QueueUrl=current_config.inflation_queue(game_id).url,
-            Entries=batch
-        )
+                for nk in netkans(str(game.netkan_repo.git_repo.working_dir), ids, game_id=game_id)]
+    current_app.logger.info(f'Queueing inflation requests: {messages}')
+    sqs_send_messages(current_config.client,
+                      current_config.inflation_queue(game_id).url, messages)
+    repo.save_snapshot()
     return '', 204
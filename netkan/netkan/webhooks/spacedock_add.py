@@ -5,7 +5,7 @@ from typing import Tuple, TYPE_CHECKING
 from flask import Blueprint, current_app, request
 from werkzeug.datastructures import ImmutableMultiDict
 
-from ..common import sqs_batch_entries
+from ..common import sqs_send_messages
 from .config import current_config
 
 if TYPE_CHECKING:
@@ -34,14 +34,10 @@ spacedock_add = Blueprint(
 #     site_name:         SpaceDock
 @spacedock_add.route('/add/<game_id>', methods=['POST'])
 def add_hook(game_id: str) -> Tuple[str, int]:
-    # Submit add requests to queue in batches of <=10
+    # Submit add requests to queue in batches
     messages = [batch_message(request.form, game_id)]
-    for batch in sqs_batch_entries(messages):
-        current_app.logger.info(f'Queueing add request batch: {batch}')
-        current_config.client.send_message_batch(
-            QueueUrl=current_config.add_queue.url,
-            Entries=batch
-        )
+    current_app.logger.info(f'Queueing add requests: {messages}')
+    sqs_send_messages(current_config.client, current_config.add_queue.url, messages)
     return '', 204
 
 
@@ -1,7 +1,7 @@
 from typing import Tuple, List
 from flask import Blueprint, current_app, request
 
-from ..common import sqs_batch_entries, pull_all
+from ..common import sqs_send_messages, pull_all
 from ..metadata import Netkan
 from .config import current_config
 
@@ -48,15 +48,13 @@ def inflate_hook(game_id: str) -> Tuple[str, int]:
         messages = (nk.sqs_message(repo.highest_version(nk.identifier),
                                    repo.highest_version_prerelease(nk.identifier))
                     for nk in nks)
-        for batch in sqs_batch_entries(messages):
-            current_config.client.send_message_batch(
-                QueueUrl=current_config.inflation_queue(game_id).url,
-                Entries=batch
-            )
+        sqs_send_messages(current_config.client,
+                          current_config.inflation_queue(game_id).url, messages)
+        # So the versions looked up carry over to the next process
+        repo.save_snapshot()
         return '', 204
     return 'No such module', 404
 
 
 def find_netkans(sd_id: str, game_id: str) -> List[Netkan]:
-    all_nk = current_config.common.game(game_id).netkan_repo.netkans()
-    return [nk for nk in all_nk if nk.kref_src == 'spacedock' and nk.kref_id == sd_id]
+    return current_config.common.game(game_id).netkan_repo.kref_netkans('spacedock', sd_id)
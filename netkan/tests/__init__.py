@@ -8,7 +8,10 @@ from .repos import *
 from .scheduler import *
 from .utils import *
 from .csharp_compat import *
+from .download_cache import *
+from .queue_handler import *
 from .auto_freezer import *
 from .spacedock_adder import *
 from .status import *
 from .webhooks import *
+from .download_counter import *
@@ -129,3 +129,14 @@ class TestGame(SharedArgsHarness):
         path = f'{self.tmpdir.name}/upstream/netkan'
         self.assertEqual(
             Game('ksp2', self.shared_args).netkan_remote, path)
+
+    @mock.patch('netkan.cli.common.init_repo')
+    def test_sparse_profile(self, mocked_init):
+        self.shared_args.sparse_checkout = True
+        self.shared_args.sparse_profile = 'download-counter'
+        game = Game('ksp', self.shared_args)
+        game.init_repo('remote', 'CKAN-meta')
+        self.assertEqual(mocked_init.call_args.args[-1], ['/download_counts.json'])
+        # Everything else gets the whole tree
+        game.init_repo('remote', 'NetKAN')
+        self.assertIsNone(mocked_init.call_args.args[-1])
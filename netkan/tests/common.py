@@ -114,6 +114,7 @@ class SharedArgsHarness(TestCase, SharedArgsMixin):
                 'StringValue': '2019-06-24T19:06:14', 'DataType': 'String'},
             'ModIdentifier': {
                 'StringValue': 'DogeCoinFlag', 'DataType': 'String'},
+            'GameId': {'StringValue': 'KSP', 'DataType': 'String'},
             'Staged': {'StringValue': str(staged), 'DataType': 'String'},
             'Success': {'StringValue': 'True', 'DataType': 'String'},
             'FileName': {
@@ -0,0 +1,84 @@
+# pylint: disable-all
+# flake8: noqa
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from netkan.download_cache import DownloadCacheIndex
+from netkan.metadata import Ckan
+
+
+class TestDownloadCacheIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        self.index = DownloadCacheIndex(self.root)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, name, mtime=None):
+        path = self.root.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'data')
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_prefix(self):
+        self.assertEqual(DownloadCacheIndex.prefix('3C69B375-AwesomeMod-1.0.0.zip'), '3C69B375')
+        self.assertIsNone(DownloadCacheIndex.prefix('3C69B375-AwesomeMod-1.0.0.zip.sha1'))
+        self.assertIsNone(DownloadCacheIndex.prefix('3C69B375.zip'))
+        self.assertIsNone(DownloadCacheIndex.prefix('3C69B375-AwesomeMod-1.0.0.zip.part'))
+        self.assertIsNone(DownloadCacheIndex.prefix('3C69B375-AwesomeMod-1.0.0.tmp'))
+        self.assertIsNone(DownloadCacheIndex.prefix('not-hex1-AwesomeMod-1.0.0.zip'))
+
+    def test_skips_partial_downloads(self):
+        done = self.touch('3C69B375-AwesomeMod-1.0.0.zip', mtime=1000)
+        self.touch('3C69B375-AwesomeMod-1.0.0.zip.part', mtime=2000)
+        self.touch('downloading/3C69B375-AwesomeMod-1.0.0.zip', mtime=2000)
+        self.assertEqual(self.index.find('3C69B375'), done)
+
+    def test_missing_root(self):
+        index = DownloadCacheIndex(self.root.joinpath('missing'))
+        self.assertIsNone(index.find('3C69B375'))
+
+    def test_find_archives(self):
+        zip_file = self.touch('3C69B375-AwesomeMod-1.0.0.zip')
+        self.touch('3C69B375-AwesomeMod-1.0.0.zip.sha256')
+        tar_file = self.touch('nested/25B8A610-NASA-CountDown-1.3.9.1.tar.gz')
+        self.assertEqual(self.index.find('3C69B375'), zip_file)
+        self.assertEqual(self.index.find('25B8A610'), tar_file)
+        self.assertEqual(self.index.find_entry('3C69B375')[1], 4)
+        self.assertIsNone(self.index.find('DEADBEEF'))
+
+    def test_newest_first(self):
+        self.touch('3C69B375-AwesomeMod-1.0.0.zip', mtime=1000)
+        newer = self.touch('3C69B375-AwesomeMod-1.0.0.tar', mtime=2000)
+        self.assertEqual(self.index.find('3C69B375'), newer)
+
+    def test_follows_changes(self):
+        old = self.touch('3C69B375-AwesomeMod-1.0.0.zip')
+        self.assertEqual(self.index.find('3C69B375'), old)
+        scans = self.index.scans
+        self.assertEqual(self.index.find('3C69B375'), old)
+        self.assertEqual(self.index.scans, scans)
+
+        old.unlink()
+        self.assertIsNone(self.index.find('3C69B375'))
+        new = self.touch('sub/25B8A610-NASA-CountDown-1.3.9.1.zip')
+        self.assertEqual(self.index.find('25B8A610'), new)
+
+    def test_ckan_cache_find_file(self):
+        ckan = Ckan(contents="""{
+            "identifier": "AwesomeMod",
+            "version":    "1.0.0",
+            "download":   "https://github.com/AwesomeModder/AwesomeMod/releases/download/1.0.0/AwesomeMod.zip"
+        }""")
+        cached = self.touch(f'{ckan.cache_prefix}-AwesomeMod-1.0.0.zip')
+        with mock.patch.object(Ckan, 'CACHE_PATH', self.root):
+            self.assertEqual(ckan.cache_find_file, cached)
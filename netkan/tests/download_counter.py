@@ -0,0 +1,395 @@
+# pylint: disable-all
+# flake8: noqa
+
+import json
+import re
+import tempfile
+import threading
+import unittest
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+from netkan.download_counter import (DownloadCounter, DownloadCountStore, GitHubBatchedQuery,
+                                     request_json)
+
+
+class FakeGraphQL:
+
+    """
+    Stands in for GitHub's GraphQL API, answering download queries
+    for the repos in downloads and charging cost per query. Each repo's
+    latest release is R1 unless latest says otherwise. Queries for
+    more than max_modules repos fail for exceeding resource limits.
+    """
+
+    MODULE_PATTERN = re.compile(
+        r'(\w+): repository\(owner: "([^"]+)", name: "([^"]+)"\)')
+
+    def __init__(self, downloads, remaining=5000, cost=1, reset_in=timedelta(hours=1),
+                 max_modules=None, latest=None):
+        self.downloads = downloads
+        self.latest = latest or {}
+        self.max_modules = max_modules
+        self.remaining = remaining
+        self.cost = cost
+        self.reset_at = datetime.now(timezone.utc) + reset_in
+        self.queries = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                query = json.loads(self.rfile.read(length))['query']
+                body = json.dumps(fake.respond(query, self.headers['Authorization']))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode('UTF-8'))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/graphql'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, query, authorization):
+        if authorization != 'bearer token':
+            return {'errors': [{'message': 'Bad credentials'}]}
+        modules = self.MODULE_PATTERN.findall(query)
+        with self.lock:
+            self.queries.append(query)
+            if self.max_modules and len(modules) > self.max_modules:
+                return {'data': None, 'errors': [{'type': 'RESOURCE_LIMITS_EXCEEDED',
+                                                  'message': 'Resource limits exceeded'}]}
+            self.remaining -= self.cost
+            data = {'rateLimit': {'cost': self.cost, 'remaining': self.remaining,
+                                  'resetAt': self.reset_at.isoformat().replace('+00:00', 'Z')}}
+        for alias, user, repo in modules:
+            count = self.downloads.get((user, repo))
+            data[alias] = None if count is None else {
+                'parent': None,
+                'releases': {'nodes': [
+                    {'id': self.latest.get((user, repo), 'R1'),
+                     'releaseAssets': {'nodes': [{'downloadCount': count}]}},
+                ]},
+            }
+        return {'data': data}
+
+
+class TestGitHubBatchedQuery(unittest.TestCase):
+
+    downloads = {('user', f'Mod{i}'): i * 10 for i in range(25)}
+
+    def query(self, fake, **kwargs):
+        query = GitHubBatchedQuery('token', api_url=fake.url, **kwargs)
+        for user, repo in self.downloads:
+            query.add(repo, user, repo)
+        return query
+
+    def test_get_result(self):
+        with FakeGraphQL(self.downloads) as fake:
+            counts = self.query(fake, workers=3).get_result()
+        self.assertEqual(len(fake.queries), 3)
+        self.assertDictEqual(counts, {repo: count for (_, repo), count in self.downloads.items()})
+
+    def test_shared_kref(self):
+        with FakeGraphQL(self.downloads) as fake:
+            query = GitHubBatchedQuery('token', api_url=fake.url)
+            query.add('Mod1', 'user', 'Mod1')
+            query.add('Mod1-Extras', 'user', 'Mod1')
+            counts = query.get_result()
+        self.assertEqual(len(fake.queries), 1)
+        self.assertDictEqual(counts, {'Mod1': 10, 'Mod1-Extras': 10})
+
+    def test_rate_limit_tracked(self):
+        with FakeGraphQL(self.downloads, remaining=4000, cost=2) as fake:
+            query = self.query(fake, workers=2)
+            query.get_result()
+        self.assertEqual(query.rate_limit_remaining, 3994)
+
+    def test_stops_at_min_remaining(self):
+        with FakeGraphQL(self.downloads, remaining=1502) as fake:
+            query = self.query(fake, min_remaining=1500)
+            counts = query.get_result()
+        self.assertEqual(len(fake.queries), 2)
+        self.assertEqual(len(counts), 20)
+        self.assertEqual(query.rate_limit_remaining, 1500)
+
+    @mock.patch('netkan.download_counter.sleep')
+    def test_waits_for_reset(self, sleep):
+        with FakeGraphQL(self.downloads, remaining=1501,
+                         reset_in=timedelta(minutes=1)) as fake:
+            counts = self.query(fake, min_remaining=1500).get_result()
+        self.assertEqual(len(fake.queries), 3)
+        self.assertEqual(len(counts), 25)
+        # The stand-in never really resets, so we wait before each query after the first
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_batches_by_cost(self):
+        query = GitHubBatchedQuery('token', costs={('user', 'Mod0'): 3000,
+                                                   ('user', 'Mod1'): 10})
+        for user, repo in self.downloads:
+            query.add(repo, user, repo)
+        self.assertEqual([len(batch) for batch in query.get_batches()], [1, 10, 10, 4])
+
+    def test_costs_recorded(self):
+        with FakeGraphQL(self.downloads) as fake:
+            query = self.query(fake)
+            query.get_result()
+        # The repo, its release and the release's asset
+        self.assertEqual(query.costs[('user', 'Mod1')], 3)
+
+    def test_splits_oversized(self):
+        with FakeGraphQL(self.downloads, max_modules=4) as fake:
+            counts = self.query(fake, workers=2).get_result()
+        self.assertEqual(len(counts), 25)
+        # 10, 10 and 5 fail, then each 5 splits again into 2 and 3
+        self.assertEqual(len(fake.queries), 3 + 6 + 8)
+
+    def test_skip_unchanged(self):
+        with FakeGraphQL(self.downloads, latest={('user', 'Mod1'): 'R2'}) as fake:
+            query = self.query(fake)
+            query.skip_unchanged({('user', 'Mod1'): (5, 'R1'), ('user', 'Mod2'): (7, 'R1')})
+            counts = query.get_result()
+        # One fingerprint query, then full ones for the other 24
+        self.assertEqual(len(fake.queries), 1 + 3)
+        self.assertEqual(counts['Mod1'], 10)
+        self.assertEqual(counts['Mod2'], 7)
+        self.assertEqual(query.fingerprints[('user', 'Mod1')], 'R2')
+        self.assertNotIn(('user', 'Mod2'), query.fingerprints)
+
+
+class TestDownloadCountStore(unittest.TestCase):
+
+    def test_github_costs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DownloadCountStore(Path(tmpdir, DownloadCountStore.FILENAME))
+            self.assertDictEqual(store.github_costs(), {})
+            store.save_github_costs({('user', 'Mod1'): 3, ('user', 'Mod2'): 40})
+            store.save_github_costs({('user', 'Mod1'): 5})
+            self.assertDictEqual(store.github_costs(),
+                                 {('user', 'Mod1'): 5, ('user', 'Mod2'): 40})
+
+    def test_counts(self):
+        fetched = datetime(2024, 6, 1, tzinfo=timezone.utc)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DownloadCountStore(Path(tmpdir, DownloadCountStore.FILENAME))
+            self.assertDictEqual(store.counts('github'), {})
+            store.save_counts('github', {'user/Mod1': (10, 'R1')}, fetched)
+            store.save_counts('sourceforge', {'proj': (20, None)}, fetched)
+            self.assertDictEqual(store.counts('github'), {'user/Mod1': (10, fetched, 'R1')})
+            self.assertDictEqual(store.counts('sourceforge'), {'proj': (20, fetched, None)})
+
+
+class TestDownloadCountHistory(unittest.TestCase):
+
+    day = date(2024, 6, 1)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = DownloadCountStore(Path(self.tmpdir.name, DownloadCountStore.FILENAME))
+        for days, counts in [(0, {'Mod1': 10, 'Mod2': 100}),
+                             (1, {'Mod1': 15, 'Mod2': 100}),
+                             (7, {'Mod1': 50, 'Mod2': 160, 'Mod3': 1000})]:
+            self.store.record_day(self.day + timedelta(days=days), counts)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_counts_on(self):
+        self.assertDictEqual(self.store.counts_on(self.day + timedelta(days=1)),
+                             {'Mod1': 15, 'Mod2': 100})
+        self.assertDictEqual(self.store.counts_on(self.day + timedelta(days=8)),
+                             {'Mod1': 50, 'Mod2': 160, 'Mod3': 1000})
+
+    def test_counts_interpolated(self):
+        # Between fetches, the downloads are spread over the days
+        self.assertDictEqual(self.store.counts_on(self.day + timedelta(days=4)),
+                             {'Mod1': 32, 'Mod2': 130})
+
+    def test_deltas(self):
+        self.assertDictEqual(self.store.deltas(self.day, self.day + timedelta(days=7)),
+                             {'Mod1': 40, 'Mod2': 60})
+        self.assertDictEqual(self.store.deltas(self.day - timedelta(days=1), self.day), {})
+
+    def test_top(self):
+        self.assertEqual(self.store.top(1, self.day, self.day + timedelta(days=7)),
+                         [('Mod2', 60)])
+
+    def test_trend(self):
+        self.assertEqual(self.store.trend('Mod2', self.day, self.day + timedelta(days=7)),
+                         [(self.day, 100), (self.day + timedelta(days=1), 100),
+                          (self.day + timedelta(days=7), 160)])
+
+    def test_trend_from_start(self):
+        self.assertEqual(self.store.trend('Mod1', self.day + timedelta(days=3),
+                                          self.day + timedelta(days=7)),
+                         [(self.day + timedelta(days=1), 15),
+                          (self.day + timedelta(days=7), 50)])
+
+
+class TestDownloadCounterRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ckm_repo = mock.Mock()
+        self.ckm_repo.git_repo.git_dir = self.tmpdir.name
+        self.ckm_repo.git_repo.working_dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def counter(self, refresh_days=7):
+        return DownloadCounter('ksp', self.ckm_repo, 'token', refresh_days=refresh_days)
+
+    def test_reusable(self):
+        counter = self.counter()
+        keys = [f'proj{i}' for i in range(50)]
+        counter.store.save_counts('sourceforge', {key: (1, None) for key in keys},
+                                  counter.now - timedelta(days=1))
+        counter.store.save_counts('sourceforge', {'stale': (1, None)},
+                                  counter.now - timedelta(days=7))
+        reused = [key for key in keys if counter.reusable('sourceforge', key)]
+        # Roughly one in seven is due today
+        self.assertLess(len(reused), len(keys))
+        self.assertGreater(len(reused), len(keys) // 2)
+        self.assertIsNone(counter.reusable('sourceforge', 'stale'))
+        self.assertIsNone(counter.reusable('sourceforge', 'unknown'))
+
+    def test_fetched_today_reusable(self):
+        counter = self.counter()
+        counter.store.save_counts('github', {'user/Mod1': (10, 'R1')}, counter.now)
+        self.assertEqual(counter.reusable('github', 'user/Mod1'), (10, 'R1'))
+
+    @mock.patch('netkan.download_counter.request_json')
+    def test_count_sourceforge(self, request_json):
+        request_json.side_effect = lambda method, url, timeout: (
+            {'total': 5} if '/projects/good/' in url else {})
+        counts = self.counter().count_sourceforge({'good': ['Mod1', 'Mod2'], 'bad': ['Mod3']})
+        self.assertDictEqual(counts, {'Mod1': 5, 'Mod2': 5})
+
+    @mock.patch('netkan.download_counter.request_json')
+    def test_count_archive_org(self, request_json):
+        def archive(method, url, timeout):
+            items = url.rsplit('/', 1)[1].split(',')
+            if 'item0' in items:
+                raise requests.ConnectTimeout()
+            return {item: {'all_time': 3} for item in items}
+        request_json.side_effect = archive
+        ckans = []
+        for i in range(65):
+            ckan = mock.Mock(identifier=f'Mod{i}')
+            ckan.mirror_item.return_value = f'item{i}'
+            ckans.append(ckan)
+        counter = self.counter()
+        counts = counter.count_archive_org(ckans)
+        # The first batch of 30 failed, the other two still count
+        self.assertEqual(request_json.call_count, 3)
+        self.assertEqual(len(counts), 35)
+        self.assertEqual(len(counter.fetched['archive.org']), 35)
+
+    @mock.patch('netkan.download_counter.logging.error')
+    def test_log_top(self, error):
+        counter = self.counter()
+        today = counter.now.date()
+        counter.store.record_day(today - timedelta(days=8), {'Mod1': 1, 'Mod2': 1})
+        counter.store.record_day(today - timedelta(days=1), {'Mod1': 5, 'Mod2': 20})
+        counter.counts = {'Mod1': 30, 'Mod2': 21}
+        counter.store.record_day(today, counter.counts)
+        counter.log_top(1)
+        message = error.call_args.args[1]
+        self.assertIn('all-time:\n          30  Mod1', message)
+        self.assertIn('today:\n          25  Mod1', message)
+        self.assertIn('this week:\n          29  Mod1', message)
+        self.assertNotIn('this month', message)
+
+    @mock.patch('netkan.download_counter.DownloadCounter.count_github')
+    @mock.patch('netkan.download_counter.DownloadCounter.find_sources')
+    def test_carry_forward(self, find_sources, count_github):
+        graph_query = GitHubBatchedQuery('token')
+        for ident in ('Mod1', 'Mod2', 'Mod3'):
+            graph_query.add(ident, 'user', ident)
+        find_sources.return_value = (graph_query, mock.Mock(ids={}, get_result=dict), {}, {})
+        # The rate limit ran out before Mod2 and Mod3
+        count_github.return_value = {'Mod1': 10}
+        Path(self.tmpdir.name, 'download_counts.json').write_text(
+            json.dumps({'Mod1': 5, 'Mod2': 50}), encoding='UTF-8')
+        counter = self.counter()
+        counter.get_counts()
+        self.assertSetEqual(counter.missed, {'Mod2', 'Mod3'})
+        counter.carry_forward()
+        self.assertDictEqual(counter.counts, {'Mod1': 10, 'Mod2': 50})
+
+    def test_store_dir(self):
+        store_dir = Path(self.tmpdir.name, 'kept')
+        counter = DownloadCounter('ksp', self.ckm_repo, 'token', store_dir=store_dir)
+        counter.store.save_github_costs({('user', 'Mod1'): 5})
+        self.assertTrue(Path(store_dir, 'ksp-netkan-download-counts.sqlite').exists())
+        # A new clone finds it there
+        self.ckm_repo.git_repo.git_dir = Path(self.tmpdir.name, 'fresh')
+        counter = DownloadCounter('ksp', self.ckm_repo, 'token', store_dir=store_dir)
+        self.assertDictEqual(counter.store.github_costs(), {('user', 'Mod1'): 5})
+
+    def test_reusable_from_store_dir(self):
+        store_dir = Path(self.tmpdir.name, 'kept')
+        counter = DownloadCounter('ksp', self.ckm_repo, 'token', refresh_days=7,
+                                  store_dir=store_dir)
+        counter.store.save_counts('github', {'user/Mod1': (10, 'R1')}, counter.now)
+        # The next run's fresh clone
+        self.ckm_repo.git_repo.git_dir = Path(self.tmpdir.name, 'fresh')
+        counter = DownloadCounter('ksp', self.ckm_repo, 'token', refresh_days=7,
+                                  store_dir=store_dir)
+        self.assertEqual(counter.reusable('github', 'user/Mod1'), (10, 'R1'))
+
+    @mock.patch('netkan.download_counter.repo_file_add_or_changed', return_value=False)
+    @mock.patch('netkan.download_counter.DownloadCounter.log_top')
+    @mock.patch('netkan.download_counter.DownloadCounter.get_counts')
+    def test_records_fetched_only(self, get_counts, log_top, changed):
+        counter = self.counter()
+
+        def counts():
+            counter.counts = {'Fetched': 10, 'Reused': 20, 'Missed': 30}
+            counter.reused = {'Reused'}
+            counter.missed = {'Missed'}
+        get_counts.side_effect = counts
+        counter.update_counts()
+        self.assertDictEqual(counter.store.counts_on(counter.now.date()), {'Fetched': 10})
+
+    def test_refresh_disabled(self):
+        counter = self.counter(refresh_days=0)
+        counter.store.save_counts('github', {'user/Mod1': (10, 'R1')}, counter.now)
+        self.assertIsNone(counter.reusable('github', 'user/Mod1'))
+
+
+class TestRequestJson(unittest.TestCase):
+
+    @mock.patch('netkan.download_counter.sleep')
+    @mock.patch('netkan.download_counter.requests.request')
+    def test_retries(self, request, sleep):
+        response = mock.Mock()
+        response.json.return_value = {'total': 1}
+        request.side_effect = [requests.ConnectTimeout(), response]
+        self.assertEqual(request_json('GET', 'url', (1, 1)), {'total': 1})
+        sleep.assert_called_once_with(1)
+
+    @mock.patch('netkan.download_counter.sleep')
+    @mock.patch('netkan.download_counter.requests.request')
+    def test_gives_up(self, request, sleep):
+        request.side_effect = requests.ConnectTimeout()
+        with self.assertRaises(requests.ConnectTimeout):
+            request_json('GET', 'url', (1, 1), retries=2)
+        self.assertEqual(request.call_count, 3)
@@ -9,9 +9,11 @@ from pathlib import Path, PurePath
 from git import Repo
 from datetime import datetime
 from gitdb.exc import BadName
+from contextlib import contextmanager
 
-from netkan.indexer import CkanMessage, MessageHandler, IndexerQueueHandler
+from netkan.indexer import CkanMessage, MessageHandler, IndexerQueueHandler, PushCoalescer
 from netkan.repos import CkanMetaRepo
+from netkan.status import ModStatus
 
 from .common import SharedArgsHarness
 
@@ -158,11 +160,14 @@ class TestUpdateCkan(TestCkan):
         )
 
     def test_ckan_message_status_attrs(self):
+        self.message.indexed = True
         attrs = self.message.status_attrs(new=True)
         self.assertEqual(attrs['ModIdentifier'], 'DogeCoinFlag')
         self.assertTrue(attrs['success'])
         self.assertIsInstance(attrs['last_inflated'], datetime)
-        self.assertIsInstance(attrs['last_indexed'], datetime)
+        # Not until it's pushed
+        with self.assertRaises(KeyError):
+            attrs['last_indexed']
 
 
 class TestStagedCkan(TestUpdateCkan):
@@ -211,6 +216,11 @@ class TestStagedCkan(TestUpdateCkan):
         with self.assertRaises(KeyError):
             attrs['last_indexed']
 
+    def test_ckan_message_status_attrs_indexed(self):
+        self.message.indexed = True
+        # Staged commits go out with their branch straight away
+        self.assertIsInstance(self.message.status_attrs()['last_indexed'], datetime)
+
 
 class TestNewCkan(TestUpdateCkan):
     test_data = Path(PurePath(__file__).parent, 'testdata/empty')
@@ -259,12 +269,84 @@ class TestFailedCkan(TestCkan):
         with self.assertRaises(KeyError):
             attrs['last_indexed']
 
+    def test_update_status_new(self):
+        table = FakeStatusTable()
+        table.patch(self)
+        status = self.message.update_status(None)
+        self.assertEqual(status.ModIdentifier, 'DogeCoinFlag')
+        self.assertEqual(status.game_id, 'ksp')
+        self.assertFalse(status.success)
+        self.assertIs(table.rows[('DogeCoinFlag', 'ksp')], status)
+
+    @mock.patch('netkan.indexer.logging.error')
+    def test_update_status_new_error(self, mocked_error):
+        table = FakeStatusTable()
+        table.patch(self)
+        existing = ModStatus(ModIdentifier='DogeCoinFlag', game_id='ksp',
+                             success=True, frozen=True, last_error=None)
+        status = self.message.update_status(existing)
+        self.assertIs(status, existing)
+        self.assertFalse(status.frozen)
+        self.assertEqual(status.last_error,
+                         'Curl download failed with error CouldntConnect')
+        self.assertEqual(len(table.updates), 1)
+        mocked_error.assert_called_once()
+
+    @mock.patch('netkan.indexer.logging.error')
+    def test_update_status_same_error(self, mocked_error):
+        FakeStatusTable().patch(self)
+        existing = ModStatus(ModIdentifier='DogeCoinFlag', game_id='ksp', success=False,
+                             last_error='Curl download failed with error CouldntConnect')
+        self.message.update_status(existing)
+        mocked_error.assert_not_called()
+
+
+class FakeStatusTable:
+
+    """
+    In-memory stand-in for the ModStatus table's reads and writes
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.gets = 0
+        # (key, names of the attributes set) for each update
+        self.updates = []
+
+    def batch_get(self, keys):
+        self.gets += 1
+        return [self.rows[key] for key in keys if key in self.rows]
+
+    def patch(self, case):
+        table = self
+
+        def save(status, *args, **kwargs):
+            table.rows[(status.ModIdentifier, status.game_id)] = status
+
+        def update(status, actions, *args, **kwargs):
+            names = set()
+            for action in actions:
+                path, value = action.values
+                name = path.path[0]
+                attr = getattr(ModStatus, name)
+                setattr(status, name, None if 'NULL' in value.value
+                        else attr.deserialize(attr.get_value(value.value)))
+                names.add(name)
+            table.updates.append(((status.ModIdentifier, status.game_id), names))
+
+        for name, fake in (('batch_get', self.batch_get), ('save', save), ('update', update)):
+            patcher = mock.patch.object(ModStatus, name, fake)
+            patcher.start()
+            case.addCleanup(patcher.stop)
+
 
 class TestMessageHandler(SharedArgsHarness):
 
     def setUp(self):
         super().setUp()
         self.handler = MessageHandler(game=self.shared_args.game('ksp'))
+        self.table = FakeStatusTable()
+        self.table.patch(self)
 
     def test_class_string(self):
         self.handler.append(self.mocked_message())
@@ -320,6 +402,180 @@ class TestMessageHandler(SharedArgsHarness):
             'Id': 'MessageMcMessageFace', 'ReceiptHandle': 'HandleMcHandleFace'}]
         self.assertEqual(processed, attrs)
 
+    @mock.patch('netkan.indexer.CkanMessage.process_ckan')
+    def test_statuses_batched(self, mocked_process):
+        self.handler.append(self.mocked_message())
+        self.handler.append(self.mocked_message(staged=True))
+        self.handler.process_messages()
+        self.assertEqual(self.table.gets, 1)
+        self.assertEqual(list(self.table.rows), [('DogeCoinFlag', 'ksp')])
+        # Created by the first message, updated by the second
+        self.assertEqual(len(self.table.updates), 1)
+
+    @mock.patch('netkan.indexer.CkanMessage.process_ckan')
+    def test_statuses_updated_in_place(self, mocked_process):
+        existing = ModStatus(ModIdentifier='DogeCoinFlag', game_id='ksp', success=False,
+                             frozen=True, last_error='Old error',
+                             resources={'homepage': 'https://example.com'})
+        self.table.rows[('DogeCoinFlag', 'ksp')] = existing
+        self.handler.append(self.mocked_message())
+        self.handler.process_messages()
+        status = self.table.rows[('DogeCoinFlag', 'ksp')]
+        self.assertIs(status, existing)
+        self.assertTrue(status.success)
+        self.assertFalse(status.frozen)
+        self.assertIsNone(status.last_error)
+        # Only the indexer's own attributes are written
+        _, names = self.table.updates[0]
+        self.assertIn('success', names)
+        self.assertNotIn('ModIdentifier', names)
+        self.assertNotIn('last_checked', names)
+
+    def test_statuses_written_before_failure(self):
+        processed = []
+
+        def process(ckan):
+            if processed:
+                raise RuntimeError('Second message failed')
+            processed.append(ckan)
+        self.handler.append(self.mocked_message())
+        self.handler.append(self.mocked_message())
+        with mock.patch.object(CkanMessage, 'process_ckan', autospec=True,
+                               side_effect=process):
+            with self.assertRaises(RuntimeError):
+                self.handler.process_messages()
+        # The first one's status still went out
+        self.assertEqual(list(self.table.rows), [('DogeCoinFlag', 'ksp')])
+
+    @mock.patch('netkan.repos.CkanMetaRepo.rebase_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.push_remote_primary')
+    @mock.patch.object(CkanMessage, 'process_ckan', autospec=True,
+                       side_effect=lambda ckan: setattr(ckan, 'indexed', True))
+    def test_pushes_coalesced(self, mocked_process, mocked_push, mocked_rebase):
+        self.shared_args.push_wait = 300
+        self.shared_args.push_commits = 2
+        handler = MessageHandler(game=self.shared_args.game('ksp'))
+        handler.append(self.mocked_message())
+        # Deleted once committed, not held until the push
+        self.assertEqual(len(handler.process_messages()), 1)
+        handler.flush()
+        mocked_push.assert_not_called()
+        handler.append(self.mocked_message())
+        self.assertEqual(len(handler.process_messages()), 1)
+        mocked_rebase.assert_called_once()
+        mocked_push.assert_called_once()
+        self.assertEqual(handler.pusher.commits_per_push, 2)
+
+    @mock.patch('netkan.repos.CkanMetaRepo.unpushed_primary_paths',
+                return_value=['DogeCoinFlag/DogeCoinFlag-v1.02.ckan'])
+    @mock.patch('netkan.repos.CkanMetaRepo.rebase_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.push_remote_primary')
+    @mock.patch.object(CkanMessage, 'process_ckan', autospec=True,
+                       side_effect=lambda ckan: setattr(ckan, 'indexed', True))
+    def test_last_indexed_after_push(self, mocked_process, mocked_push, mocked_rebase,
+                                     mocked_paths):
+        self.shared_args.push_wait = 300
+        handler = MessageHandler(game=self.shared_args.game('ksp'))
+        handler.append(self.mocked_message())
+        handler.process_messages()
+        self.assertFalse(any('last_indexed' in names for _, names in self.table.updates))
+        self.assertIsNone(self.table.rows[('DogeCoinFlag', 'ksp')].last_indexed)
+        handler.push()
+        mocked_push.assert_called_once()
+        self.assertEqual(self.table.updates[-1],
+                         (('DogeCoinFlag', 'ksp'), {'last_indexed'}))
+
+    @mock.patch('netkan.repos.CkanMetaRepo.pull_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.rebase_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.push_remote_primary')
+    @mock.patch.object(CkanMessage, 'process_ckan', autospec=True,
+                       side_effect=lambda ckan: setattr(ckan, 'indexed', True))
+    def test_pushes_flushed(self, mocked_process, mocked_push, mocked_rebase, mocked_pull):
+        self.shared_args.push_wait = 300
+        handler = MessageHandler(game=self.shared_args.game('ksp'))
+        handler.append(self.mocked_message())
+        handler.append(self.mocked_message(staged=True))
+        self.assertEqual(len(handler.process_messages()), 2)
+        handler.flush(force=True)
+        mocked_push.assert_called_once()
+        handler.flush(force=True)
+        mocked_push.assert_called_once()
+
+    @mock.patch('netkan.repos.CkanMetaRepo.pull_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.rebase_remote_primary')
+    @mock.patch('netkan.repos.CkanMetaRepo.unpushed_primary_commits', return_value=3)
+    def test_enter_rebases_unpushed(self, mocked_unpushed, mocked_rebase, mocked_pull):
+        self.shared_args.push_wait = 300
+        handler = MessageHandler(game=self.shared_args.game('ksp'))
+        with handler:
+            pass
+        mocked_rebase.assert_called_once()
+        mocked_pull.assert_not_called()
+        # Commits from before a restart get pushed too
+        self.assertEqual(handler.pusher.commits, 3)
+
+
+class TestPushCoalescer(unittest.TestCase):
+
+    def test_due_without_wait(self):
+        pusher = PushCoalescer()
+        pusher.add(1)
+        self.assertTrue(pusher.due())
+
+    def test_due_after_commits(self):
+        pusher = PushCoalescer(max_commits=2, max_wait=300)
+        self.assertFalse(pusher.due())
+        pusher.add(0)
+        self.assertFalse(pusher.due())
+        pusher.add(1)
+        self.assertFalse(pusher.due())
+        pusher.add(1)
+        self.assertTrue(pusher.due())
+
+    def test_due_after_wait(self):
+        pusher = PushCoalescer(max_commits=10, max_wait=60)
+        with mock.patch('netkan.indexer.time.monotonic', return_value=100):
+            pusher.add(1)
+        with mock.patch('netkan.indexer.time.monotonic', return_value=159):
+            self.assertFalse(pusher.due())
+        with mock.patch('netkan.indexer.time.monotonic', return_value=160):
+            self.assertTrue(pusher.due())
+
+    def test_push(self):
+        pusher = PushCoalescer(max_commits=2, max_wait=300)
+        repo = mock.Mock()
+        repo.unpushed_primary_paths.return_value = [
+            'AwesomeMod/AwesomeMod-1.0.ckan', 'AwesomeMod/AwesomeMod-1.1.ckan',
+            'AdequateMod/AdequateMod-0.1.ckan']
+        pusher.add(3)
+        self.assertListEqual(pusher.push(repo), ['AdequateMod', 'AwesomeMod'])
+        repo.rebase_remote_primary.assert_called_once()
+        repo.push_remote_primary.assert_called_once()
+        self.assertFalse(pusher.pending)
+        self.assertEqual(pusher.pushes, 1)
+        self.assertEqual(pusher.commits_per_push, 3)
+        self.assertListEqual(pusher.push(repo), [])
+        repo.push_remote_primary.assert_called_once()
+
+    @mock.patch('netkan.common.boto3.client')
+    def test_push_metrics(self, mocked_client):
+        repo = mock.Mock()
+        repo.unpushed_primary_paths.return_value = []
+        pusher = PushCoalescer()
+        pusher.add(1)
+        pusher.push(repo)
+        mocked_client.assert_not_called()
+        pusher = PushCoalescer(metrics_namespace='NetKAN', game_id='ksp')
+        pusher.add(2)
+        pusher.push(repo)
+        data = mocked_client.return_value.put_metric_data.call_args.kwargs
+        self.assertEqual(data['Namespace'], 'NetKAN')
+        self.assertDictEqual({metric['MetricName']: metric['Value']
+                              for metric in data['MetricData']},
+                             {'PrimaryPushes': 1, 'PushedCommits': 2})
+        self.assertIn({'Name': 'Game', 'Value': 'ksp'},
+                      data['MetricData'][0]['Dimensions'])
+
 
 class TestIndexerQueueHandler(SharedArgsHarness):
 
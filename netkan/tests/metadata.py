@@ -1,6 +1,7 @@
 # pylint: disable-all
 # flake8: noqa
 
+import pickle
 import unittest
 from pathlib import Path, PurePath
 from git import Repo
@@ -41,6 +42,12 @@ class TestNetKANGitHub(TestNetKAN):
     def test_hook_only(self):
         self.assertFalse(self.netkan.hook_only())
 
+    def test_pickle(self):
+        netkan = pickle.loads(pickle.dumps(self.netkan))
+        self.assertEqual(netkan.identifier, 'DogeCoinFlag')
+        self.assertEqual(netkan.kref_id, 'pjf/DogeCoinFlag')
+        self.assertEqual(netkan.filename, self.netkan.filename)
+
 
 class TestNetKANSpaceDock(TestNetKAN):
 
@@ -347,3 +354,34 @@ class TestVersionComparison(unittest.TestCase):
         v2 = Ckan.Version('2.0')
 
         self.assertTrue(v1 < v2)
+
+    def test_dotSortsHigherThanDotString(self):
+        v1 = Ckan.Version('1.a')
+        v2 = Ckan.Version('1.')
+        v3 = Ckan.Version('1.b')
+
+        self.assertLess(v1, v2)
+        self.assertEqual(v1, v3)
+
+    def test_trailingZero(self):
+        v1 = Ckan.Version('1.')
+        v2 = Ckan.Version('1.0')
+
+        self.assertEqual(v1, v2)
+        self.assertEqual(hash(v1), hash(v2))
+
+    def test_sort(self):
+        versions = [Ckan.Version(v) for v in
+                    ['1.0.1', '1:0.1', '1.0', 'v6a12', '1.0.repackaged', '1.0_beta', 'v6a5']]
+
+        self.assertEqual(
+            [str(v) for v in Ckan.Version.sort(versions)],
+            ['1.0', '1.0_beta', '1.0.repackaged', '1.0.1', 'v6a5', 'v6a12', '1:0.1'])
+        self.assertEqual(
+            [str(v) for v in Ckan.Version.sort(versions, reverse=True)],
+            ['1:0.1', 'v6a12', 'v6a5', '1.0.1', '1.0.repackaged', '1.0_beta', '1.0'])
+
+    def test_max(self):
+        self.assertEqual(str(Ckan.Version.max(
+            Ckan.Version(v) for v in ['1.2', '1.10', '1.9'])), '1.10')
+        self.assertIsNone(Ckan.Version.max([]))
@@ -0,0 +1,248 @@
+# pylint: disable-all
+# flake8: noqa
+
+from time import sleep
+import unittest
+from unittest import mock
+
+from netkan.cli.common import SharedArgs
+from netkan.queue_handler import (
+    BaseMessageHandler, QueueHandler, BatchStats, MessagePrefetcher, receive_batch,
+    delete_messages
+)
+
+
+class FakeMessage:
+
+    def __init__(self, body, game_id='ksp'):
+        self.body = body
+        self.message_id = body
+        self.receipt_handle = body
+        self.message_attributes = {'GameId': {'StringValue': game_id}}
+
+
+class FakeQueue:
+
+    """
+    In-memory stand-in for an SQS queue, with a clock that only moves
+    while we wait on a receive
+    """
+
+    def __init__(self, arrivals):
+        # (arrival time, message)
+        self.pending = sorted(arrivals, key=lambda a: a[0])
+        self.now = 0.0
+        self.receives = []
+        self.deleted = []
+
+    def receive_messages(self, MaxNumberOfMessages, WaitTimeSeconds, **kwargs):
+        self.receives.append((MaxNumberOfMessages, WaitTimeSeconds))
+        next_arrival = self.pending[0][0] if self.pending else float('inf')
+        self.now = max(self.now, min(next_arrival, self.now + WaitTimeSeconds))
+        if next_arrival > self.now:
+            return []
+        ready = [msg for arrival, msg in self.pending if arrival <= self.now][:MaxNumberOfMessages]
+        self.pending = self.pending[len(ready):]
+        return ready
+
+    def delete_messages(self, Entries):
+        self.deleted.extend(Entries)
+
+
+class TestReceiveBatch(unittest.TestCase):
+
+    def receive(self, queue, **kwargs):
+        with mock.patch('netkan.queue_handler.time.monotonic', lambda: queue.now):
+            return [msg.body for msg in receive_batch(queue, 300, **kwargs)]
+
+    def test_single_receive_by_default(self):
+        queue = FakeQueue([(1, FakeMessage('a')), (2, FakeMessage('b'))])
+        self.assertListEqual(self.receive(queue), ['a'])
+        self.assertEqual(len(queue.receives), 1)
+
+    def test_empty(self):
+        queue = FakeQueue([])
+        self.assertListEqual(self.receive(queue, batch_wait=10), [])
+        self.assertListEqual(queue.receives, [(10, 20)])
+
+    def test_fills_batch(self):
+        queue = FakeQueue([(i, FakeMessage(str(i))) for i in range(1, 6)])
+        self.assertListEqual(self.receive(queue, batch_size=3, batch_wait=30),
+                             ['1', '2', '3'])
+        self.assertListEqual(queue.receives, [(3, 20), (2, 20), (1, 20)])
+
+    def test_window_from_first_message(self):
+        queue = FakeQueue([(5, FakeMessage('a')), (8, FakeMessage('b')),
+                           (20, FakeMessage('c'))])
+        self.assertListEqual(self.receive(queue, batch_size=10, batch_wait=10),
+                             ['a', 'b'])
+        self.assertEqual(queue.now, 15)
+
+
+class TestBatchStats(unittest.TestCase):
+
+    def test_summary(self):
+        stats = BatchStats('Test', log_every=2)
+        with self.assertLogs(level='INFO') as logs:
+            stats.record(1, 4.0, 1.0)
+            stats.record(3, 4.0, 3.0)
+        self.assertEqual(len(logs.records), 1)
+        self.assertDictEqual(stats.summary(), {
+            'batches': 2,
+            'messages': 4,
+            'mean_batch_size': 2.0,
+            'overhead_per_message': 2.0,
+            'processing_per_message': 1.0,
+        })
+        self.assertDictEqual(dict(stats.sizes), {1: 1, 3: 1})
+
+    @mock.patch('netkan.common.boto3.client')
+    def test_publish(self, mocked_client):
+        stats = BatchStats('Test', log_every=2, metrics_namespace='NetKAN')
+        for _ in range(3):
+            stats.record(2, 1.0, 3.0)
+        put = mocked_client.return_value.put_metric_data
+        put.assert_called_once()
+        self.assertDictEqual({metric['MetricName']: metric['Value']
+                              for metric in put.call_args.kwargs['MetricData']},
+                             {'Batches': 2, 'Messages': 4,
+                              'OverheadSeconds': 2.0, 'ProcessingSeconds': 6.0})
+        # Only what's new since goes out next time
+        self.assertEqual(stats.unpublished['Batches'], 1)
+
+
+class FakeHandler(BaseMessageHandler):
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.queued = []
+        self.entered = 0
+        self.flushes = []
+
+    def __enter__(self):
+        self.entered += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def append(self, message):
+        self.queued.append(message)
+
+    def process_messages(self):
+        processed = [{'Id': msg.message_id, 'ReceiptHandle': msg.receipt_handle}
+                     for msg in self.queued]
+        self.queued = []
+        return processed
+
+    def flush(self, force=False):
+        self.flushes.append(force)
+
+
+class FakeQueueHandler(QueueHandler):
+    _handler_class = FakeHandler
+
+
+class TestQueueHandlerBatch(unittest.TestCase):
+
+    def test_process_batch(self):
+        common = SharedArgs()
+        common.timeout = 300
+        common.batch_size = 4
+        common.batch_wait = 30
+        queue = FakeQueue([(i, FakeMessage(str(i), 'ksp' if i % 2 else 'ksp2'))
+                           for i in range(1, 6)])
+        handler = FakeQueueHandler(common)
+        with mock.patch('netkan.queue_handler.time.monotonic', lambda: queue.now):
+            handler.process_batch(queue, receive_batch(queue, 300, 4, 30))
+        self.assertListEqual([entry['Id'] for entry in queue.deleted],
+                             ['1', '3', '2', '4'])
+        self.assertEqual(handler.game_handler('ksp').entered, 1)
+        self.assertEqual(handler.stats.messages, 4)
+        self.assertEqual(handler.stats.batches, 1)
+
+    def test_flush(self):
+        common = SharedArgs()
+        queue = FakeQueue([])
+        handler = FakeQueueHandler(common)
+        game_handler = handler.game_handler('ksp')
+        handler.process_batch(queue, [])
+        handler.flush(force=True)
+        self.assertListEqual(game_handler.flushes, [False, True])
+
+    def test_stops_between_batches(self):
+        common = SharedArgs()
+        common.timeout = 300
+        common.queue = 'Inbound.fifo'
+        handler = FakeQueueHandler(common)
+        game_handler = handler.game_handler('ksp')
+
+        def receive(*args):
+            # SIGTERM arrives mid batch
+            handler._terminate(15, None)
+            return [FakeMessage('1', 'ksp')]
+        with mock.patch('netkan.queue_handler.boto3'), \
+                mock.patch('netkan.queue_handler.signal.signal'), \
+                mock.patch('netkan.queue_handler.receive_batch', side_effect=receive) as received, \
+                mock.patch('netkan.queue_handler.delete_messages'):
+            handler.run()
+        received.assert_called_once()
+        self.assertListEqual(game_handler.flushes, [True])
+
+    def test_delete_messages_chunked(self):
+        queue = mock.Mock()
+        delete_messages(queue, [{'Id': str(i), 'ReceiptHandle': str(i)} for i in range(25)])
+        self.assertListEqual([len(call.kwargs['Entries'])
+                              for call in queue.delete_messages.call_args_list], [10, 10, 5])
+
+
+class FakeVisibilityQueue(FakeQueue):
+
+    url = 'fake.queue.url'
+
+    def __init__(self, arrivals):
+        super().__init__(arrivals)
+        self.meta = mock.Mock(client=self)
+        self.visibility = []
+
+    def receive_messages(self, **kwargs):
+        messages = super().receive_messages(**kwargs)
+        if not messages:
+            # Stand in for the long poll
+            sleep(0.01)
+        return messages
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility.extend((entry['ReceiptHandle'], entry['VisibilityTimeout'])
+                               for entry in Entries)
+
+
+class TestMessagePrefetcher(unittest.TestCase):
+
+    def test_batches_in_order(self):
+        queue = FakeVisibilityQueue([(0, FakeMessage(str(i))) for i in range(5)])
+        with MessagePrefetcher(lambda: queue, 300, batch_size=2, max_buffered=2) as prefetcher:
+            batches = [[msg.body for msg in prefetcher.get(timeout=5)] for _ in range(3)]
+            self.assertListEqual(prefetcher.get(timeout=0.05), [])
+        self.assertListEqual(batches, [['0', '1'], ['2', '3'], ['4']])
+        self.assertListEqual(queue.visibility, [])
+
+    def test_extends_and_releases_buffered(self):
+        queue = FakeVisibilityQueue([(0, FakeMessage(str(i))) for i in range(4)])
+        with MessagePrefetcher(lambda: queue, 1, batch_size=2, max_buffered=1) as prefetcher:
+            self.assertListEqual([msg.body for msg in prefetcher.get(timeout=5)], ['0', '1'])
+            # Leave the next batch waiting long enough to need extending
+            sleep(1.2)
+        self.assertIn(('2', 1), queue.visibility)
+        self.assertIn(('3', 1), queue.visibility)
+        # Then handed back to the queue on exit
+        self.assertListEqual(queue.visibility[-2:], [('2', 0), ('3', 0)])
+
+    def test_extends_while_receiving(self):
+        queue = FakeVisibilityQueue([(0, FakeMessage(str(i))) for i in range(2)])
+        with MessagePrefetcher(lambda: queue, 1, batch_size=2, max_buffered=2):
+            # The buffer isn't full, so the thread keeps polling the empty queue
+            sleep(1.2)
+        self.assertIn(('0', 1), queue.visibility)
+        self.assertIn(('1', 1), queue.visibility)
+        self.assertListEqual(queue.visibility[-2:], [('0', 0), ('1', 0)])
@@ -4,11 +4,12 @@
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 from pathlib import Path, PurePath
 
 from git import Repo
 from gitdb.exc import BadName
-from netkan.repos import NetkanRepo, CkanMetaRepo
+from netkan.repos import NetkanRepo, CkanMetaRepo, RepoSnapshot
 
 
 class TestRepo(unittest.TestCase):
@@ -73,6 +74,78 @@ class TestNetkanRepo(TestRepo):
     def test_active_branch(self):
         self.assertEqual(self.nk_repo.active_branch, 'main')
 
+    def test_netkans_parse_cache(self):
+        path = self.nk_repo.nk_path('DogeCoinFlag')
+        netkan = self.nk_repo.netkan(path)
+        self.assertIs(NetkanRepo(self.repo).netkan(path), netkan)
+        self.assertIsNot(NetkanRepo(self.repo, game_id='ksp2').netkan(path), netkan)
+        path.write_text(path.read_text(encoding='UTF-8') + '\n', encoding='UTF-8')
+        self.assertIsNot(self.nk_repo.netkan(path), netkan)
+        self.repo.git.checkout('--', path)
+
+    def test_parallel_netkans(self):
+        NetkanRepo.parse_cache.clear()
+        cached = self.nk_repo.netkan(self.nk_repo.nk_path('DogeCoinFlag'))
+        netkans = list(self.nk_repo.netkans(workers=2))
+        self.assertListEqual([nk.filename for nk in netkans],
+                             list(self.nk_repo.all_nk_paths()))
+        self.assertIn(cached, netkans)
+        # Parsed results are cached for the next run
+        self.assertListEqual(list(self.nk_repo.netkans()), netkans)
+
+    def test_kref_netkans(self):
+        self.assertListEqual([nk.filename.stem for nk in self.nk_repo.kref_netkans('spacedock', '777')],
+                             ['DockCoinFlag'])
+        self.assertIn('DogeCoinFlag', self.nk_repo.kref_index[('github', 'pjf/DogeCoinFlag')])
+        self.assertListEqual(self.nk_repo.kref_netkans('spacedock', '1'), [])
+
+    def test_kref_index_snapshot(self):
+        self.assertIn('DogeCoinFlag', self.nk_repo.kref_index[('github', 'pjf/DogeCoinFlag')])
+        restarted = NetkanRepo(self.repo)
+        with mock.patch.object(NetkanRepo, 'netkan', side_effect=AssertionError('Reparsed')):
+            self.assertEqual(restarted.kref_index, self.nk_repo.kref_index)
+
+    def test_kref_index_follows_head(self):
+        nk_repo = NetkanRepo(self.repo)
+        self.assertEqual(len(nk_repo.kref_netkans('spacedock', '777')), 1)
+        new_netkan = nk_repo.nk_path('AnotherDockFlag')
+        new_netkan.write_text('{"identifier": "AnotherDockFlag", "$kref": "#/ckan/spacedock/777"}')
+        moved = nk_repo.nk_path('DockCoinFlag')
+        moved.write_text('{"identifier": "DockCoinFlag", "$kref": "#/ckan/spacedock/779"}')
+        nk_repo.commit([new_netkan, moved], 'Change krefs')
+        try:
+            self.assertListEqual([nk.filename.stem for nk in nk_repo.kref_netkans('spacedock', '777')],
+                                 ['AnotherDockFlag'])
+            self.assertListEqual([nk.filename.stem for nk in nk_repo.kref_netkans('spacedock', '779')],
+                                 ['DockCoinFlag'])
+            # The incremental update is saved for the next process too
+            self.assertEqual(nk_repo.snapshot.load('kref_index')[0], nk_repo.read_sha())
+        finally:
+            self.repo.git.reset('--hard', 'HEAD~1')
+        self.assertListEqual([nk.filename.stem for nk in nk_repo.kref_netkans('spacedock', '777')],
+                             ['DockCoinFlag'])
+
+    def test_object_reader_netkans(self):
+        reader = NetkanRepo(self.repo, object_reader=True)
+        self.assertListEqual(list(reader.all_nk_paths()),
+                             list(self.nk_repo.all_nk_paths()))
+        netkans = list(reader.netkans())
+        self.assertListEqual([nk.identifier for nk in netkans],
+                             [nk.identifier for nk in self.nk_repo.netkans()])
+        self.assertListEqual([nk.filename for nk in netkans],
+                             list(self.nk_repo.all_nk_paths()))
+
+    def test_object_reader_ignores_other_branches(self):
+        reader = NetkanRepo(self.repo, object_reader=True)
+        staged = Path(self.nk_repo.nk_dir, 'ReaderMod.netkan')
+        with self.nk_repo.change_branch('reader/branch'):
+            staged.write_text('{"identifier": "ReaderMod"}')
+            self.nk_repo.commit([staged], 'Test Stage')
+            self.assertIn(staged, list(self.nk_repo.all_nk_paths()))
+            self.assertNotIn(staged, list(reader.all_nk_paths()))
+            self.assertEqual(reader.netkan(reader.nk_path('DogeCoinFlag')).identifier,
+                             'DogeCoinFlag')
+
     def test_primary_active(self):
         self.assertTrue(self.nk_repo.is_primary_active())
 
@@ -122,6 +195,34 @@ class TestNetkanRepo(TestRepo):
         self.assertTrue(
             Path(self.nk_repo.nk_dir, 'test_pushpull_file').exists())
 
+    def clone(self, name):
+        new_clone = Repo.init(Path(self.tmpdir.name, name))
+        new_clone.create_remote('origin', self.upstream.as_posix())
+        Path(new_clone.working_dir, '.git', 'HEAD').write_text(
+            'ref: refs/heads/main')
+        new_clone.remotes.origin.pull('main')
+        new_clone.git.remote('set-head', 'origin', '-a')
+        return new_clone
+
+    def test_rebase_unpushed(self):
+        new_clone = self.clone('rebase_unpushed')
+        new_repo = NetkanRepo(new_clone)
+        self.assertEqual(new_repo.unpushed_primary_commits(), 0)
+        Path(new_repo.nk_dir, 'test_rebase_local').write_text('local')
+        new_repo.commit(new_repo.git_repo.untracked_files, 'Local')
+        self.assertEqual(new_repo.unpushed_primary_commits(), 1)
+        # Someone else pushes in the meantime
+        other_repo = NetkanRepo(self.clone('rebase_other'))
+        Path(other_repo.nk_dir, 'test_rebase_remote').write_text('remote')
+        other_repo.commit(other_repo.git_repo.untracked_files, 'Remote')
+        other_repo.push_remote_primary()
+        new_repo.rebase_remote_primary()
+        self.assertEqual(new_repo.unpushed_primary_commits(), 1)
+        # Replayed on top, no merge commit
+        self.assertEqual(len(new_clone.head.commit.parents), 1)
+        self.assertEqual(new_clone.head.commit.message, 'Local')
+        self.assertTrue(Path(new_repo.nk_dir, 'test_rebase_remote').exists())
+
     def test_branch_push_pull(self):
         new_clone = Repo.init(Path(self.tmpdir.name, 'push_pull'))
         new_clone.create_remote('origin', self.upstream.as_posix())
@@ -160,6 +261,64 @@ class TestNetkanRepo(TestRepo):
         with self.nk_repo.change_branch('local/test'):
             self.assertEqual(self.nk_repo.active_branch, 'local/test')
 
+    def test_commit(self):
+        parent = self.repo.head.commit
+        changed = Path(self.nk_repo.nk_dir, 'CommittedMod.netkan')
+        changed.write_text('{"name": "Commity McCommit"}')
+        try:
+            commit = self.nk_repo.commit([changed], 'Test Commit')
+            self.assertEqual(commit.message, 'Test Commit')
+            self.assertListEqual(commit.parents, [parent])
+            self.assertEqual(self.repo.head.commit, commit)
+            self.assertFalse(self.repo.is_dirty(untracked_files=True))
+            # Same tree GitPython would have built from the index
+            self.assertEqual(commit.tree.binsha, self.repo.index.write_tree().binsha)
+            self.assertEqual(
+                (commit.tree / 'NetKAN' / 'CommittedMod.netkan').data_stream.read(),
+                b'{"name": "Commity McCommit"}')
+        finally:
+            self.repo.git.reset('--hard', parent.hexsha)
+
+    def test_commit_removed(self):
+        parent = self.repo.head.commit
+        removed = self.nk_repo.nk_path('DogeCoinFlag')
+        removed.unlink()
+        try:
+            commit = self.nk_repo.commit([removed], 'Test Remove')
+            self.assertNotIn('NetKAN/DogeCoinFlag.netkan',
+                             [blob.path for blob in commit.tree.traverse()])
+            self.assertFalse(self.repo.is_dirty(untracked_files=True))
+        finally:
+            self.repo.git.reset('--hard', parent.hexsha)
+
+    def test_worktree_branch(self):
+        head = self.nk_repo.head_sha()
+        active = self.nk_repo.active_branch
+        with self.nk_repo.worktree_branch('worktree/branch') as staging:
+            self.assertEqual(Path(staging.git_repo.working_dir), self.nk_repo.worktree_path)
+            self.assertEqual(staging.active_branch, 'worktree/branch')
+            self.assertTrue(self.nk_repo.is_active_branch(active))
+            staged = Path(staging.nk_dir, 'WorktreeMod.netkan')
+            staged.write_text('{"name": "Worktree McWorktree"}')
+            staging.commit([staged], 'Test Worktree')
+        self.assertTrue(self.nk_repo.is_active_branch(active))
+        self.assertEqual(self.nk_repo.head_sha(), head)
+        self.assertFalse(Path(self.nk_repo.nk_dir, 'WorktreeMod.netkan').exists())
+        upstream = Repo(self.upstream)
+        self.assertEqual(upstream.heads['worktree/branch'].commit.message, 'Test Worktree')
+        self.assertEqual(self.nk_repo.git_repo.heads['worktree/branch'].commit.hexsha,
+                         upstream.heads['worktree/branch'].commit.hexsha)
+
+    def test_worktree_branch_reused(self):
+        with self.nk_repo.worktree_branch('worktree/first') as staging:
+            Path(staging.nk_dir, 'Leftover.netkan').write_text('{}')
+        with self.nk_repo.worktree_branch('worktree/second') as staging:
+            self.assertEqual(staging.active_branch, 'worktree/second')
+            self.assertFalse(Path(staging.nk_dir, 'Leftover.netkan').exists())
+        # Released, so the main checkout can take it
+        self.nk_repo.checkout_branch('worktree/second')
+        self.assertTrue(self.nk_repo.is_active_branch('worktree/second'))
+
 
 class TestCkanMetaRepo(TestRepo):
     test_data = Path(PurePath(__file__).parent, 'testdata/CKAN-meta')
@@ -183,6 +342,147 @@ class TestCkanMetaRepo(TestRepo):
              '<Ckan(AwesomeMod, 0.11)>']
         )
 
+    def test_ckans_parse_cache(self):
+        first = list(self.ckm_repo.ckans('AwesomeMod'))
+        second = list(CkanMetaRepo(self.repo).ckans('AwesomeMod'))
+        self.assertEqual(len(first), len(second))
+        for ckan in first:
+            self.assertIn(ckan, second)
+
+    def test_highest_version(self):
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        self.assertEqual(self.ckm_repo.highest_version('AdequateMod').string, '1:0.2')
+        self.assertIsNone(self.ckm_repo.highest_version_prerelease('AwesomeMod'))
+        self.assertIsNone(self.ckm_repo.highest_version('NotAMod'))
+
+    def test_version_index_follows_head(self):
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        adequate = self.ckm_repo.mod_versions('AdequateMod')
+        new_ckan = self.ckm_repo.mod_path('AwesomeMod').joinpath('AwesomeMod-0.12.ckan')
+        new_ckan.write_text('{"identifier": "AwesomeMod", "version": "0.12",'
+                            ' "release_status": "testing"}')
+        self.ckm_repo.commit([new_ckan], 'Add prerelease')
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        self.assertEqual(
+            self.ckm_repo.highest_version_prerelease('AwesomeMod').string, '0.12')
+        # Unchanged mods aren't rescanned
+        self.assertIs(self.ckm_repo.mod_versions('AdequateMod'), adequate)
+
+    def test_version_index_snapshot(self):
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        self.assertIsNone(self.ckm_repo.highest_version('NotAMod'))
+        self.ckm_repo.save_snapshot()
+        restarted = CkanMetaRepo(self.repo)
+        with mock.patch.object(CkanMetaRepo, 'ckans', side_effect=AssertionError('Rescanned')):
+            self.assertEqual(restarted.highest_version('AwesomeMod').string, '0.11')
+            self.assertEqual(restarted.highest_version_module('AwesomeMod', False).filename,
+                             self.ckm_repo.mod_path('AwesomeMod').joinpath('AwesomeMod-0.11.ckan'))
+            self.assertIsNone(restarted.highest_version('NotAMod'))
+
+    def test_version_index_snapshot_behind(self):
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        self.ckm_repo.save_snapshot()
+        new_ckan = self.ckm_repo.mod_path('AwesomeMod').joinpath('AwesomeMod-0.13.ckan')
+        new_ckan.write_text('{"identifier": "AwesomeMod", "version": "0.13"}')
+        self.ckm_repo.commit([new_ckan], 'Add release')
+        try:
+            # Changes since the snapshot are picked up
+            self.assertEqual(CkanMetaRepo(self.repo).highest_version('AwesomeMod').string, '0.13')
+        finally:
+            self.repo.git.reset('--hard', 'HEAD~1')
+
+    def test_version_index_snapshot_unchanged(self):
+        self.assertEqual(self.ckm_repo.highest_version('AwesomeMod').string, '0.11')
+        self.ckm_repo.save_snapshot()
+        restarted = CkanMetaRepo(self.repo)
+        self.assertEqual(restarted.highest_version('AwesomeMod').string, '0.11')
+        with mock.patch.object(RepoSnapshot, 'save') as save:
+            restarted.save_snapshot()
+            save.assert_not_called()
+
+    def test_snapshot_dir(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            ckm_repo = CkanMetaRepo(self.repo, game_id='ksp',
+                                    snapshot_dir=Path(snapshot_dir, 'snapshots'))
+            self.assertEqual(ckm_repo.snapshot.path,
+                             Path(snapshot_dir, 'snapshots', f'ksp-{RepoSnapshot.FILENAME}'))
+            self.assertEqual(ckm_repo.highest_version('AwesomeMod').string, '0.11')
+            ckm_repo.save_snapshot()
+            self.assertTrue(ckm_repo.snapshot.path.exists())
+
+    def test_snapshot_dir_shallow_clone(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            snapshot_dir = Path(tmpdir, 'snapshots')
+            full = Repo.clone_from(self.upstream.as_posix(), Path(tmpdir, 'full'))
+            full_repo = CkanMetaRepo(full, game_id='ksp', snapshot_dir=snapshot_dir)
+            self.assertEqual(full_repo.highest_version('AwesomeMod').string, '0.11')
+            self.assertEqual(full_repo.highest_version('AdequateMod').string, '1:0.2')
+            full_repo.save_snapshot()
+            new_ckan = full_repo.mod_path('AwesomeMod').joinpath('AwesomeMod-0.13.ckan')
+            new_ckan.write_text('{"identifier": "AwesomeMod", "version": "0.13"}')
+            full_repo.commit([new_ckan], 'Add release')
+            # A fresh clone that doesn't have the snapshot's commit
+            shallow = Repo.clone_from(f'file://{full.working_dir}',
+                                      Path(tmpdir, 'shallow'), depth=1)
+            shallow_repo = CkanMetaRepo(shallow, game_id='ksp', snapshot_dir=snapshot_dir)
+            with mock.patch.object(CkanMetaRepo, 'ckans',
+                                   wraps=shallow_repo.ckans) as ckans:
+                self.assertEqual(shallow_repo.highest_version('AwesomeMod').string, '0.13')
+                self.assertEqual(shallow_repo.highest_version('AdequateMod').string, '1:0.2')
+                # Only the changed mod is rescanned
+                ckans.assert_called_once_with('AwesomeMod')
+
+    def test_object_reader(self):
+        reader = CkanMetaRepo(self.repo, object_reader=True)
+        self.assertListEqual(sorted(reader.identifiers()),
+                             sorted(self.ckm_repo.identifiers()))
+        self.assertListEqual(
+            sorted(ck.version.string for ck in reader.ckans('AwesomeMod')),
+            sorted(ck.version.string for ck in self.ckm_repo.ckans('AwesomeMod')))
+        self.assertListEqual(list(reader.ckans('NotAMod')), [])
+        self.assertEqual(reader.highest_version('AdequateMod').string, '1:0.2')
+
+    def test_object_reader_follows_primary(self):
+        reader = CkanMetaRepo(self.repo, object_reader=True)
+        self.assertEqual(reader.highest_version('AwesomeMod').string, '0.11')
+        new_ckan = self.ckm_repo.mod_path('AwesomeMod').joinpath('AwesomeMod-0.13.ckan')
+        new_ckan.write_text('{"identifier": "AwesomeMod", "version": "0.13"}')
+        # Uncommitted files aren't seen
+        self.assertEqual(reader.highest_version('AwesomeMod').string, '0.11')
+        self.ckm_repo.commit([new_ckan], 'Add release')
+        try:
+            self.assertEqual(reader.highest_version('AwesomeMod').string, '0.13')
+            self.assertEqual(reader.highest_version_module('AwesomeMod', False).filename,
+                             new_ckan)
+        finally:
+            self.repo.git.reset('--hard', 'HEAD~1')
+
+
+class TestRepoSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot = RepoSnapshot(Path(self.tmpdir.name, RepoSnapshot.FILENAME))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_missing(self):
+        self.assertIsNone(self.snapshot.load('index'))
+
+    def test_round_trip(self):
+        self.snapshot.save('index', 'abc123', [['a', 1, None], ['b', 2, True]])
+        self.snapshot.save('other', 'def456', [])
+        self.assertEqual(self.snapshot.load('index'),
+                         ('abc123', [['a', 1, None], ['b', 2, True]]))
+        self.snapshot.save('index', 'fed321', [['c', 3, False]])
+        self.assertEqual(self.snapshot.load('index'), ('fed321', [['c', 3, False]]))
+        self.assertEqual(self.snapshot.load('other'), ('def456', []))
+
+    def test_corrupt(self):
+        self.snapshot.path.write_text('Not a database')
+        self.assertIsNone(self.snapshot.load('index'))
+
 
 class TestRepoConfig(TestRepo):
     test_data = Path(PurePath(__file__).parent, 'testdata/CKAN-meta')
@@ -1,7 +1,14 @@
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from pathlib import Path, PurePath
+from unittest import mock
 
-from netkan.common import sqs_batch_entries
-from netkan.scheduler import NetkanScheduler
+from netkan.common import (sqs_batch_entries, sqs_message_size, sqs_send_batch,
+                           sqs_send_messages)
+from netkan.metadata import Netkan
+from netkan.scheduler import AdaptiveSchedule, HostInterleave, NetkanScheduler
+from netkan.status import ModStatus
 
 from .common import SharedArgsHarness
 
@@ -52,3 +59,203 @@ class TestScheduler(SharedArgsHarness):
             batches.append(batch)
         self.assertEqual(len(batches[0]), 10)
         self.assertEqual(len(batches), 1)
+
+    def test_adaptive(self):
+        now = datetime.now(timezone.utc)
+        rows = [ModStatus(ModIdentifier='DogeCoinFlag', game_id='ksp', success=True,
+                          release_date=now - timedelta(days=2),
+                          last_inflated=now - timedelta(minutes=30)),
+                ModStatus(ModIdentifier='FlagCoinDoge', game_id='ksp', success=True,
+                          release_date=now - timedelta(days=400),
+                          last_inflated=now - timedelta(minutes=30))]
+        scheduler = NetkanScheduler(self.shared_args, 'TestyMcTestFace', 'token', 'ksp',
+                                    nonhooks_group=True, adaptive=True)
+        with mock.patch.object(ModStatus, 'batch_get', return_value=rows) as batch_get:
+            scheduled = [nk.identifier for nk in scheduler.scheduled_netkans()]
+        batch_get.assert_called_once()
+        self.assertIn('DogeCoinFlag', scheduled)
+        self.assertNotIn('FlagCoinDoge', scheduled)
+
+    def test_plan(self):
+        scheduler = NetkanScheduler(self.shared_args, 'TestyMcTestFace', 'token', 'ksp',
+                                    nonhooks_group=True, webhooks_group=True, dry_run=True)
+        plan = scheduler.plan()
+        self.assertEqual(plan['game_id'], 'ksp')
+        self.assertEqual(len(plan['netkans']), 13)
+        self.assertListEqual(list(plan['stages']), ['parse', 'select', 'versions', 'messages'])
+        entry = next(e for e in plan['netkans'] if e['identifier'] == 'DogeCoinFlag')
+        self.assertEqual(entry['group'], 'nonhooks')
+        self.assertIsNone(entry['high_version'])
+        self.assertGreater(entry['message_size'], 0)
+        self.assertEqual(plan['message_bytes'],
+                         sum(e['message_size'] for e in plan['netkans']))
+
+    @mock.patch('netkan.scheduler.github_limit_remaining', return_value=5000)
+    def test_interleave(self, limit):
+        self.shared_args.dev = False
+        scheduler = NetkanScheduler(self.shared_args, 'TestyMcTestFace', 'token', 'ksp',
+                                    nonhooks_group=True, interleave=True)
+        scheduled = [nk.kref_src for nk in scheduler.scheduled_netkans()]
+        limit.assert_called_once_with('token')
+        self.assertEqual(len(scheduled), 12)
+        self.assertEqual(scheduled.count('github'), 8)
+        # The other hosts are spread between the GitHub mods
+        self.assertNotIn(('github', 'github', 'github'),
+                         set(zip(scheduled, scheduled[1:], scheduled[2:])))
+
+    @mock.patch('netkan.scheduler.github_limit_remaining', return_value=5000)
+    @mock.patch('netkan.scheduler.sqs_send_messages', return_value=Counter())
+    def test_send_workers(self, send, _limit):
+        self.shared_args.dev = False
+        for interleave, workers in ((False, 4), (True, 1)):
+            scheduler = NetkanScheduler(self.shared_args, 'TestyMcTestFace', 'token', 'ksp',
+                                        nonhooks_group=True, send_workers=4,
+                                        interleave=interleave)
+            scheduler.client = mock.Mock()
+            scheduler.schedule_all_netkans()
+            # Interleaved runs are sent in order
+            self.assertEqual(send.call_args.kwargs['workers'], workers)
+
+
+class TestSqsBatching(unittest.TestCase):
+
+    @staticmethod
+    def message(ident, body_size=10):
+        return {
+            'Id': ident,
+            'MessageBody': 'x' * body_size,
+            'MessageGroupId': '1',
+            'MessageAttributes': {
+                'GameId': {'DataType': 'String', 'StringValue': 'ksp'},
+            },
+        }
+
+    def test_message_size(self):
+        self.assertEqual(sqs_message_size(self.message('a')),
+                         10 + len('GameId') + len('String') + len('ksp'))
+
+    def test_batches_by_bytes(self):
+        messages = [self.message(str(i), 100_000) for i in range(5)]
+        batches = list(sqs_batch_entries(messages))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+    def test_oversized_message_alone(self):
+        messages = [self.message('a'), self.message('b', 300_000), self.message('c')]
+        batches = list(sqs_batch_entries(messages))
+        self.assertEqual([[m['Id'] for m in b] for b in batches],
+                         [['a'], ['b'], ['c']])
+
+    @mock.patch('netkan.common.time.sleep')
+    def test_send_retries_failed(self, sleep):
+        client = mock.Mock()
+        client.send_message_batch.side_effect = [
+            {'Failed': [{'Id': '1', 'SenderFault': False},
+                        {'Id': '2', 'SenderFault': True}]},
+            {},
+        ]
+        counts = sqs_send_batch(client, 'url', [self.message(str(i)) for i in range(3)])
+        self.assertEqual(counts, {'sent': 2, 'retried': 1, 'failed': 1})
+        retried = client.send_message_batch.call_args_list[1].kwargs['Entries']
+        self.assertEqual([m['Id'] for m in retried], ['1'])
+        sleep.assert_called_once_with(1.0)
+
+    @mock.patch('netkan.common.time.sleep')
+    def test_send_gives_up(self, sleep):
+        client = mock.Mock()
+        client.send_message_batch.return_value = {
+            'Failed': [{'Id': '0', 'SenderFault': False}]}
+        counts = sqs_send_batch(client, 'url', [self.message('0')], retries=2)
+        self.assertEqual(counts['sent'], 0)
+        self.assertEqual(counts['retried'], 2)
+        self.assertEqual(counts['failed'], 1)
+        self.assertEqual(client.send_message_batch.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+
+    def test_send_concurrently(self):
+        client = mock.Mock()
+        client.send_message_batch.return_value = {}
+        counts = sqs_send_messages(client, 'url', [self.message(str(i)) for i in range(95)],
+                                   workers=4)
+        self.assertEqual(counts['sent'], 95)
+        self.assertEqual(client.send_message_batch.call_count, 10)
+        sent = [m['Id'] for call in client.send_message_batch.call_args_list
+                for m in call.kwargs['Entries']]
+        self.assertCountEqual(sent, [str(i) for i in range(95)])
+
+
+class TestAdaptiveSchedule(unittest.TestCase):
+
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+    def netkan(self, identifier, kref='#/ckan/spacedock/1'):
+        return Netkan(contents=f'{{"identifier": "{identifier}", "$kref": "{kref}"}}')
+
+    def status(self, released_days_ago, inflated_hours_ago, success=True):
+        return ModStatus(ModIdentifier='Mod', game_id='ksp', success=success,
+                         release_date=self.now - timedelta(days=released_days_ago),
+                         last_inflated=self.now - timedelta(hours=inflated_hours_ago))
+
+    def test_intervals(self):
+        schedule = AdaptiveSchedule(now=self.now)
+        netkan = self.netkan('Mod')
+        self.assertEqual(schedule.interval(netkan, self.status(1, 1)),
+                         (timedelta(0), 'active'))
+        self.assertEqual(schedule.interval(netkan, self.status(20, 1)),
+                         (timedelta(hours=2), 'recent'))
+        self.assertEqual(schedule.interval(netkan, self.status(100, 1)),
+                         (timedelta(hours=6), 'quiet'))
+        self.assertEqual(schedule.interval(netkan, self.status(1000, 1)),
+                         (timedelta(hours=24), 'dormant'))
+        self.assertEqual(schedule.interval(netkan, self.status(1, 1, success=False)),
+                         (timedelta(hours=6), 'failing'))
+        self.assertEqual(schedule.interval(self.netkan('Mod', '#/ckan/github/a/b'),
+                                           self.status(1000, 1)),
+                         (timedelta(hours=48), 'dormant'))
+
+    def test_last_indexed_counts_as_change(self):
+        status = self.status(1000, 1)
+        status.last_indexed = self.now - timedelta(days=1)
+        self.assertEqual(AdaptiveSchedule(now=self.now).interval(self.netkan('Mod'), status)[1],
+                         'active')
+
+    def test_plan(self):
+        schedule = AdaptiveSchedule(now=self.now)
+        netkans = [self.netkan(ident) for ident in ['Active', 'Dormant', 'Stale', 'New']]
+        statuses = {'Active': self.status(1, 0.5),
+                    'Dormant': self.status(1000, 3),
+                    'Stale': self.status(1000, 30)}
+        self.assertListEqual([nk.identifier for nk in schedule.plan(netkans, statuses)],
+                             ['Active', 'Stale', 'New'])
+        self.assertEqual(schedule.report,
+                         {'active': 1, 'dormant': 1, 'new': 1, 'not due': 1})
+
+    def test_budget(self):
+        schedule = AdaptiveSchedule(max_scheduled=2, now=self.now)
+        netkans = [self.netkan(ident) for ident in ['Recent', 'Stale', 'New']]
+        statuses = {'Recent': self.status(20, 3), 'Stale': self.status(1000, 72)}
+        self.assertListEqual([nk.identifier for nk in schedule.plan(netkans, statuses)],
+                             ['New', 'Stale'])
+        self.assertEqual(schedule.report['over budget'], 1)
+
+
+class TestHostInterleave(unittest.TestCase):
+
+    netkans = [Netkan(contents=f'{{"identifier": "{ident}", "$kref": "#/ckan/{kref}"}}')
+               for ident, kref in [('C1', 'curse/1'),
+                                   ('G1', 'github/a/1'), ('G2', 'github/a/2'),
+                                   ('G3', 'github/a/3'), ('G4', 'github/a/4'),
+                                   ('S1', 'spacedock/1'), ('S2', 'spacedock/2')]]
+
+    def test_order(self):
+        self.assertListEqual([nk.identifier for nk in HostInterleave().order(self.netkans)],
+                             ['G1', 'S1', 'G2', 'C1', 'G3', 'S2', 'G4'])
+
+    def test_github_budget(self):
+        interleave = HostInterleave(github_budget=6)
+        self.assertEqual(interleave.github_covered(4), 2)
+        self.assertListEqual([nk.identifier for nk in interleave.order(self.netkans)],
+                             ['G1', 'S1', 'C1', 'G2', 'S2', 'G3', 'G4'])
+
+    def test_github_budget_plenty(self):
+        self.assertEqual(HostInterleave(github_budget=5000).github_covered(4), 4)
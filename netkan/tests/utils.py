@@ -3,7 +3,7 @@ import tempfile
 from pathlib import Path
 from git import Repo
 
-from netkan.utils import repo_file_add_or_changed
+from netkan.utils import repo_file_add_or_changed, ParseCache, file_stamp, init_repo
 
 
 class TestNetKANUtilsRepoFileAddOrChange(unittest.TestCase):
@@ -50,3 +50,80 @@ class TestNetKANUtilsRepoFileAddOrChange(unittest.TestCase):
         existing = Path(self.nested, 'existing_nested.txt')
         existing.write_text('text', encoding='UTF-8')
         self.assertTrue(repo_file_add_or_changed(self.repo, existing))
+
+
+class TestInitRepo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.upstream = Path(self.tmpdir.name, 'upstream')
+        repo = Repo.init(self.upstream, initial_branch='main')
+        for path in ['AwesomeMod/AwesomeMod-1.0.ckan', 'AwesomeMod/notes.txt',
+                     'download_counts.json', 'README.md']:
+            Path(self.upstream, path).parent.mkdir(exist_ok=True)
+            Path(self.upstream, path).write_text(path, encoding='UTF-8')
+        repo.index.add(repo.untracked_files)
+        repo.index.commit('test')
+        repo.config_writer().set_value('uploadpack', 'allowFilter', 'true').release()
+        self.url = self.upstream.as_uri()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def files(self, repo):
+        working = Path(repo.working_dir)
+        return sorted(path.relative_to(working).as_posix()
+                      for path in working.rglob('*')
+                      if path.is_file() and '.git' not in path.parts)
+
+    def test_full_clone(self):
+        repo = init_repo(self.url, Path(self.tmpdir.name, 'full').as_posix(), True)
+        self.assertEqual(len(self.files(repo)), 4)
+        self.assertFalse(repo.config_reader().has_option(
+            'remote "origin"', 'partialclonefilter'))
+
+    def test_blobless_clone(self):
+        repo = init_repo(self.url, Path(self.tmpdir.name, 'blobless').as_posix(), True,
+                         blobless=True)
+        self.assertEqual(len(self.files(repo)), 4)
+        self.assertEqual(repo.config_reader().get_value(
+            'remote "origin"', 'partialclonefilter'), 'blob:none')
+
+    def test_sparse_checkout(self):
+        path = Path(self.tmpdir.name, 'sparse').as_posix()
+        repo = init_repo(self.url, path, False, blobless=True,
+                         sparse_paths=['/download_counts.json', '/*/*.ckan'])
+        self.assertListEqual(self.files(repo),
+                             ['AwesomeMod/AwesomeMod-1.0.ckan', 'download_counts.json'])
+        self.assertFalse(repo.is_dirty())
+        # Reopening applies the profile it's given
+        repo = init_repo(self.url, path, False, sparse_paths=['/README.md'])
+        self.assertListEqual(self.files(repo), ['README.md'])
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = ParseCache()
+        self.assertEqual(cache.get('a', lambda: 1), 1)
+        self.assertEqual(cache.get('a', lambda: 2), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = ParseCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)
+        cache.get('c', lambda: 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', lambda: 4), 1)
+        self.assertEqual(cache.get('b', lambda: 5), 5)
+
+    def test_file_stamp_changes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'file.txt')
+            path.write_text('one', encoding='UTF-8')
+            before = file_stamp(path)
+            self.assertEqual(file_stamp(path), before)
+            path.write_text('three', encoding='UTF-8')
+            self.assertNotEqual(file_stamp(path), before)
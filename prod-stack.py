@@ -251,6 +251,7 @@ netkan_role = t.add_resource(Role(
                     {
                         "Action": [
                             "cloudwatch:GetMetricStatistics",
+                            "cloudwatch:PutMetricData",
                             "ec2:DescribeVolumes"
                         ],
                         "Effect": "Allow",
@@ -634,6 +635,7 @@ services = [
             ('CKAN_REPOS', CKANMETA_REPOS),
             ('SQS_QUEUE', GetAtt(outbound, 'QueueName')),
             ('AWS_DEFAULT_REGION', Sub('${AWS::Region}')),
+            ('METRICS_NAMESPACE', 'NetKAN'),
         ],
         'volumes': [
             ('ckan_cache', '/home/netkan/ckan_cache'),
@@ -650,6 +652,11 @@ services = [
             ('NETKAN_REMOTES', NETKAN_REMOTES),
             ('CKANMETA_REMOTES', CKANMETA_REMOTES),
             ('AWS_DEFAULT_REGION', Sub('${AWS::Region}')),
+            # The clone is thrown away after each run, the snapshots aren't
+            ('SNAPSHOT_DIR', '/home/netkan/ckan_cache/snapshots'),
+        ],
+        'volumes': [
+            ('ckan_cache', '/home/netkan/ckan_cache'),
         ],
         'schedule': 'rate(30 minutes)',
     },
@@ -668,6 +675,10 @@ services = [
             ('NETKAN_REMOTES', NETKAN_REMOTES),
             ('CKANMETA_REMOTES', CKANMETA_REMOTES),
             ('AWS_DEFAULT_REGION', Sub('${AWS::Region}')),
+            ('SNAPSHOT_DIR', '/home/netkan/ckan_cache/snapshots'),
+        ],
+        'volumes': [
+            ('ckan_cache', '/home/netkan/ckan_cache'),
         ],
         'schedule': 'rate(1 day)',
     },
@@ -743,6 +754,11 @@ services = [
         'env': [
             ('NETKAN_REMOTES', NETKAN_REMOTES),
             ('CKANMETA_REMOTES', CKANMETA_REMOTES),
+            # Each run's clone is thrown away, this is kept for the next
+            ('DOWNLOAD_COUNTS_DIR', '/home/netkan/ckan_cache/download_counts'),
+        ],
+        'volumes': [
+            ('ckan_cache', '/home/netkan/ckan_cache'),
         ],
         'schedule': 'rate(1 day)',
     },
@@ -840,6 +856,10 @@ services = [
                     ('INFLATION_SQS_QUEUES', INFLATION_QUEUES),
                     ('ADD_SQS_QUEUE', GetAtt(addqueue, 'QueueName')),
                     ('MIRROR_SQS_QUEUE', GetAtt(mirrorqueue, 'QueueName')),
+                    ('SNAPSHOT_DIR', '/home/netkan/ckan_cache/snapshots'),
+                ],
+                'volumes': [
+                    ('ckan_cache', '/home/netkan/ckan_cache'),
                 ],
             },
             {
@@ -864,6 +884,7 @@ services = [
             ('NETKAN_REMOTES', NETKAN_REMOTES),
             ('CKAN_USER', NETKAN_USER),
             ('CKAN_REPOS', NETKAN_REPOS),
+            ('METRICS_NAMESPACE', 'NetKAN'),
         ],
     },
     {
@@ -877,6 +898,7 @@ services = [
             ('IA_COLLECTIONS', 'ksp=kspckanmods'),
             ('SQS_QUEUE', GetAtt(mirrorqueue, 'QueueName')),
             ('AWS_DEFAULT_REGION', Sub('${AWS::Region}')),
+            ('METRICS_NAMESPACE', 'NetKAN'),
         ],
         'volumes': [
             ('ckan_cache', '/home/netkan/ckan_cache'),